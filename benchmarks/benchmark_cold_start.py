@@ -0,0 +1,135 @@
+"""Benchmarks the cold start of the bot: import time and time to first response.
+
+Every run imports the bot in a fresh interpreter and serves one update through
+the webhook handler. The default update carries no message, so no Firestore or
+Telegram access is needed. With --update start a /start message is served,
+which needs the Firestore emulator (FIRESTORE_EMULATOR_HOST and
+GOOGLE_CLOUD_PROJECT) and answers the Telegram API calls from a local stub.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+from stub_servers import TelegramStub, server_url, start_stub
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "telegram-bot")
+
+CHILD = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import flask
+import main
+
+imported = time.perf_counter()
+with main.app.test_request_context(method="POST", json={update!r}):
+    response, status = main.handle_telegram_update(flask.request)
+responded = time.perf_counter()
+
+print(json.dumps({{
+    "import_seconds": imported - start,
+    "first_response_seconds": responded - imported,
+    "time_to_first_response_seconds": responded - start,
+    "status": status,
+    "modules": len(sys.modules),
+    "pyproj_imported": "pyproj" in sys.modules,
+}}))
+"""
+
+UPDATES = {
+    "empty": {"update_id": 1},
+    "start": {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Benchmark"},
+            "text": "/start",
+        },
+    },
+}
+
+
+def run_once(mode: str, update: Dict[str, Any], api_url: str, cloud_logging: bool):
+    """Imports the bot in a fresh interpreter and serves one update."""
+    env = dict(
+        os.environ,
+        STARTUP_MODE=mode,
+        CLOUD_LOGGING="1" if cloud_logging else "0",
+        BOT_TOKEN=os.environ.get("BOT_TOKEN", "0:benchmark"),
+        TELEGRAM_API_URL=api_url,
+        SEND_MODE="direct",
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD.format(update=update)],
+        cwd=BOT_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode:
+        raise RuntimeError(f"{mode} run failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarise(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarises the runs of a startup mode."""
+    summary = {}
+    for key in [
+        "import_seconds",
+        "first_response_seconds",
+        "time_to_first_response_seconds",
+    ]:
+        values = [run[key] for run in runs]
+        summary[key] = {
+            "median": statistics.median(values),
+            "min": min(values),
+            "max": max(values),
+        }
+    summary["modules"] = runs[-1]["modules"]
+    summary["pyproj_imported"] = runs[-1]["pyproj_imported"]
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", nargs="+", default=["lazy", "eager"])
+    parser.add_argument("--update", choices=sorted(UPDATES), default="empty")
+    parser.add_argument(
+        "--cloud-logging",
+        action="store_true",
+        help="attach the Cloud Logging handler, needs credentials",
+    )
+    args = parser.parse_args()
+
+    server, _ = start_stub(TelegramStub, latency=(0.0, 0.0))
+    api_url = f"{server_url(server)}/bot{{0}}/{{1}}"
+
+    results = {}
+    for mode in args.modes:
+        runs = [
+            run_once(mode, UPDATES[args.update], api_url, args.cloud_logging)
+            for _ in range(args.runs)
+        ]
+        results[mode] = summarise(runs)
+    server.shutdown()
+
+    print(
+        json.dumps(
+            {"runs": args.runs, "update": args.update, "modes": results}, indent=2
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
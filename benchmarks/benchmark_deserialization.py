@@ -0,0 +1,114 @@
+"""Benchmarks loading trip documents into models, validated and trusted.
+
+Compares validating every document, as list queries did before, with the trusted
+path of FirestoreModel.from_firestore_docs and with the plain document dicts read by
+the export and hotspots list paths. Importing the models needs the bot's dependencies
+installed but no Firestore access.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "telegram-bot"))
+
+import models  # noqa: E402
+from models import Trip  # noqa: E402
+from schema_migrations import TRIP_SCHEMA_VERSION  # noqa: E402
+
+
+class Snapshot:
+    """A stand-in for a Firestore document snapshot."""
+
+    exists = True
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self._data = data
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns a copy of the document data, as Firestore does."""
+        return dict(self._data)
+
+
+def generate_docs(count: int, seed: int, schema_version: int) -> List[Snapshot]:
+    """Generates synthetic trip documents."""
+    rng = random.Random(seed)
+    start_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    docs = []
+    for i in range(count):
+        start_time += timedelta(minutes=30)
+        docs.append(
+            Snapshot(
+                {
+                    "schema_version": schema_version,
+                    "trip_id": f"trip{i:08d}",
+                    "shift_id": f"shift{i // 30:06d}",
+                    "user_id": "42",
+                    "start_latitude": 22.3 + rng.random() / 10,
+                    "start_longitude": 114.1 + rng.random() / 10,
+                    "start_address": f"彌敦道 {rng.randint(1, 999)}",
+                    "start_time": start_time,
+                    "end_latitude": 22.3 + rng.random() / 10,
+                    "end_longitude": 114.1 + rng.random() / 10,
+                    "end_address": f"軒尼詩道 {rng.randint(1, 999)}",
+                    "end_time": start_time + timedelta(minutes=rng.randint(5, 25)),
+                    "fare": round(rng.uniform(27, 400), 1),
+                }
+            )
+        )
+    return docs
+
+
+def legacy_load(docs: List[Snapshot]) -> List[Trip]:
+    """Loads the trips the way list queries did before, one validation per document."""
+    trips = [Trip.model_validate(doc.to_dict()) if doc.exists else None for doc in docs]
+    return [_ for _ in trips if _ is not None]
+
+
+def measure(load: Callable[[], list], repeat: int) -> float:
+    """Measures the best duration of a few loads, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load()
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1000, 2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trips", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    docs = generate_docs(args.trips, args.seed, TRIP_SCHEMA_VERSION)
+
+    def load_validated() -> List[Trip]:
+        models.DESERIALIZATION_MODE = "validate"
+        try:
+            return Trip.from_firestore_docs(docs)
+        finally:
+            models.DESERIALIZATION_MODE = "trusted"
+
+    results = {
+        "trips": args.trips,
+        "per_document_validate_ms": measure(lambda: legacy_load(docs), args.repeat),
+        "validate_mode_ms": measure(load_validated, args.repeat),
+        "trusted_construct_ms": measure(
+            lambda: Trip.from_firestore_docs(docs), args.repeat
+        ),
+        "document_dicts_ms": measure(
+            lambda: [doc.to_dict() for doc in docs], args.repeat
+        ),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Benchmarks the /hotspots pickup binning against a per-trip loop.
+
+Reports the time to bin a driver's trip history from scratch, to rank the cells
+for a time of week, and to merge a few newly ended trips into the cached bins.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "telegram-bot"))
+
+import pyproj  # noqa: E402
+
+from hotspots import HOURS_PER_WEEK, HotspotIndex  # noqa: E402
+
+TRANSFORMER = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:2326")
+
+
+def hk1980_grid(lat, lon):
+    """Converts latitude and longitude to HK1980 grid easting and northing."""
+    northing, easting = TRANSFORMER.transform(lat, lon)
+    return easting, northing
+
+
+def generate_trips(count: int, seed: int) -> List[Dict[str, Any]]:
+    """Generates synthetic paid trips around a few pickup areas, oldest first."""
+    rng = random.Random(seed)
+    areas = [(22.28 + rng.random() / 10, 114.15 + rng.random() / 10) for _ in range(40)]
+    start_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    trips = []
+    for i in range(count):
+        start_time += timedelta(minutes=rng.randint(10, 40))
+        lat, lon = rng.choice(areas)
+        trips.append(
+            {
+                "start_latitude": lat + rng.gauss(0, 0.003),
+                "start_longitude": lon + rng.gauss(0, 0.003),
+                "start_address": f"彌敦道 {i % 999 + 1}",
+                "start_time": start_time,
+                "end_time": start_time + timedelta(minutes=rng.randint(5, 25)),
+                "fare": round(rng.uniform(27, 400), 1),
+            }
+        )
+    return trips
+
+
+def loop_top(trips: List[Dict[str, Any]], when: datetime, cell_size: float) -> list:
+    """Bins the trips one at a time with dictionaries, then ranks the cells."""
+    bins: Dict[tuple, float] = defaultdict(float)
+    for trip in trips:
+        trip_hour = int((trip["start_time"].timestamp() + 8 * 3600) // 3600 + 72)
+        easting, northing = hk1980_grid(trip["start_latitude"], trip["start_longitude"])
+        cell = (easting // cell_size, northing // cell_size)
+        bins[(cell, trip_hour % HOURS_PER_WEEK)] += trip["fare"]
+
+    hour = int((when.timestamp() + 8 * 3600) // 3600 + 72) % HOURS_PER_WEEK
+    hours = {(hour + offset) % HOURS_PER_WEEK for offset in (-1, 0, 1)}
+    fares: Dict[tuple, float] = defaultdict(float)
+    for (cell, trip_hour), fare in bins.items():
+        if trip_hour in hours:
+            fares[cell] += fare
+    return sorted(fares.items(), key=lambda item: -item[1])[:5]
+
+
+def measure(run: Callable[[], Any], repeat: int) -> float:
+    """Measures the best duration of a few runs, in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1000, 2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trips", type=int, nargs="+", default=[10_000, 50_000])
+    parser.add_argument("--new-trips", type=int, default=5)
+    parser.add_argument("--cell-size", type=float, default=500.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = {}
+    for count in args.trips:
+        trips = generate_trips(count + args.new_trips, args.seed)
+        history, new_trips = trips[:count], trips[count:]
+        when = history[-1]["start_time"]
+
+        def build() -> HotspotIndex:
+            index = HotspotIndex(project=hk1980_grid, cell_size=args.cell_size)
+            index.add_trips(history)
+            return index
+
+        index = build()
+
+        def refresh() -> None:
+            refreshed = HotspotIndex(project=hk1980_grid, cell_size=args.cell_size)
+            refreshed.keys, refreshed.counts, refreshed.fares = (
+                index.keys,
+                index.counts,
+                index.fares,
+            )
+            refreshed.first_time, refreshed.last_time = (
+                index.first_time,
+                index.last_time,
+            )
+            refreshed.add_trips(new_trips)
+            refreshed.top(when)
+
+        results[count] = {
+            "bins": len(index.keys),
+            "loop_build_and_top_ms": measure(
+                lambda: loop_top(history, when, args.cell_size), args.repeat
+            ),
+            "build_and_top_ms": measure(lambda: build().top(when), args.repeat),
+            "top_ms": measure(lambda: index.top(when), args.repeat),
+            "refresh_and_top_ms": measure(refresh, args.repeat),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
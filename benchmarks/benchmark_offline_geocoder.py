@@ -0,0 +1,92 @@
+"""Benchmarks load time, memory and query latency of the offline reverse geocoder."""
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "telegram-bot"))
+
+from offline_geocoder import OfflineGeocoder  # noqa: E402
+
+# Rough HK1980 grid extent of the urban areas
+EASTING_RANGE = (815000.0, 845000.0)
+NORTHING_RANGE = (810000.0, 835000.0)
+
+
+def write_address_points(path: str, count: int, seed: int) -> None:
+    """Writes synthetic address points to a csv file."""
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["easting", "northing", "address"])
+        for i in range(count):
+            writer.writerow(
+                [
+                    f"{rng.uniform(*EASTING_RANGE):.1f}",
+                    f"{rng.uniform(*NORTHING_RANGE):.1f}",
+                    f"地段 {i // 4}",
+                ]
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--points", type=int, default=200_000)
+    parser.add_argument("--queries", type=int, default=100_000)
+    parser.add_argument("--max-distance", type=float, default=30.0)
+    parser.add_argument("--bucket-size", type=float, default=100.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "hk_address_points.csv")
+        write_address_points(path, args.points, args.seed)
+
+        start = time.perf_counter()
+        geocoder = OfflineGeocoder.from_csv(path, bucket_size=args.bucket_size)
+        load_seconds = time.perf_counter() - start
+
+        # Measured on a second load, tracing allocations skews the load time
+        tracemalloc.start()
+        traced_geocoder = OfflineGeocoder.from_csv(path, bucket_size=args.bucket_size)
+        memory_bytes, peak_memory_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del traced_geocoder
+
+    rng = random.Random(args.seed + 1)
+    queries = [
+        (rng.uniform(*EASTING_RANGE), rng.uniform(*NORTHING_RANGE))
+        for _ in range(args.queries)
+    ]
+    found = 0
+    start = time.perf_counter()
+    for easting, northing in queries:
+        if geocoder.nearest(easting, northing, args.max_distance) is not None:
+            found += 1
+    query_seconds = time.perf_counter() - start
+
+    print(
+        json.dumps(
+            {
+                "points": len(geocoder),
+                "buckets": len(geocoder.buckets),
+                "load_seconds": round(load_seconds, 3),
+                "memory_mb": round(memory_bytes / 2**20, 1),
+                "peak_memory_mb": round(peak_memory_bytes / 2**20, 1),
+                "queries": args.queries,
+                "found_ratio": round(found / args.queries, 3),
+                "query_microseconds": round(query_seconds / args.queries * 1e6, 2),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Replays synthetic driver sessions through the long-polling runner.
+
+The sessions of benchmark_webhook.py are queued on a fake Bot API, which serves
+them to getUpdates and answers the sends, and the runner of main.py consumes
+them until every update is handled and its offset confirmed. The documents are
+kept in SQLite by default, so no emulator is needed; with --storage-backend
+firestore, start the Firestore emulator first as for benchmark_webhook.py.
+
+Reports updates per second, processing times and the runner counters as JSON.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark_webhook import BOT_DIR, Session, git_commit
+from stub_servers import BotAPIStub, GeocoderStub, server_url, start_stub
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--drivers", type=int, default=50)
+    parser.add_argument("--cycles", type=int, default=10, help="trips per shift")
+    parser.add_argument("--export-every", type=int, default=5)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--telegram-latency", type=float, nargs=2, default=[0.02, 0.08])
+    parser.add_argument("--geocoder-latency", type=float, nargs=2, default=[0.1, 0.4])
+    parser.add_argument(
+        "--storage-backend", choices=["sqlite", "firestore"], default="sqlite"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.storage_backend == "firestore" and not os.environ.get(
+        "FIRESTORE_EMULATOR_HOST"
+    ):
+        parser.error("FIRESTORE_EMULATOR_HOST is not set, start the emulator first")
+
+    telegram, telegram_stub = start_stub(BotAPIStub, tuple(args.telegram_latency))
+    geocoder, geocoder_stub = start_stub(GeocoderStub, tuple(args.geocoder_latency))
+
+    run_id = int(time.time()) % 100000
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-ar-baak")
+    os.environ.update(
+        {
+            "BOT_TOKEN": "0:benchmark",
+            "CLOUD_LOGGING": "0",
+            "STORAGE_BACKEND": args.storage_backend,
+            "SQLITE_PATH": os.path.join(tempfile.mkdtemp(), "taxi.db"),
+            "UPDATE_SOURCE": "polling",
+            "SEND_MODE": "queued",
+            "POLLING_MAX_CONCURRENCY": str(args.max_concurrency),
+            "POLLING_TIMEOUT": "1",
+            "TELEGRAM_API_URL": f"{server_url(telegram)}/bot{{0}}/{{1}}",
+            "OSM_URL": f"{server_url(geocoder)}/reverse",
+            "HK_GEODATA_URL": f"{server_url(geocoder)}/gs/api/v1.0.0/identify",
+            "HK_ADDRESS_POINTS_PATH": "",
+        }
+    )
+    sys.path.insert(0, BOT_DIR)
+    import main as bot_main  # pylint: disable=import-outside-toplevel
+
+    rng = random.Random(args.seed)
+    updates = []
+    for i in range(args.drivers):
+        session = Session(run_id * 1000 + i, random.Random(rng.random()))
+        updates.append(
+            [update for _, update in session.updates(args.cycles, args.export_every)]
+        )
+    # Interleave the drivers as Telegram would, each in order, with increasing
+    # update IDs across all of them
+    queued = []
+    while any(updates):
+        for driver_updates in updates:
+            if driver_updates:
+                update = driver_updates.pop(0)
+                update["update_id"] = len(queued) + 1
+                queued.append(update)
+    telegram_stub.add_updates(queued)
+
+    runner = bot_main.polling_runner
+
+    def stop_when_done() -> None:
+        while runner.processed < len(queued):
+            time.sleep(0.05)
+        runner.stop()
+
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    start = time.perf_counter()
+    asyncio.run(runner.run())
+    elapsed = time.perf_counter() - start
+    telegram.shutdown()
+    geocoder.shutdown()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "updates": len(queued),
+        "elapsed_seconds": elapsed,
+        "updates_per_second": len(queued) / elapsed,
+        "runner": runner.stats(),
+        "unconfirmed_updates": telegram_stub.unconfirmed(),
+        "telegram_requests": telegram_stub.sent,
+        "geocoder_requests": geocoder_stub.requests,
+    }
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
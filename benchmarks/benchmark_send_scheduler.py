@@ -0,0 +1,158 @@
+"""Replays a shift change burst of sends against a rate limited fake Telegram.
+
+Every driver gets a few interactive replies and some drivers also a CSV export,
+all at once as at the 4am and 4pm shift changes. The fake Telegram answers a send
+with 429 and a retry_after when it exceeds the global or the per chat limit, and
+takes a configurable latency otherwise. The sends are made either straight from
+handler threads, with the retries the scheduler also makes inline, or through
+the send scheduler's queue.
+
+Reports the 429s, the time to drain the burst and the time from the burst to
+each interactive and bulk send, as JSON.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List
+
+from benchmark_webhook import BOT_DIR, summarise
+
+sys.path.insert(0, BOT_DIR)
+
+# pylint: disable=wrong-import-position
+from telebot.apihelper import ApiTelegramException  # noqa: E402
+from send_scheduler import BULK, INTERACTIVE, SendScheduler  # noqa: E402
+
+
+class FakeTelegram:
+    """Counts sends in sliding one second windows and rejects those over the limits."""
+
+    def __init__(
+        self, global_limit: int, chat_limit: int, latency: float, rng: random.Random
+    ) -> None:
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.latency = latency
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.sent: Deque[float] = deque()
+        self.sent_by_chat: Dict[int, Deque[float]] = {}
+        self.accepted = 0
+        self.rejected = 0
+
+    def send(self, chat_id: int) -> None:
+        """Sends a message, raising ApiTelegramException with 429 over the limits."""
+        time.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+        now = time.monotonic()
+        with self.lock:
+            chat_sent = self.sent_by_chat.setdefault(chat_id, deque())
+            for window in (self.sent, chat_sent):
+                while window and window[0] <= now - 1:
+                    window.popleft()
+            if len(self.sent) >= self.global_limit or len(chat_sent) >= self.chat_limit:
+                self.rejected += 1
+                raise ApiTelegramException(
+                    "sendMessage",
+                    None,
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1},
+                    },
+                )
+            self.sent.append(now)
+            chat_sent.append(now)
+            self.accepted += 1
+
+
+def run(args: argparse.Namespace, mode: str) -> Dict[str, Any]:
+    """Sends the burst in one mode and measures it."""
+    rng = random.Random(args.seed)
+    telegram = FakeTelegram(
+        args.global_limit, args.chat_limit, args.latency, random.Random(args.seed)
+    )
+    scheduler = SendScheduler(
+        enabled=mode == "queued",
+        global_rate=args.global_limit,
+        chat_rate=args.chat_limit,
+        chat_burst=args.chat_limit,
+        workers=args.workers,
+    )
+    latencies: Dict[int, List[float]] = {INTERACTIVE: [], BULK: []}
+    failures: List[str] = []
+    lock = threading.Lock()
+
+    def send(chat_id: int, priority: int) -> None:
+        telegram.send(chat_id)
+        with lock:
+            latencies[priority].append(time.monotonic() - start)
+
+    def handle(chat_id: int) -> None:
+        sends = [INTERACTIVE] * args.replies
+        if rng.random() < args.export_share:
+            sends.append(BULK)
+        for priority in sends:
+            try:
+                scheduler.enqueue(
+                    chat_id, lambda p=priority: send(chat_id, p), priority=priority
+                )
+            except ApiTelegramException as err:
+                with lock:
+                    failures.append(str(err))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.handlers) as executor:
+        list(executor.map(handle, range(args.drivers)))
+    handled = time.monotonic() - start
+    scheduler.join()
+    drained = time.monotonic() - start
+    stats = scheduler.stats()
+    return {
+        "handlers_seconds": round(handled, 3),
+        "drain_seconds": round(drained, 3),
+        "accepted": telegram.accepted,
+        "rejected_429": telegram.rejected,
+        "failed": len(failures) + stats["failed"],
+        "interactive_latency": summarise(latencies[INTERACTIVE]),
+        "bulk_latency": summarise(latencies[BULK]) if latencies[BULK] else None,
+        "scheduler": stats,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--drivers", type=int, default=300)
+    parser.add_argument("--replies", type=int, default=2)
+    parser.add_argument("--export-share", type=float, default=0.2)
+    parser.add_argument("--handlers", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--global-limit", type=int, default=30)
+    parser.add_argument("--chat-limit", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {
+        "parameters": vars(args),
+        "direct": run(args, "direct"),
+        "queued": run(args, "queued"),
+    }
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
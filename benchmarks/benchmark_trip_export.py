@@ -0,0 +1,141 @@
+"""Benchmarks the csv export of trips against the previous list-based export."""
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import pytz
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "telegram-bot"))
+
+from trip_export import export_trips_csv  # noqa: E402
+
+
+class LegacyTrip(BaseModel):
+    trip_id: Optional[str] = None
+    shift_id: Optional[str] = None
+    user_id: str
+    start_latitude: Optional[float] = None
+    start_longitude: Optional[float] = None
+    start_address: str
+    start_time: datetime
+    end_latitude: Optional[float] = None
+    end_longitude: Optional[float] = None
+    end_address: Optional[str] = None
+    end_time: Optional[datetime] = None
+    fare: Optional[float] = None
+
+
+def generate_trips(count: int, seed: int) -> Iterator[Dict[str, Any]]:
+    """Generates synthetic trip documents, newest first."""
+    rng = random.Random(seed)
+    start_time = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(
+        minutes=count * 30
+    )
+    for i in range(count):
+        start_time -= timedelta(minutes=30)
+        yield {
+            "trip_id": f"trip{i:08d}",
+            "shift_id": f"shift{i // 30:06d}",
+            "user_id": "42",
+            "start_latitude": 22.3 + rng.random() / 10,
+            "start_longitude": 114.1 + rng.random() / 10,
+            "start_address": f"彌敦道 {rng.randint(1, 999)}",
+            "start_time": start_time,
+            "end_latitude": 22.3 + rng.random() / 10,
+            "end_longitude": 114.1 + rng.random() / 10,
+            "end_address": f"軒尼詩道 {rng.randint(1, 999)}",
+            "end_time": start_time + timedelta(minutes=rng.randint(5, 25)),
+            "fare": round(rng.uniform(27, 400), 1),
+        }
+
+
+def legacy_export(count: int, seed: int) -> int:
+    """Exports the trips the way get_trips did before streaming."""
+    hk_tz = pytz.timezone("Asia/Hong_Kong")
+    trips = [LegacyTrip.model_validate(trip) for trip in generate_trips(count, seed)]
+    trips.sort(key=lambda trip: trip.start_time, reverse=True)
+    csv_data = StringIO()
+    writer = csv.writer(csv_data)
+    writer.writerow(
+        [
+            "Shift ID",
+            "Trip ID",
+            "Start Time",
+            "Start Address",
+            "End Time",
+            "End Address",
+            "Fare",
+        ]
+    )
+    for trip in trips:
+        trip_data = trip.model_dump()
+        writer.writerow(
+            [
+                trip.shift_id,
+                trip.trip_id,
+                trip_data["start_time"].astimezone(hk_tz).strftime("%Y-%m-%d %H:%M:%S"),
+                trip.start_address,
+                trip_data["end_time"].astimezone(hk_tz).strftime("%Y-%m-%d %H:%M:%S"),
+                trip.end_address,
+                f'${trip_data["fare"]:.2f}',
+            ]
+        )
+    csv_data.seek(0)
+    return len(trips)
+
+
+def streaming_export(count: int, seed: int, compress: bool = False) -> int:
+    """Exports the trips through the streaming pipeline."""
+    file, _, exported, _ = export_trips_csv(
+        generate_trips(count, seed), compress=compress
+    )
+    file.close()
+    return exported
+
+
+def measure(export: Callable[[], int]) -> Dict[str, float]:
+    """Measures the duration and peak traced memory of an export."""
+    start = time.perf_counter()
+    export()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    export()
+    _, peak_memory_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": round(seconds, 3),
+        "peak_memory_mb": round(peak_memory_bytes / 2**20, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trips", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = {}
+    for count in args.trips:
+        results[count] = {
+            "legacy": measure(lambda: legacy_export(count, args.seed)),
+            "streaming": measure(lambda: streaming_export(count, args.seed)),
+            "streaming_zip": measure(
+                lambda: streaming_export(count, args.seed, compress=True)
+            ),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Replays synthetic driver sessions through the webhook to measure throughput.
+
+Each simulated driver starts a shift, runs pick up, drop off and fare cycles,
+exports their trips now and then and ends the shift. Drivers are replayed
+concurrently, each in order, through handle_telegram_update against the
+Firestore emulator, with the Telegram Bot API and the geocoding services
+answered by local stubs of configurable latency.
+
+Start the emulator first, e.g.
+
+    gcloud emulators firestore start --host-port=127.0.0.1:8089
+    export FIRESTORE_EMULATOR_HOST=127.0.0.1:8089
+
+The JSON results carry the commit and parameters so that runs can be compared
+across commits.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Tuple
+
+from stub_servers import GeocoderStub, TelegramStub, server_url, start_stub
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "telegram-bot")
+
+# Hong Kong bounding box used for the synthetic locations
+HK_LATITUDE = (22.20, 22.50)
+HK_LONGITUDE = (113.90, 114.30)
+
+
+class Session:
+    """Builds the Telegram updates sent by one synthetic driver."""
+
+    def __init__(self, user_id: int, rng: random.Random) -> None:
+        self.user_id = user_id
+        self.rng = rng
+        self.message_id = 0
+
+    def message(self, **content: Any) -> Tuple[str, Dict[str, Any]]:
+        """Builds a message update from the driver."""
+        self.message_id += 1
+        kind = content.get("text", "location")
+        if not kind.startswith("/") and "text" in content:
+            kind = "fare"
+        return kind, {
+            "update_id": self.user_id * 100000 + self.message_id,
+            "message": {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"},
+                "from": {
+                    "id": self.user_id,
+                    "is_bot": False,
+                    "first_name": f"Driver {self.user_id}",
+                },
+                **content,
+            },
+        }
+
+    def location(self) -> Tuple[str, Dict[str, Any]]:
+        """Builds a location update somewhere in Hong Kong."""
+        return self.message(
+            location={
+                "latitude": self.rng.uniform(*HK_LATITUDE),
+                "longitude": self.rng.uniform(*HK_LONGITUDE),
+            }
+        )
+
+    def updates(self, cycles: int, export_every: int) -> Iterator[Tuple[str, Dict]]:
+        """Yields the updates of a shift with the given number of trips."""
+        yield self.message(text="/start")
+        yield self.message(text="/start_shift")
+        for cycle in range(1, cycles + 1):
+            yield self.location()
+            yield self.location()
+            yield self.message(text=f"{self.rng.uniform(27, 400):.1f}")
+            if export_every and cycle % export_every == 0:
+                yield self.message(text="/get_trips")
+        yield self.message(text="/end_shift")
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Gets the nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarise(latencies: List[float]) -> Dict[str, float]:
+    """Summarises latencies in seconds."""
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies),
+    }
+
+
+def git_commit() -> str:
+    """Gets the commit of the working tree, if any."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BOT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def firestore_ops(tracer_stats: Dict[str, Any], write_stats: Dict[str, Any]):
+    """Counts the Firestore round trips and document writes per command."""
+    ops = {}
+    for command, stats in tracer_stats.items():
+        updates = stats["latency"]["count"]
+        calls = {
+            name: span["count"]
+            for name, span in stats["spans"].items()
+            if name.startswith("firestore.")
+        }
+        writes = write_stats.get(command, {}).get("writes", 0)
+        ops[command] = {
+            "updates": updates,
+            "round_trips_per_update": sum(calls.values()) / updates,
+            "writes_per_update": writes / updates,
+            "calls": calls,
+        }
+    return ops
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--drivers", type=int, default=20)
+    parser.add_argument("--cycles", type=int, default=30, help="trips per shift")
+    parser.add_argument("--export-every", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--telegram-latency", type=float, nargs=2, default=[0.02, 0.08])
+    parser.add_argument("--geocoder-latency", type=float, nargs=2, default=[0.1, 0.4])
+    parser.add_argument(
+        "--offline-geocoder",
+        action="store_true",
+        help="resolve against the bundled address points before the stubs",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        parser.error("FIRESTORE_EMULATOR_HOST is not set, start the emulator first")
+
+    telegram, telegram_stub = start_stub(TelegramStub, tuple(args.telegram_latency))
+    geocoder, geocoder_stub = start_stub(GeocoderStub, tuple(args.geocoder_latency))
+
+    # Fresh user IDs per run so that runs against the same emulator do not mix
+    run_id = int(time.time()) % 100000
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-ar-baak")
+    os.environ.update(
+        {
+            "BOT_TOKEN": "0:benchmark",
+            "CLOUD_LOGGING": "0",
+            "WEBHOOK_MODE": "sync",
+            # Sends are made within the updates, so that their latency is measured
+            "SEND_MODE": "direct",
+            "TELEGRAM_API_URL": f"{server_url(telegram)}/bot{{0}}/{{1}}",
+            "OSM_URL": f"{server_url(geocoder)}/reverse",
+            "HK_GEODATA_URL": f"{server_url(geocoder)}/gs/api/v1.0.0/identify",
+        }
+    )
+    if not args.offline_geocoder:
+        os.environ["HK_ADDRESS_POINTS_PATH"] = ""
+    sys.path.insert(0, BOT_DIR)
+    import flask  # pylint: disable=import-outside-toplevel
+    import main as bot_main  # pylint: disable=import-outside-toplevel
+
+    rng = random.Random(args.seed)
+    sessions = [
+        Session(run_id * 1000 + i, random.Random(rng.random()))
+        for i in range(args.drivers)
+    ]
+    latencies: Dict[str, List[float]] = {}
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def replay(session: Session) -> None:
+        for kind, update in session.updates(args.cycles, args.export_every):
+            start = time.perf_counter()
+            try:
+                with bot_main.app.test_request_context(method="POST", json=update):
+                    _, status = bot_main.handle_telegram_update(flask.request)
+                if status != 200:
+                    raise RuntimeError(f"status {status}")
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                with lock:
+                    errors.append(f"{kind}: {err!r}")
+                continue
+            with lock:
+                latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(replay, sessions))
+    elapsed = time.perf_counter() - start
+    telegram.shutdown()
+    geocoder.shutdown()
+
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "updates": len(all_latencies),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "elapsed_seconds": elapsed,
+        "updates_per_second": len(all_latencies) / elapsed,
+        "latency": summarise(all_latencies) if all_latencies else None,
+        "latency_by_kind": {
+            kind: summarise(values) for kind, values in sorted(latencies.items())
+        },
+        "firestore_ops": firestore_ops(
+            bot_main.tracer.stats(), bot_main.write_stats.stats()
+        ),
+        "telegram_requests": telegram_stub.requests,
+        "geocoder_requests": geocoder_stub.requests,
+    }
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
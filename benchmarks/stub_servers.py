@@ -0,0 +1,165 @@
+"""Local stand-ins for the Telegram Bot API and the reverse geocoding services."""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple, Type
+from urllib.parse import parse_qs, urlparse
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every request with a JSON body after a configurable latency."""
+
+    # Seconds, each response is delayed by a uniform draw from this range
+    latency: Tuple[float, float] = (0.0, 0.0)
+    requests = 0
+    body = b""
+    lock = threading.Lock()
+
+    def respond(self) -> Dict[str, Any]:
+        """Builds the JSON response for the request."""
+        raise NotImplementedError
+
+    def handle_request(self) -> None:
+        """Waits out the latency and writes the JSON response."""
+        self.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            type(self).requests += 1
+        time.sleep(random.uniform(*self.latency))
+        body = json.dumps(self.respond(), ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        self.handle_request()
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        self.handle_request()
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+class TelegramStub(StubHandler):
+    """Answers every Telegram Bot API call as if a message was sent."""
+
+    def respond(self) -> Dict[str, Any]:
+        return {
+            "ok": True,
+            "result": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": 1, "type": "private"},
+            },
+        }
+
+
+class BotAPIStub(TelegramStub):
+    """A fake Bot API serving queued updates to getUpdates with long polling.
+
+    Updates are confirmed, and dropped, once getUpdates is called with a later
+    offset. Every other method is answered as a sent message, and recorded with
+    its query parameters and body.
+    """
+
+    updates: List[Dict[str, Any]] = []
+    calls: List[Tuple[str, Dict[str, str], bytes]] = []
+    sent = 0
+    condition = threading.Condition()
+
+    @classmethod
+    def add_updates(cls, updates: List[Dict[str, Any]]) -> None:
+        """Queues updates for the bot to poll."""
+        with cls.condition:
+            cls.updates.extend(updates)
+            cls.condition.notify_all()
+
+    @classmethod
+    def calls_to(cls, method: str) -> List[Tuple[Dict[str, str], bytes]]:
+        """Gets the parameters and bodies of the calls made to a method so far."""
+        with cls.condition:
+            return [
+                (params, body) for name, params, body in cls.calls if name == method
+            ]
+
+    @classmethod
+    def unconfirmed(cls) -> int:
+        """Counts the updates not confirmed by the bot yet."""
+        with cls.condition:
+            return len(cls.updates)
+
+    def respond(self) -> Dict[str, Any]:
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        with self.condition:
+            type(self).calls.append((url.path.rsplit("/", 1)[-1], params, self.body))
+        return super().respond()
+
+    def handle_request(self) -> None:
+        if not self.path.endswith("/getUpdates"):
+            with self.lock:
+                type(self).sent += 1
+            super().handle_request()
+            return
+        params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        offset = params.get("offset", 0)
+        deadline = time.monotonic() + params.get("timeout", 0)
+        stub = type(self)
+        with stub.condition:
+            stub.updates[:] = [u for u in stub.updates if u["update_id"] >= offset]
+            while not stub.updates and time.monotonic() < deadline:
+                stub.condition.wait(deadline - time.monotonic())
+            result = stub.updates[: params.get("limit", 100)]
+        body = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GeocoderStub(StubHandler):
+    """Answers OSM Nominatim reverse and HK GeoData identify requests."""
+
+    def respond(self) -> Dict[str, Any]:
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path.endswith("/identify"):
+            easting = float(params.get("x", [0])[0])
+            return {
+                "results": [
+                    {
+                        "type": "ADDRESS",
+                        "addressInfo": [{"caddress": f"彌敦道 {int(easting) % 999}號"}],
+                    }
+                ]
+            }
+        lat = float(params.get("lat", [0])[0])
+        return {
+            "address": {"road": "彌敦道", "house_number": str(int(lat * 1e4) % 999)}
+        }
+
+
+def start_stub(
+    handler: Type[StubHandler], latency: Tuple[float, float]
+) -> Tuple[ThreadingHTTPServer, Type[StubHandler]]:
+    """Serves the stub on a free local port in a background thread."""
+    configured = type(
+        handler.__name__,
+        (handler,),
+        {"latency": latency, "requests": 0, "updates": [], "calls": [], "sent": 0},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), configured)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, configured
+
+
+def server_url(server: ThreadingHTTPServer) -> str:
+    """Gets the base URL of a stub server."""
+    return f"http://127.0.0.1:{server.server_port}"
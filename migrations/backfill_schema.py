@@ -0,0 +1,139 @@
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore import Client
+from google.oauth2 import service_account
+import argparse
+import os
+import sys
+import time
+from typing import List, Optional
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "telegram-bot"))
+
+from models import (  # noqa: E402 pylint: disable=wrong-import-position
+    SHIFT_COLLECTION_NAME,
+    TRIP_COLLECTION_NAME,
+    USER_COLLECTION_NAME,
+)
+from schema_migrations import (  # noqa: E402 pylint: disable=wrong-import-position
+    SHIFT_UPGRADES,
+    TRIP_UPGRADES,
+    USER_UPGRADES,
+    Upgrade,
+    upgrade_document,
+)
+
+load_dotenv()
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
+
+google_auth_creds = service_account.Credentials.from_service_account_file(
+    "credentials.json"
+)
+
+# taxi_db = Client(
+#     project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-dev"
+# )
+taxi_db = Client(
+    project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-prod"
+)
+
+UPGRADES = {
+    USER_COLLECTION_NAME: USER_UPGRADES,
+    SHIFT_COLLECTION_NAME: SHIFT_UPGRADES,
+    TRIP_COLLECTION_NAME: TRIP_UPGRADES,
+}
+
+MAX_WRITES_PER_BATCH = 500
+
+
+def backfill_collection(
+    db: Client,
+    collection_name: str,
+    upgrades: List[Upgrade],
+    max_writes_per_second: float = 50,
+    start_after: Optional[str] = None,
+) -> None:
+    """Upgrades the documents of a collection not yet upgraded on read, throttled.
+
+    Each write only applies if the document is unchanged since it was read, a
+    document modified by the bot in the meantime is left to its on-read upgrade.
+    """
+    collection_ref = db.collection(collection_name)
+    upgraded = skipped = 0
+    cursor = collection_ref.document(start_after).get() if start_after else None
+    while True:
+        query = collection_ref.order_by("__name__").limit(MAX_WRITES_PER_BATCH)
+        if cursor is not None:
+            query = query.start_after(cursor)
+        docs = list(query.stream())
+        if not docs:
+            break
+        cursor = docs[-1]
+
+        writes = []
+        for doc in docs:
+            _, changes = upgrade_document(upgrades, doc.to_dict())
+            if changes:
+                writes.append((doc, changes))
+        if not writes:
+            continue
+
+        started = time.monotonic()
+        batch = db.batch()
+        for doc, changes in writes:
+            batch.update(
+                doc.reference,
+                changes,
+                option=db.write_option(last_update_time=doc.update_time),
+            )
+        try:
+            batch.commit()
+            upgraded += len(writes)
+        except FailedPrecondition:
+            # A document of the batch changed, retry them one by one
+            for doc, changes in writes:
+                try:
+                    doc.reference.update(
+                        changes,
+                        option=db.write_option(last_update_time=doc.update_time),
+                    )
+                    upgraded += 1
+                except FailedPrecondition:
+                    skipped += 1
+        print(
+            f"Upgraded {upgraded} documents of {collection_name}, skipped {skipped}, "
+            f"up to {cursor.id}."
+        )
+
+        # Spreads the writes out to keep clear of hotspotting and write spikes
+        time.sleep(
+            max(0.0, len(writes) / max_writes_per_second - (time.monotonic() - started))
+        )
+    print(f"Backfilled {collection_name}: {upgraded} upgraded, {skipped} skipped.")
+
+
+def main() -> None:
+
+    # Documents are upgraded when the bot next modifies them, this upgrades the
+    # long tail that is rarely modified. Interrupted runs resume with --start-after:
+    #   python migrations/backfill_schema.py trips --max-writes-per-second 50
+    parser = argparse.ArgumentParser(
+        description="Upgrades documents to the latest schema version."
+    )
+    parser.add_argument("collections", nargs="*", default=list(UPGRADES))
+    parser.add_argument("--max-writes-per-second", type=float, default=50)
+    parser.add_argument("--start-after", default=None)
+    args = parser.parse_args()
+
+    for collection_name in args.collections:
+        backfill_collection(
+            taxi_db,
+            collection_name,
+            UPGRADES[collection_name],
+            max_writes_per_second=args.max_writes_per_second,
+            start_after=args.start_after,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+from google.cloud.firestore import Client
+from google.cloud.firestore_v1.base_query import QueryPartition
+from google.oauth2 import service_account
+import argparse
+import glob
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import types
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "telegram-bot"))
+
+from models import (  # noqa: E402 pylint: disable=wrong-import-position
+    SHIFT_COLLECTION_NAME,
+    TRIP_COLLECTION_NAME,
+    FirestoreModel,
+    Shift,
+    Trip,
+)
+from trip_export import HK_TZ  # noqa: E402 pylint: disable=wrong-import-position
+
+load_dotenv()
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
+
+google_auth_creds = service_account.Credentials.from_service_account_file(
+    "credentials.json"
+)
+
+# taxi_db = Client(
+#     project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-dev"
+# )
+taxi_db = Client(
+    project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-prod"
+)
+
+# Exported collections, with the model describing their documents and the field
+# the document ID is written to
+COLLECTIONS = {
+    TRIP_COLLECTION_NAME: (Trip, "trip_id"),
+    SHIFT_COLLECTION_NAME: (Shift, "shift_id"),
+}
+
+MANIFEST_FILE_NAME = "_manifest.json"
+
+# Hive's partition name for rows without a start time
+UNKNOWN_DATE = "__HIVE_DEFAULT_PARTITION__"
+
+ARROW_TYPES = {
+    str: pa.string(),
+    int: pa.int64(),
+    float: pa.float64(),
+    bool: pa.bool_(),
+    datetime: pa.timestamp("us", tz="UTC"),
+}
+
+
+def arrow_schema(model: typing.Type[FirestoreModel]) -> pa.Schema:
+    """Gets the Arrow schema of the scalar fields of a model."""
+    fields = []
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        # Unwrap Optional[X]
+        args = [arg for arg in typing.get_args(annotation) if arg is not types.NoneType]
+        if len(args) == 1:
+            annotation = args[0]
+        if annotation in ARROW_TYPES:
+            fields.append(pa.field(name, ARROW_TYPES[annotation]))
+    return pa.schema(fields)
+
+
+def peak_rss_mb() -> float:
+    """Gets the peak resident set size of this process in MiB."""
+    # Reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+class Manifest:
+    """Partition cursors and completed partitions of an export, for resuming it."""
+
+    def __init__(self, output_dir: str) -> None:
+        self.path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+        self._lock = threading.Lock()
+        self.data: Dict[str, Any] = {"collections": {}}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as file:
+                self.data = json.load(file)
+
+    def partitions(self, collection: str) -> Optional[List[Dict[str, Any]]]:
+        """Gets the recorded partitions of a collection."""
+        return self.data["collections"].get(collection)
+
+    def set_partitions(
+        self, collection: str, bounds: List[Tuple[Optional[str], Optional[str]]]
+    ) -> None:
+        """Records the partitions of a collection as (start, end) document paths."""
+        with self._lock:
+            self.data["collections"][collection] = [
+                {"start": start, "end": end, "done": False, "docs": 0}
+                for start, end in bounds
+            ]
+            self._save()
+
+    def mark_done(self, collection: str, index: int, docs: int) -> None:
+        """Records a partition as fully written."""
+        with self._lock:
+            partition = self.data["collections"][collection][index]
+            partition["done"] = True
+            partition["docs"] = docs
+            self._save()
+
+    def _save(self) -> None:
+        # Replaced atomically, so an interrupted save never loses the manifest
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.data, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+class PartitionWriter:
+    """Writes the documents of one partition to date-partitioned Parquet files.
+
+    Rows are buffered per Hong Kong date of their start time and written as a row
+    group once a date has row_group_size rows, or once the partition buffers
+    max_buffered_rows rows in total, so memory stays bounded however the dates of
+    the documents are spread. At most max_open_files files are kept open, a date
+    whose file was closed continues in a new file.
+    """
+
+    def __init__(
+        self,
+        collection_dir: str,
+        partition: int,
+        schema: pa.Schema,
+        *,
+        row_group_size: int = 10000,
+        max_buffered_rows: int = 50000,
+        max_open_files: int = 16,
+    ) -> None:
+        self.collection_dir = collection_dir
+        self.partition = partition
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self.max_open_files = max_open_files
+        self._buffers: Dict[str, List[Dict[str, Any]]] = {}
+        self._buffered_rows = 0
+        self._writers: OrderedDict[str, pq.ParquetWriter] = OrderedDict()
+        self._file_counts: Dict[str, int] = {}
+
+    def write(self, row: Dict[str, Any]) -> None:
+        """Buffers a row, writing out row groups as buffers fill up."""
+        start_time = row.get("start_time")
+        date = (
+            f"{start_time.astimezone(HK_TZ):%Y-%m-%d}" if start_time else UNKNOWN_DATE
+        )
+        buffer = self._buffers.setdefault(date, [])
+        buffer.append(row)
+        self._buffered_rows += 1
+        if len(buffer) >= self.row_group_size:
+            self._flush(date)
+        while self._buffered_rows >= self.max_buffered_rows:
+            self._flush(max(self._buffers, key=lambda key: len(self._buffers[key])))
+
+    def close(self) -> None:
+        """Writes out the remaining rows and closes all files."""
+        for date in list(self._buffers):
+            self._flush(date)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+    def _flush(self, date: str) -> None:
+        rows = self._buffers.pop(date, [])
+        if not rows:
+            return
+        self._buffered_rows -= len(rows)
+        self._writer(date).write_batch(
+            pa.RecordBatch.from_pylist(rows, schema=self.schema)
+        )
+
+    def _writer(self, date: str) -> pq.ParquetWriter:
+        writer = self._writers.get(date)
+        if writer is not None:
+            self._writers.move_to_end(date)
+            return writer
+
+        while len(self._writers) >= self.max_open_files:
+            _, oldest = self._writers.popitem(last=False)
+            oldest.close()
+        file_number = self._file_counts.get(date, 0)
+        self._file_counts[date] = file_number + 1
+        date_dir = os.path.join(self.collection_dir, f"date={date}")
+        os.makedirs(date_dir, exist_ok=True)
+        writer = pq.ParquetWriter(
+            os.path.join(
+                date_dir, f"part-{self.partition:05d}-{file_number:04d}.parquet"
+            ),
+            self.schema,
+            compression="zstd",
+        )
+        self._writers[date] = writer
+        return writer
+
+
+def document_rows(docs: Iterable[Any], id_field: str) -> Iterable[Dict[str, Any]]:
+    """Converts document snapshots to rows, with the document ID in id_field."""
+    for doc in docs:
+        row = doc.to_dict() or {}
+        row[id_field] = doc.id
+        yield row
+
+
+def remove_partition_files(collection_dir: str, partition: int) -> None:
+    """Removes the files of a partition left behind by an interrupted export."""
+    for path in glob.glob(
+        os.path.join(collection_dir, "date=*", f"part-{partition:05d}-*.parquet")
+    ):
+        os.remove(path)
+
+
+def export_collection(
+    db: Client,
+    collection: str,
+    output_dir: str,
+    manifest: Manifest,
+    partition_count: int = 16,
+    workers: int = 8,
+    **writer_options: int,
+) -> Dict[str, Any]:
+    """Exports a collection to Parquet, reading its partitions in parallel.
+
+    Partitions already written by a previous run recorded in the manifest are
+    skipped, the files of unfinished partitions are rewritten. writer_options are
+    passed on to PartitionWriter.
+    """
+    model, id_field = COLLECTIONS[collection]
+    schema = arrow_schema(model)
+    collection_dir = os.path.join(output_dir, collection)
+    group = db.collection_group(collection)
+
+    partitions = manifest.partitions(collection)
+    if partitions is None:
+        # Partition cursors are recorded, so a resumed export splits the
+        # collection the same way
+        bounds = [
+            (
+                partition.start_at.path if partition.start_at else None,
+                partition.end_at.path if partition.end_at else None,
+            )
+            for partition in group.get_partitions(partition_count)
+        ]
+        manifest.set_partitions(collection, bounds)
+        partitions = manifest.partitions(collection)
+
+    pending = [
+        index for index, partition in enumerate(partitions) if not partition["done"]
+    ]
+    print(
+        f"Exporting {collection}: {len(pending)} of {len(partitions)} partitions pending."
+    )
+
+    def export_partition(index: int) -> int:
+        partition = partitions[index]
+        query = QueryPartition(
+            group,
+            db.document(partition["start"]) if partition["start"] else None,
+            db.document(partition["end"]) if partition["end"] else None,
+        ).query()
+
+        remove_partition_files(collection_dir, index)
+        writer = PartitionWriter(collection_dir, index, schema, **writer_options)
+        docs = 0
+        try:
+            for row in document_rows(query.stream(), id_field):
+                writer.write(row)
+                docs += 1
+        finally:
+            writer.close()
+        manifest.mark_done(collection, index, docs)
+        print(f"Partition {index} of {collection} exported, {docs} documents.")
+        return docs
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        docs = sum(executor.map(export_partition, pending))
+    seconds = time.perf_counter() - start
+    return {
+        "partitions": len(partitions),
+        "exported_partitions": len(pending),
+        "docs": docs,
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(docs / seconds, 1) if seconds else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def main() -> None:
+
+    # Exports to <output>/<collection>/date=YYYY-MM-DD/part-*.parquet, re-run with
+    # the same output directory to resume an interrupted export:
+    #   python migrations/export_parquet.py --output exports/2024-06-01
+    parser = argparse.ArgumentParser(
+        description="Exports trips and shifts to date-partitioned Parquet files."
+    )
+    parser.add_argument("--output", default="exports")
+    parser.add_argument(
+        "--collections", nargs="+", choices=list(COLLECTIONS), default=list(COLLECTIONS)
+    )
+    parser.add_argument("--partitions", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--row-group-size", type=int, default=10000)
+    parser.add_argument("--max-buffered-rows", type=int, default=50000)
+    parser.add_argument("--max-open-files", type=int, default=16)
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.output)
+    results = {}
+    for collection in args.collections:
+        results[collection] = export_collection(
+            taxi_db,
+            collection,
+            args.output,
+            manifest,
+            partition_count=args.partitions,
+            workers=args.workers,
+            row_group_size=args.row_group_size,
+            max_buffered_rows=args.max_buffered_rows,
+            max_open_files=args.max_open_files,
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
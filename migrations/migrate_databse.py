@@ -1,52 +1,334 @@
 from google.cloud.firestore import Client
-from google.cloud.firestore_v1 import CollectionReference
+from google.cloud.firestore_v1.base_query import BaseQuery, QueryPartition
+from google.cloud.firestore_v1.bulk_writer import BulkWriteFailure, BulkWriterOptions
 from google.oauth2 import service_account
+import argparse
+import hashlib
+import json
 import os
-from typing import Any, Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
 GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 
-google_auth_creds = service_account.Credentials.from_service_account_file(
-    "credentials.json"
-)
+# Documents read, written and checkpointed at a time per partition
+PAGE_SIZE = 500
 
-default_db = Client(credentials=google_auth_creds)
-prod_db = Client(
-    project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-prod"
-)
+# BulkWriter attempts per write before the copy is stopped
+MAX_WRITE_ATTEMPTS = 10
 
+CHECKSUM_MODULUS = 2**64
 
-def migrate_collection(
+
+def get_client(database: Optional[str] = None) -> Client:
+    """Gets a client of a database, of the emulator if FIRESTORE_EMULATOR_HOST is set."""
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        return Client(project=GCP_PROJECT_ID or "demo-taxi", database=database)
+    google_auth_creds = service_account.Credentials.from_service_account_file(
+        "credentials.json"
+    )
+    if database is None:
+        return Client(credentials=google_auth_creds)
+    return Client(
+        project=GCP_PROJECT_ID, credentials=google_auth_creds, database=database
+    )
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, "path"):
+        return value.path
+    return str(value)
+
+
+def document_checksum(doc_id: str, data: Dict[str, Any]) -> int:
+    """Gets a checksum of a document that does not depend on its collection."""
+    payload = json.dumps([doc_id, data], sort_keys=True, default=_canonical)
+    return int.from_bytes(hashlib.sha256(payload.encode()).digest()[:8], "big")
+
+
+class Checkpoint:
+    """Partition bounds and copy progress of a collection, for resuming a copy."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.partitions: Optional[List[Dict[str, Any]]] = None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                self.partitions = json.load(file)["partitions"]
+
+    def set_partitions(self, bounds: List[Tuple[Optional[str], Optional[str]]]) -> None:
+        """Records the partitions as (start, end) document IDs."""
+        with self._lock:
+            self.partitions = [
+                {"start": start, "end": end, "after": None, "docs": 0, "done": False}
+                for start, end in bounds
+            ]
+            self._save()
+
+    def advance(self, index: int, after: str, docs: int) -> None:
+        """Records the documents of a partition up to and including after as copied."""
+        with self._lock:
+            partition = self.partitions[index]
+            partition["after"] = after
+            partition["docs"] += docs
+            self._save()
+
+    def mark_done(self, index: int) -> None:
+        """Records a partition as fully copied."""
+        with self._lock:
+            self.partitions[index]["done"] = True
+            self._save()
+
+    def _save(self) -> None:
+        # Replaced atomically, so an interrupted save never loses the checkpoint
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({"partitions": self.partitions}, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+def partition_query(
+    db: Client, collection: str, start: Optional[str], end: Optional[str]
+) -> BaseQuery:
+    """Gets the query of the documents of a collection between two document IDs."""
+    return QueryPartition(
+        db.collection_group(collection),
+        db.collection(collection).document(start) if start else None,
+        db.collection(collection).document(end) if end else None,
+    ).query()
+
+
+def iter_pages(db: Client, collection: str, query: BaseQuery, after: Optional[str]):
+    """Streams the top-level documents of a partition query one page at a time."""
+    while True:
+        page_query = query
+        if after:
+            page_query = page_query.start_after(
+                [db.collection(collection).document(after)]
+            )
+        docs = list(page_query.limit(PAGE_SIZE).stream())
+        if not docs:
+            return
+        after = docs[-1].id
+        # Collection group queries also match subcollections of the same name
+        yield [doc for doc in docs if doc.reference.parent.parent is None], after
+        if len(docs) < PAGE_SIZE:
+            return
+
+
+def migrate_collection(  # pylint: disable=too-many-arguments
     source_db: Client,
     target_db: Client,
     source_collection: str,
     target_collection: str,
-) -> None:
-    """Migrates documents from one collection to another."""
-    source_ref: CollectionReference = source_db.collection(source_collection)
-    target_ref: CollectionReference = target_db.collection(target_collection)
-
-    docs = source_ref.stream()
-
-    for doc in docs:
-        data: Dict[str, Any] = doc.to_dict()
-        target_ref.document(doc.id).set(data)
-        print(
-            f"Document {doc.id} migrated from {source_collection} to {target_collection}"
+    *,
+    checkpoint_path: Optional[str] = None,
+    partition_count: int = 16,
+    workers: int = 8,
+    max_ops_per_second: int = 500,
+) -> Dict[str, Any]:
+    """Copies documents from one collection to another, resuming from a checkpoint.
+
+    The source collection is split with partition queries that are copied in
+    parallel, each through its own BulkWriter with a share of the write rate. A
+    page of documents is read only once the previous page is committed, and the
+    last committed document of each partition is checkpointed.
+    """
+    checkpoint = Checkpoint(
+        checkpoint_path or f"migrate-{source_collection}-{target_collection}.json"
+    )
+    if checkpoint.partitions is None:
+        checkpoint.set_partitions(
+            [
+                (
+                    partition.start_at.id if partition.start_at else None,
+                    partition.end_at.id if partition.end_at else None,
+                )
+                for partition in source_db.collection_group(
+                    source_collection
+                ).get_partitions(partition_count)
+            ]
         )
+    pending = [
+        index
+        for index, partition in enumerate(checkpoint.partitions)
+        if not partition["done"]
+    ]
+    print(
+        f"Copying {source_collection} to {target_collection}: "
+        f"{len(pending)} of {len(checkpoint.partitions)} partitions pending."
+    )
+    target_ref = target_db.collection(target_collection)
+    ops_per_writer = max(1, max_ops_per_second // min(workers, len(pending) or 1))
+
+    def copy_partition(index: int) -> int:
+        partition = checkpoint.partitions[index]
+        failures: List[BulkWriteFailure] = []
+
+        def on_write_error(failure: BulkWriteFailure, _) -> bool:
+            if failure.attempts < MAX_WRITE_ATTEMPTS:
+                return True
+            failures.append(failure)
+            return False
+
+        writer = target_db.bulk_writer(
+            BulkWriterOptions(
+                initial_ops_per_second=ops_per_writer,
+                max_ops_per_second=ops_per_writer,
+            )
+        )
+        writer.on_write_error(on_write_error)
+        query = partition_query(
+            source_db, source_collection, partition["start"], partition["end"]
+        )
+        copied = 0
+        try:
+            for docs, after in iter_pages(
+                source_db, source_collection, query, partition["after"]
+            ):
+                for doc in docs:
+                    writer.set(target_ref.document(doc.id), doc.to_dict())
+                writer.flush()
+                if failures:
+                    raise RuntimeError(
+                        f"Partition {index} of {source_collection} failed to write "
+                        f"{len(failures)} documents: {failures[0].message}"
+                    )
+                checkpoint.advance(index, after, len(docs))
+                copied += len(docs)
+        finally:
+            writer.close()
+        checkpoint.mark_done(index)
+        print(f"Partition {index} of {source_collection} copied, {copied} documents.")
+        return copied
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        copied = sum(executor.map(copy_partition, pending))
+    seconds = time.perf_counter() - start
+    return {
+        "partitions": len(checkpoint.partitions),
+        "copied_partitions": len(pending),
+        "docs": copied,
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(copied / seconds, 1) if seconds else 0.0,
+    }
+
+
+def verify_collection(
+    source_db: Client,
+    target_db: Client,
+    source_collection: str,
+    target_collection: str,
+    *,
+    checkpoint_path: Optional[str] = None,
+    workers: int = 8,
+) -> Dict[str, Any]:
+    """Compares the document counts and checksums of the copied partitions."""
+    checkpoint = Checkpoint(
+        checkpoint_path or f"migrate-{source_collection}-{target_collection}.json"
+    )
+    partitions = checkpoint.partitions or [{"start": None, "end": None}]
+
+    def summarise(db: Client, collection: str, index: int) -> Tuple[int, int]:
+        partition = partitions[index]
+        query = partition_query(db, collection, partition["start"], partition["end"])
+        count, checksum = 0, 0
+        for docs, _ in iter_pages(db, collection, query, None):
+            for doc in docs:
+                count += 1
+                checksum += document_checksum(doc.id, doc.to_dict())
+        return count, checksum % CHECKSUM_MODULUS
+
+    def verify_partition(index: int) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+        return (
+            summarise(source_db, source_collection, index),
+            summarise(target_db, target_collection, index),
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(verify_partition, range(len(partitions))))
+    mismatched = [
+        index for index, (source, target) in enumerate(results) if source != target
+    ]
+    summary = {
+        "source_docs": sum(source[0] for source, _ in results),
+        "target_docs": sum(target[0] for _, target in results),
+        "source_checksum": sum(source[1] for source, _ in results) % CHECKSUM_MODULUS,
+        "target_checksum": sum(target[1] for _, target in results) % CHECKSUM_MODULUS,
+        "mismatched_partitions": mismatched,
+        "ok": not mismatched,
+    }
+    print(
+        f"Verified {target_collection} against {source_collection}: "
+        f"{'OK' if summary['ok'] else f'partitions {mismatched} differ'}."
+    )
+    return summary
 
 
 def main() -> None:
-    # Migrate taxi-users to users in the taxi-prod database
-    migrate_collection(default_db, prod_db, "taxi-users", "users")
 
-    # Migrate taxi-trips to trips in the taxi-prod database
-    migrate_collection(default_db, prod_db, "taxi-trips", "trips")
+    # Re-run with the same checkpoint directory to resume an interrupted copy. To
+    # try it between two emulator databases:
+    #   FIRESTORE_EMULATOR_HOST=127.0.0.1:8089 python migrations/migrate_databse.py \
+    #       --source-database source --target-database target
+    parser = argparse.ArgumentParser(
+        description="Copies the taxi collections between databases."
+    )
+    parser.add_argument("--source-database", default=None)
+    parser.add_argument("--target-database", default="taxi-prod")
+    parser.add_argument(
+        "--collections",
+        nargs="+",
+        default=["taxi-users:users", "taxi-trips:trips", "taxi-shifts:shifts"],
+        help="source:target collection pairs",
+    )
+    parser.add_argument("--checkpoint-dir", default="migration-checkpoints")
+    parser.add_argument("--partitions", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-ops-per-second", type=int, default=500)
+    parser.add_argument("--verify-only", action="store_true")
+    args = parser.parse_args()
 
-    # Migrate taxi-shifts to shifts in the taxi-prod database
-    migrate_collection(default_db, prod_db, "taxi-shifts", "shifts")
+    source_db = get_client(args.source_database)
+    target_db = get_client(args.target_database)
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    results = {}
+    for pair in args.collections:
+        source_collection, target_collection = pair.split(":")
+        checkpoint_path = os.path.join(
+            args.checkpoint_dir, f"{source_collection}-{target_collection}.json"
+        )
+        result = {}
+        if not args.verify_only:
+            result["copy"] = migrate_collection(
+                source_db,
+                target_db,
+                source_collection,
+                target_collection,
+                checkpoint_path=checkpoint_path,
+                partition_count=args.partitions,
+                workers=args.workers,
+                max_ops_per_second=args.max_ops_per_second,
+            )
+        result["verify"] = verify_collection(
+            source_db,
+            target_db,
+            source_collection,
+            target_collection,
+            checkpoint_path=checkpoint_path,
+            workers=args.workers,
+        )
+        results[pair] = result
+    print(json.dumps(results, indent=2))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+from google.cloud.firestore import DELETE_FIELD, Client
+from google.cloud.firestore_v1 import CollectionReference
+from google.oauth2 import service_account
+import os
+from typing import Any, Dict
+from dotenv import load_dotenv
+
+load_dotenv()
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
+
+google_auth_creds = service_account.Credentials.from_service_account_file(
+    "credentials.json"
+)
+
+# taxi_db = Client(
+#     project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-dev"
+# )
+taxi_db = Client(
+    project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-prod"
+)
+
+# A batch holds at most 500 writes, one is needed for the user document
+MAX_EXPORTS_PER_BATCH = 499
+
+
+def migrate_export_history_to_cursor(db: Client, collection_name: str) -> None:
+    """Moves 'export_history' of all users into an export cursor and an exports subcollection."""
+    collection_ref: CollectionReference = db.collection(collection_name)
+
+    # Stream all documents in the collection
+    docs = collection_ref.stream()
+
+    for doc in docs:
+        data: Dict[str, Any] = doc.to_dict()
+        if "export_history" not in data:
+            print(f"Document {doc.id} has no 'export_history' field.")
+            continue
+
+        export_history = sorted(data["export_history"] or [])
+        if not export_history:
+            collection_ref.document(doc.id).update({"export_history": DELETE_FIELD})
+            print(f"Empty 'export_history' removed from document {doc.id}")
+            continue
+
+        exports_ref = collection_ref.document(doc.id).collection("exports")
+        for start in range(0, len(export_history), MAX_EXPORTS_PER_BATCH):
+            batch = db.batch()
+            chunk = export_history[start : start + MAX_EXPORTS_PER_BATCH]
+            for index, export_time in enumerate(chunk, start):
+                # Deterministic IDs, so a re-run after an interruption overwrites
+                # the exports already moved rather than duplicating them
+                batch.set(
+                    exports_ref.document(f"{doc.id}_{index}"),
+                    {
+                        "user_id": doc.id,
+                        "export_time": export_time,
+                        # Not recorded by the old export history
+                        "trip_count": 0,
+                        "skip_exported": False,
+                        "last_exported_end_time": export_time,
+                    },
+                )
+            if start + MAX_EXPORTS_PER_BATCH >= len(export_history):
+                # Previously trips ending after the last export were not exported yet
+                batch.update(
+                    collection_ref.document(doc.id),
+                    {
+                        "last_export_time": export_history[-1],
+                        "last_exported_end_time": export_history[-1],
+                        "export_history": DELETE_FIELD,
+                    },
+                )
+            batch.commit()
+        print(
+            f"Moved {len(export_history)} exports of document {doc.id} to its export cursor."
+        )
+
+
+def main() -> None:
+
+    # Replace 'export_history' of all users in the taxi-prod database with an export cursor
+    migrate_export_history_to_cursor(taxi_db, "users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+from google.cloud.firestore import Client
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.oauth2 import service_account
+import os
+import sys
+from typing import Any, Dict, List
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "telegram-bot"))
+
+from rollups import (  # noqa: E402 pylint: disable=wrong-import-position
+    PERIODS,
+    ROLLUP_COLLECTION_NAME,
+    period_id,
+    rollup_fields,
+    shift_amounts,
+    trip_amounts,
+)
+
+load_dotenv()
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
+
+google_auth_creds = service_account.Credentials.from_service_account_file(
+    "credentials.json"
+)
+
+# taxi_db = Client(
+#     project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-dev"
+# )
+taxi_db = Client(
+    project=GCP_PROJECT_ID, credentials=google_auth_creds, database="taxi-prod"
+)
+
+MAX_WRITES_PER_BATCH = 500
+
+
+def add_amounts(target: Dict[str, Any], amounts: Dict[str, Any]) -> None:
+    """Adds possibly nested amounts into a rollup document."""
+    for field, amount in amounts.items():
+        if isinstance(amount, dict):
+            add_amounts(target.setdefault(field, {}), amount)
+        else:
+            target[field] = target.get(field, 0) + amount
+
+
+def compute_rollups(db: Client, user_id: str) -> Dict[str, Dict[str, Any]]:
+    """Computes the daily and monthly rollups of a user from their trips and shifts."""
+    rollups: Dict[str, Dict[str, Any]] = {}
+
+    def add(period: str, when, amounts: Dict[str, Any]) -> None:
+        rollup = rollups.setdefault(
+            period_id(period, when),
+            {
+                **rollup_fields(period, when, user_id),
+                "total_trips": 0,
+                "total_fare": 0.0,
+                "hour_trips": {},
+                "total_shifts": 0,
+                "shift_seconds": 0.0,
+            },
+        )
+        add_amounts(rollup, amounts)
+
+    trips = (
+        db.collection("trips")
+        .where(filter=FieldFilter("user_id", "==", user_id))
+        .select(["start_time", "fare"])
+        .stream()
+    )
+    for trip in trips:
+        data = trip.to_dict()
+        if not data.get("start_time") or not data.get("fare") or data["fare"] <= 0:
+            continue
+        for period in PERIODS:
+            add(
+                period,
+                data["start_time"],
+                trip_amounts(data["start_time"], data["fare"]),
+            )
+
+    shifts = (
+        db.collection("shifts")
+        .where(filter=FieldFilter("user_id", "==", user_id))
+        .select(["start_time", "end_time"])
+        .stream()
+    )
+    for shift in shifts:
+        data = shift.to_dict()
+        if not data.get("start_time") or not data.get("end_time"):
+            continue
+        for period, when, amounts in shift_amounts(
+            data["start_time"], data["end_time"]
+        ):
+            add(period, when, amounts)
+
+    return rollups
+
+
+def rebuild_user_rollups(db: Client, user_id: str) -> None:
+    """Replaces the rollups of a user with ones recomputed from raw trips and shifts."""
+    rollups = compute_rollups(db, user_id)
+    rollups_ref = db.collection(f"users/{user_id}/{ROLLUP_COLLECTION_NAME}")
+
+    writes: List[tuple] = [
+        ("set", rollups_ref.document(doc_id), data) for doc_id, data in rollups.items()
+    ]
+    writes += [
+        ("delete", doc.reference, None)
+        for doc in rollups_ref.stream()
+        if doc.id not in rollups
+    ]
+
+    for start in range(0, len(writes), MAX_WRITES_PER_BATCH):
+        batch = db.batch()
+        for operation, ref, data in writes[start : start + MAX_WRITES_PER_BATCH]:
+            if operation == "set":
+                batch.set(ref, data)
+            else:
+                batch.delete(ref)
+        batch.commit()
+    print(f"Rebuilt {len(rollups)} rollups of user {user_id}.")
+
+
+def main() -> None:
+
+    # Rollups updated by the bot while a user is rebuilt are overwritten, so run
+    # this when drivers are off shift or re-run it for the affected users:
+    #   python migrations/rebuild_rollups.py [user_id ...]
+    user_ids = sys.argv[1:] or [doc.id for doc in taxi_db.collection("users").stream()]
+    for user_id in user_ids:
+        rebuild_user_rollups(taxi_db, user_id)
+
+
+if __name__ == "__main__":
+    main()
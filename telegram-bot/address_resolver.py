@@ -0,0 +1,296 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass(slots=True)
+class PendingAddress:
+    """A trip address waiting to be resolved from its coordinates."""
+
+    trip_id: str
+    field: str
+    latitude: float
+    longitude: float
+    attempts: int = 0
+
+
+class AddressResolver:
+    """Fills in the addresses of trips recorded with coordinates only, in the background.
+
+    Coordinates submitted within batch_delay seconds of the first are resolved as
+    one batch of up to max_batch. The batch is grouped by cell_key, so that nearby
+    pickups and drop offs of any trips share one lookup, and the cells are resolved
+    by up to workers threads. The addresses found are written with one call to
+    write per batch, as {trip_id: {field: address}}. A lookup that fails or finds
+    nothing, as the geocoding client reports errors as no address, and a failed
+    write are retried with a later batch, up to max_attempts. The addresses still
+    not found then are passed to mark_unresolvable, as {trip_id: [field]}.
+
+    Addresses lost with the queue of a stopped instance, or with failed writes,
+    are found again by sweeps every sweep_interval seconds, which submit the
+    (trip_id, field, latitude, longitude) that find_unresolved returns. Sweeps
+    start with the first submission, or with start_sweeps.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        resolve: Callable[[float, float], Optional[str]],
+        cell_key: Callable[[float, float], str],
+        write: Callable[[Dict[str, Dict[str, str]]], None],
+        find_unresolved: Optional[
+            Callable[[], Iterable[Tuple[str, str, float, float]]]
+        ] = None,
+        mark_unresolvable: Optional[Callable[[Dict[str, List[str]]], None]] = None,
+        sweep_interval: Optional[float] = None,
+        batch_delay: float = 2.0,
+        max_batch: int = 100,
+        workers: int = 4,
+        max_pending: int = 10000,
+        max_attempts: int = 3,
+    ) -> None:
+        self.resolve = resolve
+        self.cell_key = cell_key
+        self.write = write
+        self.find_unresolved = find_unresolved
+        self.mark_unresolvable = mark_unresolvable
+        self.sweep_interval = sweep_interval
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="address-resolver"
+        )
+        self._pending: List[PendingAddress] = []
+        self._pending_since = 0.0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._sweeper: Optional[threading.Thread] = None
+        self._busy = False
+        self._flush = False
+        self.max_depth = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.batches = 0
+        self.lookups = 0
+        self.resolved = 0
+        self.unresolved = 0
+        self.failed = 0
+        self.retried = 0
+        self.swept = 0
+        self.total_batch_time = 0.0
+        self.max_batch_time = 0.0
+
+    def submit(
+        self, trip_id: str, field: str, latitude: float, longitude: float
+    ) -> bool:
+        """Queues an address field of a trip, returns False if the queue is full."""
+        with self._condition:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                logging.warning(
+                    f"Address queue full, dropped {field} of trip {trip_id}"
+                )
+                return False
+            self._queue(PendingAddress(trip_id, field, latitude, longitude))
+            self.submitted += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name="address-resolver", daemon=True
+                )
+                self._thread.start()
+                self.start_sweeps()
+            self._condition.notify_all()
+        return True
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Resolves the queued addresses without waiting for a batch to fill up.
+
+        Returns False if they are not all resolved or given up within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._flush = True
+            self._condition.notify_all()
+            try:
+                while self._pending or self._busy:
+                    remaining = (
+                        None if deadline is None else deadline - time.monotonic()
+                    )
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self._flush = False
+        return True
+
+    def sweep(self) -> int:
+        """Submits the unresolved addresses that are not queued, returns how many."""
+        with self._condition:
+            queued = {(item.trip_id, item.field) for item in self._pending}
+        swept = 0
+        for trip_id, field, latitude, longitude in self.find_unresolved():
+            if (trip_id, field) not in queued and self.submit(
+                trip_id, field, latitude, longitude
+            ):
+                swept += 1
+        with self._condition:
+            self.swept += swept
+        if swept:
+            logging.info(f"Swept {swept} unresolved addresses")
+        return swept
+
+    def start_sweeps(self) -> None:
+        """Sweeps now and then every sweep_interval seconds, in the background."""
+        if self.find_unresolved is None or not self.sweep_interval:
+            return
+
+        def sweep_forever() -> None:
+            while True:
+                try:
+                    self.sweep()
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logging.exception("Error sweeping unresolved addresses")
+                time.sleep(self.sweep_interval)
+
+        with self._condition:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(
+                    target=sweep_forever, name="address-sweeper", daemon=True
+                )
+                self._sweeper.start()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the queue and lookup counters."""
+        with self._condition:
+            return {
+                "depth": len(self._pending),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "batches": self.batches,
+                "lookups": self.lookups,
+                "resolved": self.resolved,
+                "unresolved": self.unresolved,
+                "failed": self.failed,
+                "retried": self.retried,
+                "swept": self.swept,
+                "avg_batch_time": (
+                    self.total_batch_time / self.batches if self.batches else 0.0
+                ),
+                "max_batch_time": self.max_batch_time,
+            }
+
+    def _queue(self, item: PendingAddress) -> None:
+        # Called with the condition held
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append(item)
+        self.max_depth = max(self.max_depth, len(self._pending))
+
+    def _next_batch(self) -> List[PendingAddress]:
+        # Called with the condition held, waits for the batch to fill up or time out
+        while not self._pending:
+            self._condition.wait()
+        while len(self._pending) < self.max_batch and not self._flush:
+            remaining = self._pending_since + self.batch_delay - time.monotonic()
+            if remaining <= 0:
+                break
+            self._condition.wait(remaining)
+        batch = self._pending[: self.max_batch]
+        del self._pending[: self.max_batch]
+        self._pending_since = time.monotonic()
+        return batch
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                batch = self._next_batch()
+                self._busy = True
+            started_at = time.monotonic()
+            try:
+                self._resolve_batch(batch)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception(f"Error resolving {len(batch)} addresses")
+            elapsed = time.monotonic() - started_at
+            with self._condition:
+                self._busy = False
+                self.batches += 1
+                self.total_batch_time += elapsed
+                self.max_batch_time = max(self.max_batch_time, elapsed)
+                self._condition.notify_all()
+
+    def _resolve_batch(self, batch: List[PendingAddress]) -> None:
+        cells: Dict[str, List[PendingAddress]] = {}
+        for item in batch:
+            cells.setdefault(self.cell_key(item.latitude, item.longitude), []).append(
+                item
+            )
+        addresses = list(self._executor.map(self._resolve_cell, cells.values()))
+
+        updates: Dict[str, Dict[str, str]] = {}
+        written: List[PendingAddress] = []
+        not_found: List[PendingAddress] = []
+        for items, address in zip(cells.values(), addresses):
+            if not address:
+                not_found.extend(items)
+                continue
+            for item in items:
+                updates.setdefault(item.trip_id, {})[item.field] = address
+                written.append(item)
+        with self._condition:
+            self.lookups += len(cells)
+            unresolvable = self._retry(not_found)
+            self.unresolved += len(unresolvable)
+        if unresolvable:
+            self._mark_unresolvable(unresolvable)
+        if not updates:
+            return
+
+        try:
+            self.write(updates)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.error(f"Error writing the addresses of {len(updates)} trips: {err}")
+            with self._condition:
+                # Left for the sweeps, the lookups are not at fault
+                self.failed += len(self._retry(written))
+            return
+        with self._condition:
+            self.resolved += len(written)
+
+    def _retry(self, items: List[PendingAddress]) -> List[PendingAddress]:
+        # Called with the condition held, returns the items given up
+        given_up = []
+        for item in items:
+            item.attempts += 1
+            if item.attempts < self.max_attempts:
+                self._queue(item)
+                self.retried += 1
+            else:
+                given_up.append(item)
+        return given_up
+
+    def _mark_unresolvable(self, items: List[PendingAddress]) -> None:
+        if self.mark_unresolvable is None:
+            return
+        fields: Dict[str, List[str]] = {}
+        for item in items:
+            fields.setdefault(item.trip_id, []).append(item.field)
+        try:
+            self.mark_unresolvable(fields)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            # The sweeps then try them again
+            logging.error(f"Error marking the addresses of {len(fields)} trips: {err}")
+
+    def _resolve_cell(self, items: List[PendingAddress]) -> Optional[str]:
+        item = items[0]
+        try:
+            return self.resolve(item.latitude, item.longitude)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.error(
+                f"Error resolving the address at {item.latitude}, {item.longitude}: {err}"
+            )
+            return None
@@ -0,0 +1,27 @@
+import logging
+import os
+
+import telebot
+
+# Registered with Telegram once per deploy, not on every cold start:
+#   BOT_TOKEN=... python telegram-bot/bot_commands.py
+COMMANDS = [
+    telebot.types.BotCommand("/start_shift", "開工"),
+    telebot.types.BotCommand("/end_shift", "收工"),
+    telebot.types.BotCommand("/get_trips", "睇返最近嘅記錄"),
+    telebot.types.BotCommand("/get_all_trips", "睇晒全部記錄"),
+    telebot.types.BotCommand("/stats", "睇收入統計"),
+    telebot.types.BotCommand("/hotspots", "睇而家邊度多客"),
+]
+
+
+def register_commands(bot: telebot.TeleBot) -> None:
+    """Sets the command menu of the bot."""
+    bot.set_my_commands(COMMANDS)
+    logging.info(f"Registered {len(COMMANDS)} bot commands.")
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    register_commands(telebot.TeleBot(os.environ.get("BOT_TOKEN")))
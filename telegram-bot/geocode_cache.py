@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+from google.cloud.firestore_v1 import CollectionReference
+
+GEOCODE_CACHE_COLLECTION_NAME = "geocode_cache"
+
+
+class GeocodeCache:
+    """Two-tier reverse-geocode cache keyed on a quantized HK1980 grid cell.
+
+    The first tier is an in-process LRU with a TTL, the second a shared Firestore
+    collection so that cold instances can reuse addresses resolved elsewhere.
+    """
+
+    def __init__(
+        self,
+        project: Callable[[float, float], Tuple[float, float]],
+        collection: Optional[Callable[[], CollectionReference]] = None,
+        cell_size: float = 25.0,
+        max_size: int = 2048,
+        ttl: float = 7 * 24 * 60 * 60,
+    ) -> None:
+        self.project = project
+        self.collection = collection
+        self.cell_size = cell_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def cell_key(self, lat: float, lon: float) -> str:
+        """Returns the key of the grid cell containing the given coordinates."""
+        easting, northing = self.project(lat, lon)
+        return (
+            f"{self.cell_size:g}m:"
+            f"{int(easting // self.cell_size)}:{int(northing // self.cell_size)}"
+        )
+
+    def get(self, lat: float, lon: float) -> Optional[str]:
+        """Gets the cached address for the cell containing the given coordinates."""
+        key = self.cell_key(lat, lon)
+        address = self._get_local(key)
+        if address is not None:
+            self.hits += 1
+            return address
+
+        address = self._get_shared(key)
+        if address is not None:
+            self.shared_hits += 1
+            self._put_local(key, address)
+            return address
+
+        self.misses += 1
+        return None
+
+    def peek(self, lat: float, lon: float) -> Optional[str]:
+        """Gets the address cached in process, without reading the shared tier."""
+        address = self._get_local(self.cell_key(lat, lon))
+        if address is not None:
+            self.hits += 1
+        return address
+
+    def put(self, lat: float, lon: float, address: str) -> None:
+        """Caches the address for the cell containing the given coordinates."""
+        key = self.cell_key(lat, lon)
+        self._put_local(key, address)
+        self._put_shared(key, address)
+
+    def get_or_resolve(
+        self,
+        lat: float,
+        lon: float,
+        resolver: Callable[[float, float], Optional[str]],
+    ) -> Optional[str]:
+        """Gets the cached address, resolving and caching it on a miss."""
+        address = self.get(lat, lon)
+        if address is not None:
+            return address
+
+        address = resolver(lat, lon)
+        if address:
+            self.put(lat, lon, address)
+        return address
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the cache counters."""
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
+
+    def _get_local(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            address, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return address
+
+    def _put_local(self, key: str, address: str) -> None:
+        with self._lock:
+            self._entries[key] = (address, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _get_shared(self, key: str) -> Optional[str]:
+        if self.collection is None:
+            return None
+        try:
+            doc = self.collection().document(key).get()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.error(f"Error reading geocode cache entry {key}: {err}")
+            return None
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get("expires_at")
+        if expires_at is not None and expires_at <= datetime.now(timezone.utc):
+            self.expirations += 1
+            return None
+        return data.get("address")
+
+    def _put_shared(self, key: str, address: str) -> None:
+        if self.collection is None:
+            return
+        try:
+            self.collection().document(key).set(
+                {
+                    "address": address,
+                    "cell_size": self.cell_size,
+                    "expires_at": datetime.now(timezone.utc)
+                    + timedelta(seconds=self.ttl),
+                }
+            )
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.error(f"Error writing geocode cache entry {key}: {err}")
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from tracing import LatencyHistogram
+
+# Overridable to point at local stubs, see benchmarks/benchmark_webhook.py
+OSM_URL = os.environ.get("OSM_URL", "https://nominatim.openstreetmap.org/reverse")
+HK_GEODATA_URL = os.environ.get(
+    "HK_GEODATA_URL", "https://geodata.gov.hk/gs/api/v1.0.0/identify"
+)
+
+
+def parse_osm_address(data: Dict[str, Any]) -> Optional[str]:
+    """Gets the address from an OSM Nominatim reverse geocoding response."""
+    address = data.get("address", {})
+    return " ".join(
+        [
+            address.get("road", ""),
+            address.get("house_number", ""),
+            address.get("village", ""),
+            address.get("building", ""),
+        ]
+    ).strip()
+
+
+def parse_hk_geodata_address(data: Dict[str, Any]) -> Optional[str]:
+    """Gets the address from a HK GeoData identify response."""
+    address = data["results"][0]
+    match address["type"]:
+        case "LOT":
+            location_name = [
+                address["addressInfo"][0].get("LOTNAME", ""),
+                address["addressInfo"][0].get("LOT_FULLNAME", ""),
+            ]
+            location_name = [name for name in location_name if name]
+            return " ".join(location_name).replace("<br>", "").strip()
+        case "ADDRESS":
+            location_name = [
+                address["addressInfo"][0].get("caddress", ""),
+                address["addressInfo"][0].get("cname", ""),
+            ]
+            location_name = [name for name in location_name if name]
+            return " ".join(location_name).replace("<br>", "").strip()
+    logging.error(f"Unrecognised address type {address['type']} for address {address}")
+    return None
+
+
+class GeocodingProvider(ABC):
+    """A reverse geocoding web service with its own deadline and stats."""
+
+    name = "provider"
+
+    def __init__(self, deadline: float) -> None:
+        self.deadline = deadline
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.errors = 0
+        self.empty = 0
+        self.wins = 0
+
+    @abstractmethod
+    def request(self, client: httpx.Client, lat: float, lon: float) -> Optional[str]:
+        """Requests the address of the coordinates from the service."""
+
+    def resolve(self, client: httpx.Client, lat: float, lon: float) -> Optional[str]:
+        """Requests the address and records the latency and outcome."""
+        self.requests += 1
+        start = time.perf_counter()
+        try:
+            address = self.request(client, lat, lon)
+        except (httpx.HTTPError, json.decoder.JSONDecodeError) as err:
+            self.errors += 1
+            logging.error(f"Error fetching location from {self.name}: {err}")
+            return None
+        except (KeyError, IndexError, TypeError) as err:
+            self.errors += 1
+            logging.error(f"Error parsing location response from {self.name}: {err}")
+            return None
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+        if not address:
+            self.empty += 1
+        return address
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the request counters and latency histogram stats."""
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.errors / self.requests if self.requests else 0.0,
+            "empty": self.empty,
+            "wins": self.wins,
+            "latency": self.latency.stats(),
+        }
+
+
+class OSMProvider(GeocodingProvider):
+    name = "osm"
+
+    def request(self, client: httpx.Client, lat: float, lon: float) -> Optional[str]:
+        """Requests the address from OSM Nominatim."""
+        response = client.get(
+            OSM_URL,
+            params={"lat": lat, "lon": lon, "format": "json"},
+            headers={
+                "User-Agent": "ArBaakTaxi/0.0",
+                "Referrer": "https://arbaak.com",
+                "Accept-Language": "zh",
+            },
+            timeout=self.deadline,
+        )
+        response.raise_for_status()
+        return parse_osm_address(response.json())
+
+
+class HKGeoDataProvider(GeocodingProvider):
+    name = "hk_geodata"
+
+    def __init__(
+        self, deadline: float, project: Callable[[float, float], Tuple[float, float]]
+    ) -> None:
+        super().__init__(deadline)
+        self.project = project
+
+    def request(self, client: httpx.Client, lat: float, lon: float) -> Optional[str]:
+        """Requests the address from the HK GeoData identify API."""
+        easting, northing = self.project(lat, lon)
+        response = client.get(
+            HK_GEODATA_URL,
+            params={"x": easting, "y": northing, "lang": "zh"},
+            timeout=self.deadline,
+        )
+        response.raise_for_status()
+        return parse_hk_geodata_address(response.json())
+
+
+class GeocodingClient:
+    """Reverse geocoder racing several providers over a shared connection pool.
+
+    The first provider is asked first. If it has not answered within its p90
+    latency, the next provider is asked as well (a hedged request), and the first
+    non-empty address wins.
+    """
+
+    def __init__(
+        self,
+        providers: List[GeocodingProvider],
+        hedge_quantile: float = 0.9,
+        default_hedge_delay: float = 1.0,
+        min_hedge_samples: int = 20,
+        http2: bool = False,
+    ) -> None:
+        self.providers = providers
+        self.hedge_quantile = hedge_quantile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_samples = min_hedge_samples
+        self.http2 = http2
+        self.hedged = 0
+        self._client: Optional[httpx.Client] = None
+        self._client_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=4 * len(providers), thread_name_prefix="geocoding"
+        )
+
+    @property
+    def client(self) -> httpx.Client:
+        """Gets the shared HTTP client, opening the connection pool on first use."""
+        with self._client_lock:
+            if self._client is None:
+                self._client = httpx.Client(
+                    http2=self.http2 and self._http2_available(),
+                    limits=httpx.Limits(
+                        max_connections=20, max_keepalive_connections=10
+                    ),
+                )
+            return self._client
+
+    def reverse_geocode(self, lat: float, lon: float) -> Optional[str]:
+        """Gets the address from latitude and longitude from the fastest provider."""
+        pending: Dict[Future, GeocodingProvider] = {}
+        for i, provider in enumerate(self.providers):
+            pending[self._executor.submit(provider.resolve, self.client, lat, lon)] = (
+                provider
+            )
+            if i == len(self.providers) - 1:
+                break
+
+            # Wait for an answer for up to the hedge delay before racing the next
+            deadline = time.monotonic() + self._hedge_delay(provider)
+            while pending:
+                done, _ = wait(
+                    pending,
+                    timeout=max(deadline - time.monotonic(), 0),
+                    return_when=FIRST_COMPLETED,
+                )
+                if not done:
+                    break
+                for future in done:
+                    address = future.result()
+                    if address:
+                        pending[future].wins += 1
+                        return address
+                    # Failed or empty, move on to the next provider straight away
+                    pending.pop(future)
+            if pending:
+                self.hedged += 1
+
+        for future in self._as_completed(pending):
+            address = future.result()
+            if address:
+                pending[future].wins += 1
+                return address
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the stats of every provider."""
+        return {
+            "hedged": self.hedged,
+            **{provider.name: provider.stats() for provider in self.providers},
+        }
+
+    def _hedge_delay(self, provider: GeocodingProvider) -> float:
+        if provider.latency.count < self.min_hedge_samples:
+            return self.default_hedge_delay
+        delay = provider.latency.quantile(self.hedge_quantile)
+        return min(delay, provider.deadline) if delay else self.default_hedge_delay
+
+    def _as_completed(self, pending: Dict[Future, GeocodingProvider]):
+        timeout = (
+            max(provider.deadline for provider in pending.values()) if pending else 0
+        )
+        waiting = set(pending)
+        end = time.monotonic() + timeout
+        while waiting:
+            done, waiting = wait(
+                waiting,
+                timeout=max(end - time.monotonic(), 0),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                return
+            yield from done
+
+    @staticmethod
+    def _http2_available() -> bool:
+        try:
+            import h2  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+        except ImportError:
+            logging.warning("HTTP/2 requested but the h2 package is not installed.")
+            return False
+        return True
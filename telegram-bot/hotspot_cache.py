@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Hashable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from hotspots import HotspotIndex
+
+
+class HotspotCache:
+    """Instance-local LRU of the hotspot index of each driver, with a TTL."""
+
+    def __init__(self, max_size: int = 256, ttl: float = 6 * 60 * 60) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, Tuple["HotspotIndex", float]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: Hashable) -> Optional["HotspotIndex"]:
+        """Gets the cached index of a driver."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id: Hashable, index: "HotspotIndex") -> None:
+        """Caches the index of a driver."""
+        with self._lock:
+            self._entries[user_id] = (index, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the cache counters."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
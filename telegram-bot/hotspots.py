@@ -0,0 +1,185 @@
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+HOURS_PER_WEEK = 7 * 24
+HK_UTC_OFFSET = 8 * 60 * 60
+
+# Cell keys pack the column and row of a grid cell into a single integer
+CELL_KEY_STRIDE = 1 << 20
+
+# Only these trip fields are downloaded to bin pickups
+HOTSPOT_FIELDS = [
+    "start_latitude",
+    "start_longitude",
+    "start_address",
+    "start_time",
+    "end_time",
+    "fare",
+]
+
+
+def hour_of_week(epoch_seconds: np.ndarray) -> np.ndarray:
+    """Gets the Hong Kong hour of week, from Monday 00:00, of Unix timestamps."""
+    hours = (epoch_seconds.astype(np.int64) + HK_UTC_OFFSET) // 3600
+    # 1970-01-01 was a Thursday, three days after a Monday
+    return (hours + 3 * 24) % HOURS_PER_WEEK
+
+
+class HotspotIndex:
+    """Pickup fares binned by HK1980 grid cell and hour of week.
+
+    Bins are kept as sorted columnar arrays of packed (cell, hour of week) keys with
+    their trip counts and fare sums, so new trips are merged in without rebinning
+    the history.
+    """
+
+    def __init__(
+        self,
+        project: Callable[[Any, Any], Tuple[Any, Any]],
+        cell_size: float = 500.0,
+    ) -> None:
+        self.project = project
+        self.cell_size = cell_size
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.fares = np.empty(0, dtype=np.float64)
+        # A representative pickup address per cell, the latest one seen
+        self.addresses: Dict[int, str] = {}
+        self.first_time: Optional[float] = None
+        self.last_time: Optional[float] = None
+        # Latest end time of the paid trips seen, newer trips are merged on refresh
+        self.watermark: Optional[datetime] = None
+
+    def __len__(self) -> int:
+        return int(self.counts.sum())
+
+    def add_trips(self, trips: Iterable[Dict[str, Any]]) -> int:
+        """Bins the paid trips with a pickup location, returns the number binned."""
+        latitudes: List[float] = []
+        longitudes: List[float] = []
+        start_times: List[float] = []
+        fares: List[float] = []
+        addresses: List[Optional[str]] = []
+        for trip in trips:
+            fare = trip.get("fare")
+            if not fare:
+                # Fetched again on refresh until its fare is entered
+                continue
+            end_time = trip.get("end_time")
+            if end_time is not None and (
+                self.watermark is None or end_time > self.watermark
+            ):
+                self.watermark = end_time
+            if (
+                trip.get("start_latitude") is None
+                or trip.get("start_longitude") is None
+                or trip.get("start_time") is None
+            ):
+                continue
+            latitudes.append(trip["start_latitude"])
+            longitudes.append(trip["start_longitude"])
+            start_times.append(trip["start_time"].timestamp())
+            fares.append(fare)
+            addresses.append(trip.get("start_address"))
+        if not fares:
+            return 0
+        self.add_columns(
+            np.asarray(latitudes),
+            np.asarray(longitudes),
+            np.asarray(start_times),
+            np.asarray(fares),
+            addresses,
+        )
+        return len(fares)
+
+    def add_columns(
+        self,
+        latitudes: np.ndarray,
+        longitudes: np.ndarray,
+        start_times: np.ndarray,
+        fares: np.ndarray,
+        addresses: Optional[List[Optional[str]]] = None,
+    ) -> None:
+        """Bins pickups given as columns of coordinates, Unix start times and fares."""
+        eastings, northings = self.project(latitudes, longitudes)
+        cells = self._cell_keys(np.asarray(eastings), np.asarray(northings))
+        keys = cells * HOURS_PER_WEEK + hour_of_week(start_times)
+
+        # Aggregate the new pickups, then merge them with the existing bins
+        merged_keys, inverse = np.unique(
+            np.concatenate([self.keys, keys]), return_inverse=True
+        )
+        self.counts = np.bincount(
+            inverse,
+            weights=np.concatenate([self.counts, np.ones(len(keys))]),
+            minlength=len(merged_keys),
+        ).astype(np.int64)
+        self.fares = np.bincount(
+            inverse,
+            weights=np.concatenate([self.fares, fares]),
+            minlength=len(merged_keys),
+        )
+        self.keys = merged_keys
+
+        if addresses is not None:
+            # Oldest first, so the latest address of a cell wins
+            for i in np.argsort(start_times, kind="stable"):
+                if addresses[i]:
+                    self.addresses[int(cells[i])] = addresses[i]
+        first, last = float(start_times.min()), float(start_times.max())
+        self.first_time = (
+            first if self.first_time is None else min(self.first_time, first)
+        )
+        self.last_time = last if self.last_time is None else max(self.last_time, last)
+
+    def top(
+        self, when: datetime, limit: int = 5, window: int = 1
+    ) -> List[Dict[str, Any]]:
+        """Gets the cells with the highest expected pickup fare per hour around a time.
+
+        The expected fare per hour is the fare picked up in the cell within window
+        hours either side of the hour of week, divided by the number of such hours
+        in the history.
+        """
+        if not self.keys.size:
+            return []
+        hour = int(hour_of_week(np.asarray([when.timestamp()]))[0])
+        hours = (np.arange(hour - window, hour + window + 1)) % HOURS_PER_WEEK
+        selected = np.isin(self.keys % HOURS_PER_WEEK, hours)
+        if not selected.any():
+            return []
+
+        cells, inverse = np.unique(
+            self.keys[selected] // HOURS_PER_WEEK, return_inverse=True
+        )
+        fares = np.bincount(inverse, weights=self.fares[selected])
+        counts = np.bincount(inverse, weights=self.counts[selected])
+        weeks = max(1.0, (self.last_time - self.first_time) / (HOURS_PER_WEEK * 3600))
+        fare_per_hour = fares / (weeks * len(hours))
+
+        order = np.argsort(-fare_per_hour, kind="stable")[:limit]
+        return [
+            {
+                "cell": int(cells[i]),
+                "address": self.addresses.get(int(cells[i])),
+                "center": self._cell_center(int(cells[i])),
+                "trips": int(counts[i]),
+                "fare_per_hour": float(fare_per_hour[i]),
+                "average_fare": float(fares[i] / counts[i]),
+            }
+            for i in order
+        ]
+
+    def _cell_keys(self, eastings: np.ndarray, northings: np.ndarray) -> np.ndarray:
+        columns = np.floor(eastings / self.cell_size).astype(np.int64)
+        rows = np.floor(northings / self.cell_size).astype(np.int64)
+        return columns * CELL_KEY_STRIDE + rows
+
+    def _cell_center(self, cell: int) -> Tuple[float, float]:
+        column, row = divmod(cell, CELL_KEY_STRIDE)
+        return (
+            (column + 0.5) * self.cell_size,
+            (row + 0.5) * self.cell_size,
+        )
@@ -1,314 +1,300 @@
-from datetime import datetime, timezone
+import asyncio
+from datetime import datetime, timedelta, timezone
 import os
-from firebase_admin import firestore
-from google.cloud.firestore_v1.base_document import DocumentSnapshot
-from google.cloud.firestore_v1.base_query import FieldFilter
-import json
-from typing import List, Optional, Self
-import pytz
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
 import telebot
-import httpx
-import pyproj
-from pydantic import BaseModel, field_validator
-import csv
-from io import StringIO
 from flask import Flask, jsonify
-from google.cloud.logging import (  # pylint: disable=ungrouped-imports
-    Client as GCloudLoggingClient,
-)
-from google.cloud.logging.handlers import CloudLoggingHandler
 import logging
+from address_resolver import AddressResolver
+from bot_commands import COMMANDS
+from geocode_cache import GEOCODE_CACHE_COLLECTION_NAME, GeocodeCache
+from offline_geocoder import OfflineGeocoder
+from geocoding_client import GeocodingClient, HKGeoDataProvider, OSMProvider
+from update_queue import ChatOrderedQueue
+from update_dedup import (
+    CLAIMED,
+    COMPLETED,
+    PROCESSED_UPDATES_COLLECTION_NAME,
+    UpdateDeduplicator,
+)
+from outbox import Outbox
+from polling import DEFAULT_API_URL, PollingRunner
+from send_scheduler import BULK, INTERACTIVE, SendScheduler
+from models import (
+    Shift,
+    Trip,
+    UnitOfWork,
+    STORAGE_BACKEND,
+    User,
+    get_db,
+    get_repository,
+    session_cache,
+    tracer,
+    write_stats,
+)
+from session_cache import StaleSessionError
+from trip_export import EXPORT_FIELDS, HK_TZ, export_trips_csv, format_location
+from rollups import summarise as summarise_rollup
+from hotspot_cache import HotspotCache
+from functools import lru_cache, partial
+
+if TYPE_CHECKING:
+    import pyproj
+    from hotspots import HotspotIndex
+
+# Clients are created on first use so that a cold start serves its first update
+# without waiting on credential lookups or network calls. Set to "eager" to
+# create them at import instead, e.g. when minimum instances are kept warm.
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "lazy")
 
 LOG_NAME = "ar-baak-taxi-tg-bot"
-gcloud_logging_client = GCloudLoggingClient()
-gcloud_logging_handler = CloudLoggingHandler(gcloud_logging_client, name=LOG_NAME)
+# Set to "0" to only log to stderr, e.g. when running locally without credentials
+CLOUD_LOGGING = os.environ.get("CLOUD_LOGGING", "1")
 
 logger = logging.getLogger(LOG_NAME)
 logger.setLevel(logging.DEBUG)
-logger.addHandler(gcloud_logging_handler)
-
 
 flask_logger = logging.getLogger("werkzeug")
 flask_logger.setLevel(logging.DEBUG)
-flask_logger.addHandler(gcloud_logging_handler)
+
+
+@lru_cache(maxsize=None)
+def setup_cloud_logging() -> None:
+    """Attaches the Cloud Logging handler, once."""
+    if CLOUD_LOGGING != "1":
+        return
+    # pylint: disable=import-outside-toplevel
+    from google.cloud.logging import Client as GCloudLoggingClient
+    from google.cloud.logging.handlers import CloudLoggingHandler
+
+    gcloud_logging_handler = CloudLoggingHandler(GCloudLoggingClient(), name=LOG_NAME)
+    logger.addHandler(gcloud_logging_handler)
+    flask_logger.addHandler(gcloud_logging_handler)
+
 
 # Initialize Flask app
 app = Flask(__name__)
 
-# Initialize Firestore
-DB_NAME = f"taxi-{os.environ.get('ENV', 'dev')}"
-db = firestore.Client(database=DB_NAME)
 
-USER_COLLECTION_NAME = "users"
-TRIP_COLLECTION_NAME = "trips"
-SHIFT_COLLECTION_NAME = "shifts"
+class TracedTeleBot(telebot.TeleBot):
+    """Telegram bot timing the messages sent while serving an update.
 
+    Text messages go through the outbox, so that they can be coalesced and the
+    last one returned in the webhook response. Messages and documents are then
+    handed to the send scheduler, which queues them in SEND_MODE=queued.
+    """
 
-# Telegram bot setup
+    def send_message(self, chat_id, text, **kwargs):  # pylint: disable=arguments-differ
+        if outbox.defer(chat_id, text, **kwargs):
+            return None
+        return self.send_message_now(chat_id, text, **kwargs)
+
+    def send_message_now(self, chat_id, text, **kwargs):
+        """Queues a message for sending, bypassing the outbox."""
+        send = super().send_message
+        send_traced = tracer.bind(
+            "telegram.send_message", lambda: send(chat_id, text, **kwargs)
+        )
+        send_scheduler.enqueue(chat_id, send_traced, priority=INTERACTIVE)
+
+    def send_document(
+        self, chat_id, document, on_sent=None, **kwargs
+    ):  # pylint: disable=arguments-differ
+        """Queues a document for sending behind interactive replies, then closes it.
+
+        on_sent is called once the document is sent.
+        """
+        # Keep the messages held back so far ahead of the document
+        outbox.flush()
+        send = super().send_document
+
+        def send_file():
+            # A retried send reads the file again from the start
+            document.file.seek(0)
+            return send(chat_id, document, **kwargs)
+
+        send_traced = tracer.bind("telegram.send_document", send_file)
+        send_scheduler.enqueue(
+            chat_id,
+            send_traced,
+            priority=BULK,
+            cleanup=document.file.close,
+            on_sent=on_sent,
+        )
+
+
+# How replies are sent: "webhook" coalesces consecutive texts and returns the
+# last one in the webhook response, "coalesce" only coalesces them and "direct"
+# sends every message as it is made
+TELEGRAM_REPLY_MODE = os.environ.get("TELEGRAM_REPLY_MODE", "webhook")
+outbox = Outbox(
+    send=lambda chat_id, text, **kwargs: bot.send_message_now(chat_id, text, **kwargs),
+    enabled=TELEGRAM_REPLY_MODE != "direct",
+)
+
+# Sends are made from the handler by default, as the CPU is throttled between
+# requests on Cloud Functions. Set to "queued" where it is always allocated, e.g.
+# when long polling on a VM, to have background workers send within Telegram's
+# limits of about 30 messages per second overall and 1 per second per chat.
+SEND_MODE = os.environ.get("SEND_MODE", "direct")
+send_scheduler = SendScheduler(
+    enabled=SEND_MODE == "queued",
+    global_rate=float(os.environ.get("SEND_GLOBAL_RATE", 30)),
+    chat_rate=float(os.environ.get("SEND_CHAT_RATE", 1)),
+    chat_burst=float(os.environ.get("SEND_CHAT_BURST", 3)),
+    workers=int(os.environ.get("SEND_WORKERS", 4)),
+    max_queued=int(os.environ.get("SEND_MAX_QUEUED", 10000)),
+)
+
+# Telegram bot setup, the command menu is registered at deploy time by
+# bot_commands.py
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
-bot = telebot.TeleBot(BOT_TOKEN)
-
-# Set bot commands
-commands = [
-    telebot.types.BotCommand("/start_shift", "開工"),
-    telebot.types.BotCommand("/end_shift", "收工"),
-    telebot.types.BotCommand("/get_trips", "睇返最近嘅記錄"),
-    telebot.types.BotCommand("/get_all_trips", "睇晒全部記錄"),
-]
-bot.set_my_commands(commands)
-
-# Coordinate transformer
-transformer = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:2326")
-
-
-class Trip(BaseModel):
-    model_config = {"arbitrary_types_allowed": True}
-    trip_id: Optional[str] = None
-    shift_id: Optional[str] = None
-    user_id: str
-    start_latitude: Optional[float] = None
-    start_longitude: Optional[float] = None
-    start_address: str
-    start_time: datetime
-    end_latitude: Optional[float] = None
-    end_longitude: Optional[float] = None
-    end_address: Optional[str] = None
-    end_time: Optional[datetime] = None
-    fare: Optional[float] = None
-
-    @field_validator("fare")
-    def validate_fare(cls, value: float):
-        """Validates that the fare is a positive number."""
-        if value is not None and value <= 0:
-            raise ValueError("Fare must be a positive number.")
-        return value
-
-    def to_firestore_dict(self):
-        """Converts the Trip object to a dictionary suitable for Firestore."""
-        data = self.model_dump(exclude_unset=True)
-        return data
-
-    @classmethod
-    def from_firestore_doc(cls, doc: DocumentSnapshot) -> Optional[Self]:
-        """Creates a Trip object from a Firestore document snapshot."""
-        if doc.exists:
-            return cls.model_validate(doc.to_dict())
-        return None
+bot = TracedTeleBot(BOT_TOKEN)
 
-    def save_to_firestore(self):
-        """Saves or updates the Trip object in Firestore."""
-        trip_ref = db.collection(TRIP_COLLECTION_NAME).document()
-        self.trip_id = trip_ref.id
-        trip_ref.set(self.to_firestore_dict())
-
-    @classmethod
-    def get_trip_by_id(cls, trip_id: str) -> Optional[Self]:
-        """Gets a Trip object from Firestore by its ID."""
-        trip_ref = db.collection(TRIP_COLLECTION_NAME).document(trip_id)
-        trip_doc = trip_ref.get()
-        return cls.from_firestore_doc(trip_doc)
-
-    def update_in_firestore(self):
-        """Updates the corresponding Firestore document with the current User data."""
-        trip_ref = db.collection(TRIP_COLLECTION_NAME).document(str(self.trip_id))
-        trip_ref.update(self.model_dump(exclude_unset=True))
-
-
-class Shift(BaseModel):
-    shift_id: Optional[str] = None
-    user_id: str
-    start_time: datetime
-    end_time: Optional[datetime] = None
-    total_trips: int = 0
-    total_fare: float = 0.0
-
-    def to_firestore_dict(self):
-        """Converts the Shift object to a dictionary suitable for Firestore."""
-        data = self.model_dump(exclude_unset=True)
-        if data.get("start_time"):
-            data["start_time"] = firestore.SERVER_TIMESTAMP
-        if data.get("end_time"):
-            data["end_time"] = firestore.SERVER_TIMESTAMP
-        return data
-
-    @classmethod
-    def from_firestore_doc(cls, doc: DocumentSnapshot) -> Optional[Self]:
-        """Creates a Shift object from a Firestore document snapshot."""
-        if doc.exists:
-            return cls.model_validate(doc.to_dict())
-        return None
+# Overridable to point at a local stub, e.g. "http://127.0.0.1:8081/bot{0}/{1}"
+if os.environ.get("TELEGRAM_API_URL"):
+    telebot.apihelper.API_URL = os.environ["TELEGRAM_API_URL"]
 
-    @classmethod
-    def get_shift_by_id(cls, shift_id: str) -> Optional[Self]:
-        """Gets a Shift object from Firestore by its ID."""
-        shift_ref = db.collection(SHIFT_COLLECTION_NAME).document(shift_id)
-        shift_doc = shift_ref.get()
-        return cls.from_firestore_doc(shift_doc)
-
-    def save_to_firestore(self):
-        """Saves or updates the Shift object in Firestore."""
-        shift_ref = db.collection(SHIFT_COLLECTION_NAME).document()
-        self.shift_id = shift_ref.id
-        shift_ref.set(self.to_firestore_dict())
-
-    def update_in_firestore(self):
-        """Updates the corresponding Firestore document with the current Shift data."""
-        shift_ref = db.collection(SHIFT_COLLECTION_NAME).document(str(self.shift_id))
-        shift_ref.update(self.model_dump(exclude_unset=True))
-
-    def get_all_trips(self) -> List[Trip]:
-        """Retrieves all trips associated with this user from Firestore."""
-        trips_ref = (
-            db.collection(TRIP_COLLECTION_NAME)
-            .where(filter=FieldFilter("shift_id", "==", str(self.shift_id)))
-            .stream()
-        )
-        trips = [Trip.from_firestore_doc(trip_doc) for trip_doc in trips_ref]
-        return [_ for _ in trips if _ is not None]
-
-
-class User(BaseModel):
-    user_id: int
-    first_name: str
-    last_name: Optional[str]
-    username: Optional[str]
-    active_trip: Optional[str] = None
-    active_shift: Optional[str] = None
-    total_trips: int = 0
-    total_fare: float = 0.0
-    await_location_input: bool = False
-    await_fare_input: bool = False
-    export_history: List[datetime] = []
-
-    @classmethod
-    def from_firestore_doc(cls, doc: DocumentSnapshot) -> Optional[Self]:
-        """Creates a User object from a Firestore document snapshot."""
-        if doc.exists:
-            return cls.model_validate(doc.to_dict())
-        return None
 
-    @classmethod
-    def get_or_create_from_message_user(cls, from_user: telebot.types.User) -> Self:
-        """Gets or creates a User object from a Telegram message user."""
-        user_id = from_user.id
-        user_id_str = str(user_id)
-        user_ref = db.collection(USER_COLLECTION_NAME).document(user_id_str)
-        user_doc = user_ref.get()
-
-        user = cls.from_firestore_doc(user_doc)
-        if user:
-            return user
-
-        new_user_data = {
-            "user_id": from_user.id,
-            "first_name": from_user.first_name,
-            "last_name": from_user.last_name,
-            "username": from_user.username,
-        }
-        user_ref.set(new_user_data)
-        return cls.model_validate(new_user_data)
-
-    def update_in_firestore(self):
-        """Updates the corresponding Firestore document with the current User data."""
-        user_ref = db.collection(USER_COLLECTION_NAME).document(str(self.user_id))
-        user_ref.update(self.model_dump(exclude_unset=True))
-
-    def get_all_shifts(self) -> List[Trip]:
-        """Retrieves all trips associated with this user from Firestore."""
-        trips_ref = (
-            db.collection(SHIFT_COLLECTION_NAME)
-            .where(filter=FieldFilter("user_id", "==", str(self.user_id)))
-            .stream()
-        )
-        trips = [Trip.from_firestore_doc(trip_doc) for trip_doc in trips_ref]
-        return [_ for _ in trips if _ is not None]
+@lru_cache(maxsize=None)
+def get_transformer() -> "pyproj.Transformer":
+    """Gets the WGS84 to HK1980 grid transformer, importing pyproj on first use."""
+    import pyproj  # pylint: disable=import-outside-toplevel,redefined-outer-name
 
-    def get_all_trips(self, skip_exported: bool = False) -> List[Trip]:
-        """Retrieves all trips associated with this user from Firestore."""
-        trips_ref = db.collection(TRIP_COLLECTION_NAME).where(
-            filter=FieldFilter("user_id", "==", str(self.user_id))
-        )
+    return pyproj.Transformer.from_crs("EPSG:4326", "EPSG:2326")
 
-        if skip_exported and self.export_history:
-            trips_ref = trips_ref.where(
-                filter=FieldFilter("end_time", ">=", self.export_history[-1])
-            )
 
-        trips_ref = trips_ref.stream()
+def hk1980_grid(lat: float, lon: float) -> Tuple[float, float]:
+    """Converts latitude and longitude to HK1980 grid easting and northing."""
+    # EPSG:2326 uses the northing, easting axis order
+    northing, easting = get_transformer().transform(lat, lon)
+    return easting, northing
 
-        trips = [Trip.from_firestore_doc(trip_doc) for trip_doc in trips_ref]
-        return [_ for _ in trips if _ is not None]
 
+# Reverse geocode cache, shared through Firestore unless running on a single box
+geocode_cache = GeocodeCache(
+    project=hk1980_grid,
+    collection=(
+        (lambda: get_db().collection(GEOCODE_CACHE_COLLECTION_NAME))
+        if STORAGE_BACKEND == "firestore"
+        else None
+    ),
+    cell_size=float(os.environ.get("GEOCODE_CACHE_CELL_SIZE", 25)),
+    max_size=int(os.environ.get("GEOCODE_CACHE_MAX_SIZE", 2048)),
+    ttl=float(os.environ.get("GEOCODE_CACHE_TTL", 7 * 24 * 60 * 60)),
+)
 
-def get_osm_location(lat: float, lon: float) -> Optional[str]:
-    """Get the address from latitude and longitude using OSM Nominatim."""
-    try:
-        url = "https://nominatim.openstreetmap.org/reverse"
-        response = httpx.get(
-            url,
-            params={"lat": lat, "lon": lon, "format": "json"},
-            headers={
-                "User-Agent": "ArBaakTaxi/0.0",
-                "Referrer": "https://arbaak.com",
-                "Accept-Language": "zh",
-            },
-        )
-        response.raise_for_status()
-        data = response.json()
-        logging.warning(data)
-        address = data.get("address", {})
-        return " ".join(
-            [
-                address.get("road", ""),
-                address.get("house_number", ""),
-                address.get("village", ""),
-                address.get("building", ""),
-            ]
-        ).strip()
-
-    except httpx.HTTPStatusError as err:
-        logging.error(f"Error fetching location from OSM: {err}")
-        return None
+# Offline reverse geocoder, network providers are only used beyond this distance
+HK_ADDRESS_POINTS_PATH = os.environ.get(
+    "HK_ADDRESS_POINTS_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "hk_address_points.csv"),
+)
+OFFLINE_GEOCODER_MAX_DISTANCE = float(
+    os.environ.get("OFFLINE_GEOCODER_MAX_DISTANCE", 30)
+)
+
+# Reverse geocoding providers in order of preference, the next one is raced
+# against the previous when it is slower than its usual p90 latency
+GEOCODING_PROVIDERS = {
+    "osm": lambda: OSMProvider(
+        deadline=float(os.environ.get("OSM_DEADLINE", 3)),
+    ),
+    "hk_geodata": lambda: HKGeoDataProvider(
+        deadline=float(os.environ.get("HK_GEODATA_DEADLINE", 3)),
+        project=hk1980_grid,
+    ),
+}
+geocoding_client = GeocodingClient(
+    providers=[
+        GEOCODING_PROVIDERS[name]()
+        for name in os.environ.get("GEOCODING_PROVIDERS", "osm,hk_geodata").split(",")
+    ],
+    default_hedge_delay=float(os.environ.get("GEOCODING_HEDGE_DELAY", 1)),
+    http2=os.environ.get("GEOCODING_HTTP2") == "1",
+)
 
 
-def get_hk_geodata_location(lat: float, lon: float) -> Optional[str]:
-    """Gets the address from latitude and longitude using the HK GeoData API."""
-    easting, northing = transformer.transform(lat, lon)
-    logging.warning(f"Easting {easting}, Northing {northing}")
-    url = "https://geodata.gov.hk/gs/api/v1.0.0/identify"
-    try:
-        response = httpx.get(
-            url, params={"x": northing, "y": easting, "lang": "zh"}, timeout=10
-        )
-        response.raise_for_status()
-        data = response.json()
-        address = data["results"][0]
-        match address["type"]:
-            case "LOT":
-                location_name = [
-                    address["addressInfo"][0].get("LOTNAME", ""),
-                    address["addressInfo"][0].get("LOT_FULLNAME", ""),
-                ]
-                location_name = [name for name in location_name if name]
-                return " ".join(location_name).replace("<br>", "").strip()
-            case "ADDRESS":
-                location_name = [
-                    address["addressInfo"][0].get("caddress", ""),
-                    address["addressInfo"][0].get("cname", ""),
-                ]
-                location_name = [name for name in location_name if name]
-                return " ".join(location_name).replace("<br>", "").strip()
-        logging.error(
-            f"Unrecognised address type {address['type']} for address {address}"
-        )
+@lru_cache(maxsize=None)
+def get_offline_geocoder() -> Optional[OfflineGeocoder]:
+    """Loads the offline reverse geocoder on first use, if the address points are bundled."""
+    if not os.path.exists(HK_ADDRESS_POINTS_PATH):
+        logging.warning(f"Address points {HK_ADDRESS_POINTS_PATH} not found.")
         return None
+    offline_geocoder = OfflineGeocoder.from_csv(HK_ADDRESS_POINTS_PATH)
+    logging.info(f"Loaded {len(offline_geocoder)} address points.")
+    return offline_geocoder
 
-    except httpx.HTTPStatusError as err:
-        logging.error(f"Error fetching location from HK GeoData: {err}")
+
+def get_offline_location(lat: float, lon: float) -> Optional[str]:
+    """Gets the nearest bundled address from latitude and longitude."""
+    offline_geocoder = get_offline_geocoder()
+    if offline_geocoder is None:
         return None
-    except (json.decoder.JSONDecodeError, KeyError, IndexError) as err:
-        logging.error(f"Error parsing location response: {err}")
+    nearest = offline_geocoder.nearest(
+        *hk1980_grid(lat, lon), max_distance=OFFLINE_GEOCODER_MAX_DISTANCE
+    )
+    if nearest is None:
         return None
+    address, distance = nearest
+    logging.debug(f"Offline address {address} found {distance:.1f}m away.")
+    return address
+
+
+def warm_up() -> None:
+    """Creates the clients and loads the data used while serving updates."""
+    setup_cloud_logging()
+    get_repository()
+    get_transformer()
+    _ = geocoding_client.client
+    get_offline_geocoder()
+
+
+if STARTUP_MODE == "eager":
+    warm_up()
+
+
+def reverse_geocode(lat: float, lon: float) -> Optional[str]:
+    """Gets the address from latitude and longitude, going through the geocode cache."""
+    with tracer.span("geocode.offline"):
+        location = get_offline_location(lat, lon)
+    if location:
+        return location
+
+    with tracer.span("geocode.online"):
+        location = geocode_cache.get_or_resolve(
+            lat, lon, geocoding_client.reverse_geocode
+        )
+    logging.debug(f"Geocode cache stats: {geocode_cache.stats()}")
+    logging.debug(f"Geocoding client stats: {geocoding_client.stats()}")
+    return location
+
+
+# Set to "deferred" to record trips with their coordinates straight away and
+# resolve the addresses in the background. Keep "inline" where the CPU is
+# throttled between requests, as for SEND_MODE.
+GEOCODING_MODE = os.environ.get("GEOCODING_MODE", "inline")
+address_resolver = AddressResolver(
+    resolve=reverse_geocode,
+    cell_key=geocode_cache.cell_key,
+    write=Trip.fill_addresses,
+    find_unresolved=partial(
+        Trip.find_unresolved_addresses,
+        timedelta(hours=float(os.environ.get("ADDRESS_SWEEP_MAX_AGE_HOURS", 24))),
+        int(os.environ.get("ADDRESS_SWEEP_LIMIT", 500)),
+    ),
+    mark_unresolvable=Trip.mark_unresolvable,
+    sweep_interval=float(os.environ.get("ADDRESS_SWEEP_INTERVAL", 3600)),
+    batch_delay=float(os.environ.get("ADDRESS_RESOLVER_BATCH_DELAY", 2)),
+    # Firestore allows up to 500 writes in a batch
+    max_batch=int(os.environ.get("ADDRESS_RESOLVER_MAX_BATCH", 100)),
+    workers=int(os.environ.get("ADDRESS_RESOLVER_WORKERS", 4)),
+)
+
+
+def resolve_now(lat: float, lon: float) -> Optional[str]:
+    """Gets the address if it is known without a network call, in deferred mode."""
+    with tracer.span("geocode.offline"):
+        return get_offline_location(lat, lon) or geocode_cache.peek(lat, lon)
 
 
 def create_keyboard(user: User) -> telebot.types.ReplyKeyboardMarkup:
@@ -333,7 +319,8 @@ def start(user: User, message: telebot.types.Message) -> None:
     bot.send_message(
         message.chat.id,
         f"喂，{user.first_name} 師傅！搵食工具準備好未？\n開工 /start_shift\n收工 "
-        "/end_shift\n睇返最近嘅job /get_trips\n睇晒全部記錄 /get_all_trips",
+        "/end_shift\n睇返最近嘅job /get_trips\n睇晒全部記錄 /get_all_trips\n"
+        "睇收入 /stats\n邊度多客 /hotspots",
         reply_markup=telebot.types.ReplyKeyboardRemove(),
     )
 
@@ -353,11 +340,12 @@ def start_shift(user: User, message: telebot.types.Message) -> None:
         user_id=str(user.user_id),
         start_time=datetime.now(timezone.utc),
     )
-    shift.save_to_firestore()
+    with UnitOfWork() as uow:
+        shift.save_to_firestore(uow)
 
-    # Update the user's active_shift to the new shift ID
-    user.active_shift = shift.shift_id
-    user.update_in_firestore()
+        # Update the user's active_shift to the new shift ID
+        user.active_shift = shift.shift_id
+        user.update_in_firestore(uow)
 
     bot.send_message(
         message.chat.id,
@@ -366,6 +354,11 @@ def start_shift(user: User, message: telebot.types.Message) -> None:
     )
 
 
+# When to recount the shift totals on end_shift: "always" or "empty", i.e. only
+# when no trips were counted
+SHIFT_TOTALS_RECONCILE = os.environ.get("SHIFT_TOTALS_RECONCILE", "empty")
+
+
 def end_shift(user: User, message: telebot.types.Message):
 
     if user.active_trip:
@@ -391,15 +384,18 @@ def end_shift(user: User, message: telebot.types.Message):
 
     shift.end_time = datetime.now(timezone.utc)
 
-    # Get all trips within the shift and calculate total trips and fare
-    trips = shift.get_all_trips()
-    shift.total_trips = len(trips)
-    shift.total_fare = sum(trip.fare for trip in trips if trip.fare is not None)
-    shift.update_in_firestore()
+    # The totals are maintained by process_fare_input, only recount them on the
+    # server when they look wrong
+    if SHIFT_TOTALS_RECONCILE == "always" or shift.total_trips == 0:
+        shift.reconcile_totals()
+
+    with UnitOfWork() as uow:
+        shift.update_in_firestore(uow)
+        user.add_shift_to_rollups(shift, uow)
 
-    # Unassign active_trip in the 'taxi-users' document
-    user.active_shift = None
-    user.update_in_firestore()
+        # Unassign active_trip in the 'taxi-users' document
+        user.active_shift = None
+        user.update_in_firestore(uow)
 
     shift_summary = f"""
 收工啦，辛苦晒！\n今日總共做咗 {shift.total_trips} 單生意，\n埋單總數 {shift.total_fare:.2f} 蚊。\n唞夠聽日再嚟過啦！
@@ -426,9 +422,14 @@ def handle_location(user: User, message: telebot.types.Message) -> None:
 
     shift = Shift.get_shift_by_id(user.active_shift)
 
-    location = get_osm_location(latitude, longitude)
+    if GEOCODING_MODE == "deferred":
+        # An unknown address is resolved once the trip is recorded, trips outside
+        # Hong Kong keep their coordinates
+        location = resolve_now(latitude, longitude)
+    else:
+        location = reverse_geocode(latitude, longitude)
 
-    if not location:
+    if not location and GEOCODING_MODE != "deferred":
         logging.warning(
             f"Latitude {latitude} Longitude {longitude} not found in Hong Kong."
         )
@@ -494,7 +495,7 @@ def handle_start_trip(
     message,
     user: User,
     shift: Shift,
-    location: str,
+    location: Optional[str],
     latitude: Optional[float] = None,
     longitude: Optional[float] = None,
 ) -> None:
@@ -507,16 +508,20 @@ def handle_start_trip(
         start_address=location,
         start_time=datetime.now(timezone.utc),
     )
-    trip.save_to_firestore()
+    with UnitOfWork() as uow:
+        trip.save_to_firestore(uow)
+
+        # Update active_trip in the user object and Firestore
+        user.active_trip = trip.trip_id
+        user.await_location_input = False
+        user.update_in_firestore(uow)
 
-    # Update active_trip in the user object and Firestore
-    user.active_trip = trip.trip_id
-    user.await_location_input = False
-    user.update_in_firestore()
+    if location is None:
+        address_resolver.submit(trip.trip_id, "start_address", latitude, longitude)
 
     bot.send_message(
         message.chat.id,
-        f"好，{location} 出發！記得撳『落客』入數啊！",
+        f"好，{format_location(location, latitude, longitude)} 出發！記得撳『落客』入數啊！",
         reply_markup=create_keyboard(user),
     )
 
@@ -525,7 +530,7 @@ def handle_end_trip(
     message,
     user: User,
     shift: Shift,  # pylint: disable=unused-argument
-    location: str,
+    location: Optional[str],
     latitude: Optional[float] = None,
     longitude: Optional[float] = None,
 ) -> None:
@@ -553,12 +558,16 @@ def handle_end_trip(
     trip.end_longitude = longitude
     trip.end_address = location
     trip.end_time = datetime.now(timezone.utc)
-    trip.update_in_firestore()
 
-    # Increment total_trips and update total_fare in the user object and Firestore
-    user.await_location_input = False
-    user.await_fare_input = True
-    user.update_in_firestore()
+    with UnitOfWork() as uow:
+        trip.update_in_firestore(uow)
+
+        user.await_location_input = False
+        user.await_fare_input = True
+        user.update_in_firestore(uow)
+
+    if location is None:
+        address_resolver.submit(trip.trip_id, "end_address", latitude, longitude)
 
     bot.send_message(
         message.chat.id,
@@ -577,18 +586,20 @@ def process_fare_input(
         if fare <= 0:
             raise ValueError("Fare must be a positive number.")
 
-        trip.fare = fare
-        trip.update_in_firestore()
+        # Commit the trip, shift and user in one batch so that a failure cannot
+        # leave the user with a dangling active trip
+        with UnitOfWork() as uow:
+            trip.fare = fare
+            trip.update_in_firestore(uow)
 
-        shift.total_trips += 1
-        shift.total_fare += fare
-        shift.update_in_firestore()
+            shift.increment(total_trips=1, total_fare=fare)
+            shift.update_in_firestore(uow)
 
-        user.total_trips += 1
-        user.total_fare += fare
-        user.active_trip = None
-        user.await_fare_input = False
-        user.update_in_firestore()
+            user.increment(total_trips=1, total_fare=fare)
+            user.add_trip_to_rollups(trip, uow)
+            user.active_trip = None
+            user.await_fare_input = False
+            user.update_in_firestore(uow)
 
         bot.send_message(
             message.chat.id,
@@ -607,135 +618,383 @@ def process_fare_input(
         )
 
 
+def format_rollup(title: str, data: Dict[str, Any]) -> str:
+    """Formats an earnings rollup as a message paragraph."""
+    summary = summarise_rollup(data)
+    if not summary["total_trips"] and not summary["total_shifts"]:
+        return f"{title}：未有記錄"
+    lines = [
+        f"{title}：做咗 {summary['total_trips']} 單，埋單 ${summary['total_fare']:,.2f}",
+        f"開工 {summary['shift_hours']:.1f} 個鐘，平均每單 ${summary['average_fare']:,.2f}",
+    ]
+    if summary["busiest_hours"]:
+        hours = "、".join(f"{hour:02d}:00" for hour in summary["busiest_hours"])
+        lines.append(f"最旺時段：{hours}")
+    return "\n".join(lines)
+
+
+def stats(user: User, message: telebot.types.Message) -> None:
+    """Sends today's and this month's earnings from the rollups."""
+    rollups = user.get_rollups(datetime.now(timezone.utc))
+    bot.send_message(
+        message.chat.id,
+        f"{format_rollup('今日', rollups['day'])}\n\n"
+        f"{format_rollup('今個月', rollups['month'])}",
+    )
+
+
+# Pickups binned per driver, refreshed with newly ended trips rather than rebuilt
+hotspot_cache = HotspotCache(
+    max_size=int(os.environ.get("HOTSPOT_CACHE_MAX_SIZE", 256)),
+    ttl=float(os.environ.get("HOTSPOT_CACHE_TTL", 6 * 60 * 60)),
+)
+HOTSPOT_CELL_SIZE = float(os.environ.get("HOTSPOT_CELL_SIZE", 500))
+HOTSPOT_MIN_TRIPS = int(os.environ.get("HOTSPOT_MIN_TRIPS", 20))
+WEEKDAYS = "一二三四五六日"
+
+
+def get_hotspot_index(user: User) -> "HotspotIndex":
+    """Gets the hotspot index of a user, importing NumPy on first use."""
+    # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+    from hotspots import HOTSPOT_FIELDS, HotspotIndex
+
+    index = hotspot_cache.get(user.user_id)
+    if index is None:
+        index = HotspotIndex(project=hk1980_grid, cell_size=HOTSPOT_CELL_SIZE)
+    with tracer.span("hotspots.refresh"):
+        added = index.add_trips(
+            user.iter_trip_dicts(
+                field_paths=HOTSPOT_FIELDS, ended_after=index.watermark
+            )
+        )
+    logging.info(f"Binned {added} new pickups of user {user.user_id}")
+    hotspot_cache.put(user.user_id, index)
+    return index
+
+
+def hotspots(user: User, message: telebot.types.Message) -> None:
+    """Sends the pickup areas with the highest expected fare per hour around now."""
+    index = get_hotspot_index(user)
+    if len(index) < HOTSPOT_MIN_TRIPS:
+        bot.send_message(
+            message.chat.id,
+            f"未夠記錄計熱點，做多幾單先啦！（要 {HOTSPOT_MIN_TRIPS} 單，而家有 {len(index)} 單）",
+        )
+        return
+
+    now = datetime.now(timezone.utc)
+    with tracer.span("hotspots.top"):
+        cells = index.top(now, limit=5)
+    if not cells:
+        bot.send_message(message.chat.id, "呢個鐘數未有記錄，遲啲再試下啦！")
+        return
+    local = now.astimezone(HK_TZ)
+    lines = [f"星期{WEEKDAYS[local.weekday()]} {local:%H}:00 前後最多客嘅地方："]
+    for rank, cell in enumerate(cells, start=1):
+        lines.append(
+            f"{rank}. {cell['address'] or '附近'}：每個鐘平均 ${cell['fare_per_hour']:,.2f}"
+            f"（{cell['trips']} 單，平均每單 ${cell['average_fare']:,.2f}）"
+        )
+    bot.send_message(message.chat.id, "\n".join(lines))
+
+
+# Set to "zip" to send exports as a zipped csv
+EXPORT_COMPRESSION = os.environ.get("EXPORT_COMPRESSION", "none")
+
+
 def get_trips(
     user: User, message: telebot.types.Message, skip_exported: bool = False
 ) -> None:
     """Retrieves trips associated with this user from Firestore, optionally skipping exported trips."""
 
-    hk_tz = pytz.timezone("Asia/Hong_Kong")
-    trips = user.get_all_trips(skip_exported=skip_exported)
+    trips = user.iter_trip_dicts(skip_exported=skip_exported, field_paths=EXPORT_FIELDS)
+    file, file_name, count, last_end_time = export_trips_csv(
+        trips, compress=EXPORT_COMPRESSION == "zip"
+    )
 
-    if not trips:
+    if not count:
+        file.close()
         bot.send_message(message.chat.id, "你未有最近嘅記錄。")
         return
 
-    trips.sort(key=lambda trip: trip.start_time, reverse=True)
-    csv_data = StringIO()
-    writer = csv.writer(csv_data)
-    writer.writerow(
-        [
-            "Shift ID",
-            "Trip ID",
-            "Start Time",
-            "Start Address",
-            "End Time",
-            "End Address",
-            "Fare",
-        ]
-    )
-    for trip in trips:
-        trip_data = trip.model_dump()
-        start_time_str = (
-            trip_data["start_time"].astimezone(hk_tz).strftime("%Y-%m-%d %H:%M:%S")
-            if trip_data["start_time"]
-            else "N/A"
-        )
-        end_time_str = (
-            trip_data["end_time"].astimezone(hk_tz).strftime("%Y-%m-%d %H:%M:%S")
-            if trip_data["end_time"]
-            else "N/A"
+    def on_sent() -> None:
+        # Advance the export cursor past the exported trips only once they are
+        # sent, so that the trips of a send given up or dropped are exported again
+        User.record_sent_export(
+            str(user.user_id), count, last_end_time, skip_exported=skip_exported
         )
-        fare_str = f'${trip_data["fare"]:.2f}' if trip_data["fare"] else "N/A"
-        writer.writerow(
-            [
-                trip.shift_id,
-                trip.trip_id,
-                start_time_str,
-                trip.start_address,
-                end_time_str,
-                trip.end_address,
-                fare_str,
-            ]
+        bot.send_message(message.chat.id, "記錄已成功匯出。")
+
+    # Send the CSV file, which is closed once sent
+    bot.send_document(
+        message.chat.id,
+        telebot.types.InputFile(file, file_name=file_name),
+        on_sent=on_sent,
+    )
+
+
+# Commands timed and counted under their own name, any other text under "text"
+# so that the stats cannot grow with whatever users type
+KNOWN_COMMANDS = frozenset(["/start", *(command.command for command in COMMANDS)])
+
+
+def get_update_handler_name(update: telebot.types.Update) -> str:
+    """Gets the name of the handler of an update, for stats."""
+    if update.message.content_type == "text" and update.message.text in KNOWN_COMMANDS:
+        return update.message.text
+    return update.message.content_type
+
+
+def process_update(
+    update: telebot.types.Update, webhook_reply: bool = False
+) -> Optional[Dict[str, Any]]:
+    """Processes a Telegram update, retrying once if the session cache was stale.
+
+    With webhook_reply, returns the last reply as a Bot API method for the webhook
+    response instead of sending it.
+    """
+    handler_name = get_update_handler_name(update)
+    with (
+        tracer.trace(handler_name, update.update_id),
+        write_stats.track(handler_name),
+        outbox.collect(),
+    ):
+        try:
+            dispatch_update(update)
+        except StaleSessionError as err:
+            logging.warning(f"Retrying update {update.update_id}: {err}")
+            outbox.discard()
+            dispatch_update(update)
+        # Queued sends to the chat must not be overtaken by the webhook response
+        reply = outbox.flush(
+            reply=webhook_reply
+            and TELEGRAM_REPLY_MODE == "webhook"
+            and send_scheduler.idle(update.message.chat.id)
         )
+    logging.debug(f"Session cache stats: {session_cache.stats()}")
+    logging.debug(f"Write stats: {write_stats.stats()}")
+    logging.debug(f"Outbox stats: {outbox.stats()}")
+    logging.debug(f"Send scheduler stats: {send_scheduler.stats()}")
+    return reply
+
+
+def dispatch_update(update: telebot.types.Update) -> None:
+    """Dispatches a Telegram update to the matching handler."""
+    # pylint: disable=too-many-branches
+    user = User.get_or_create_from_message_user(update.message.from_user)
+
+    if update.message.content_type == "location":
+        logging.info(f"Location received from user {user.user_id} {user.first_name}")
+        handle_location(user=user, message=update.message)
+    elif update.message.content_type == "text":
+        match update.message.text:
+            case "/start":
+                logging.info(
+                    f"`/start` received from user {user.user_id} {user.first_name}"
+                )
+                start(user=user, message=update.message)
+            case "/start_shift":
+                logging.info(
+                    f"`/start_shift` received from user {user.user_id} {user.first_name}"
+                )
+                start_shift(user=user, message=update.message)
+            case "/end_shift":
+                logging.info(
+                    f"`/end_shift` received from user {user.user_id} {user.first_name}"
+                )
+                end_shift(user=user, message=update.message)
+            case "/get_all_trips":
+                logging.info(
+                    f"`/get_all_trips` received from user {user.user_id} {user.first_name}"
+                )
+                get_trips(user=user, message=update.message)
+            case "/stats":
+                logging.info(
+                    f"`/stats` received from user {user.user_id} {user.first_name}"
+                )
+                stats(user=user, message=update.message)
+            case "/hotspots":
+                logging.info(
+                    f"`/hotspots` received from user {user.user_id} {user.first_name}"
+                )
+                hotspots(user=user, message=update.message)
+            case "/get_trips":
+                logging.info(
+                    f"`/get_trips` received from user {user.user_id} {user.first_name}"
+                )
+                get_trips(user=user, message=update.message, skip_exported=True)
+            case _:
+                logging.info(
+                    f"Text received from user {user.user_id} {user.first_name}"
+                )
+                logging.info(f"Await location input: {user.await_location_input}")
+                logging.info(f"Await fare input: {user.await_fare_input}")
+                if user.await_location_input:
+                    handle_custom_location(user=user, message=update.message)
+                elif user.await_fare_input:
+                    active_shift = Shift.get_shift_by_id(user.active_shift)
+                    active_trip = Trip.get_trip_by_id(user.active_trip)
+                    if not (
+                        (active_shift is None)
+                        or (active_trip is None)
+                        or (active_trip.end_time is None)
+                    ):
+                        process_fare_input(
+                            message=update.message,
+                            user=user,
+                            shift=active_shift,
+                            trip=active_trip,
+                        )
+
+
+# In async mode the webhook acknowledges updates straight away and a background
+# worker pool processes them, in order per chat. On Cloud Functions this needs
+# CPU to stay allocated after the response (--no-cpu-throttling). When the queue
+# is full, Telegram is asked to redeliver later rather than breaking chat order.
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "sync")
+
+
+def process_queued_update(update: telebot.types.Update) -> None:
+    """Handles an update acknowledged before processing, in WEBHOOK_MODE=async."""
+    process_update(update)
+    update_dedup.complete(update.update_id)
+
+
+update_queue = ChatOrderedQueue(
+    handler=process_queued_update,
+    max_workers=int(os.environ.get("UPDATE_QUEUE_MAX_WORKERS", 8)),
+    max_pending=int(os.environ.get("UPDATE_QUEUE_MAX_PENDING", 1000)),
+)
 
-    # Send the CSV file
-    csv_data.seek(0)
-    file = telebot.types.InputFile(csv_data, file_name="trips.csv")
-    bot.send_document(message.chat.id, file)
+# Telegram redelivers updates that were not acknowledged in time. Each update is
+# claimed by its update_id before dispatch, in-process and, in shared mode, with
+# one Firestore marker created if absent, so that a redelivery is acknowledged
+# without processing. A redelivery while this instance still handles the update
+# is refused, and a failed update's claim is released, so that Telegram sends it
+# again.
+update_dedup = UpdateDeduplicator(
+    mode=os.environ.get("UPDATE_DEDUP_MODE", "shared"),
+    collection=(
+        (lambda: get_db().collection(PROCESSED_UPDATES_COLLECTION_NAME))
+        if STORAGE_BACKEND == "firestore"
+        else None
+    ),
+    max_size=int(os.environ.get("UPDATE_DEDUP_MAX_SIZE", 10000)),
+    ttl=float(os.environ.get("UPDATE_DEDUP_TTL", 24 * 60 * 60)),
+    lease=float(os.environ.get("UPDATE_DEDUP_LEASE", 60)),
+)
+
+
+# Token expected in the X-Metrics-Token header of GET /metrics, the endpoint is
+# disabled when unset
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics(request):
+    """Returns the latency histograms and cache, write and queue stats."""
+    if not METRICS_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if request.headers.get("X-Metrics-Token") != METRICS_TOKEN:
+        return jsonify({"error": "Forbidden"}), 403
+    return (
+        jsonify(
+            {
+                "latency": tracer.stats(),
+                "writes": write_stats.stats(),
+                "session_cache": session_cache.stats(),
+                "outbox": outbox.stats(),
+                "send_scheduler": send_scheduler.stats(),
+                "update_dedup": update_dedup.stats(),
+                "hotspot_cache": hotspot_cache.stats(),
+                "geocode_cache": geocode_cache.stats(),
+                "geocoding": geocoding_client.stats(),
+                "address_resolver": address_resolver.stats(),
+                "update_queue": update_queue.stats(),
+                "polling": polling_runner.stats(),
+            }
+        ),
+        200,
+    )
 
-    # Append the current export date to User.export_history
-    current_export_time = datetime.now(timezone.utc)
-    user.export_history.append(current_export_time)
-    user.update_in_firestore()
 
-    bot.send_message(message.chat.id, "記錄已成功匯出。")
+def submit_update(update: telebot.types.Update):
+    """Queues an update for the background workers and acknowledges it."""
+    if not update_queue.submit(update.message.chat.id, update):
+        logging.warning(f"Update queue full: {update_queue.stats()}")
+        update_dedup.release(update.update_id)
+        return jsonify({"error": "Too many pending updates"}), 503
+    logging.debug(f"Update queue stats: {update_queue.stats()}")
+    return jsonify({"status": "OK"}), 200
 
 
 @app.route("/handle_telegram_update", methods=["POST"])
-def handle_telegram_update(request):
+def handle_telegram_update(request):  # pylint: disable=too-many-return-statements
     """Handles incoming Telegram updates using webhooks."""
+    setup_cloud_logging()
+    # Cloud Functions sends every path to this entry point
+    if request.method == "GET" and request.path.rstrip("/").endswith("/metrics"):
+        return get_metrics(request)
     if request.method == "POST":
         update = telebot.types.Update.de_json(request.get_json())
-        user = User.get_or_create_from_message_user(update.message.from_user)
-
-        if update.message.content_type == "location":
-            logging.info(
-                f"Location received from user {user.user_id} {user.first_name}"
-            )
-            handle_location(user=user, message=update.message)
-        elif update.message.content_type == "text":
-            match update.message.text:
-                case "/start":
-                    logging.info(
-                        f"`/start` received from user {user.user_id} {user.first_name}"
-                    )
-                    start(user=user, message=update.message)
-                case "/start_shift":
-                    logging.info(
-                        f"`/start_shift` received from user {user.user_id} {user.first_name}"
-                    )
-                    start_shift(user=user, message=update.message)
-                case "/end_shift":
-                    logging.info(
-                        f"`/end_shift` received from user {user.user_id} {user.first_name}"
-                    )
-                    end_shift(user=user, message=update.message)
-                case "/get_all_trips":
-                    logging.info(
-                        f"`/get_all_trips` received from user {user.user_id} {user.first_name}"
-                    )
-                    get_trips(user=user, message=update.message)
-                case "/get_trips":
-                    logging.info(
-                        f"`/get_trips` received from user {user.user_id} {user.first_name}"
-                    )
-                    get_trips(user=user, message=update.message, skip_exported=True)
-                case _:
-                    logging.info(
-                        f"Text received from user {user.user_id} {user.first_name}"
-                    )
-                    logging.info(f"Await location input: {user.await_location_input}")
-                    logging.info(f"Await fare input: {user.await_fare_input}")
-                    if user.await_location_input:
-                        handle_custom_location(user=user, message=update.message)
-                    elif user.await_fare_input:
-                        active_shift = Shift.get_shift_by_id(user.active_shift)
-                        active_trip = Trip.get_trip_by_id(user.active_trip)
-                        if not (
-                            (active_shift is None)
-                            or (active_trip is None)
-                            or (active_trip.end_time is None)
-                        ):
-                            process_fare_input(
-                                message=update.message,
-                                user=user,
-                                shift=active_shift,
-                                trip=active_trip,
-                            )
-        return jsonify({"status": "OK"}), 200
+        if update is None or update.message is None:
+            return jsonify({"status": "OK"}), 200
+
+        claim = update_dedup.claim(update.update_id, update.message.chat.id)
+        if claim == COMPLETED:
+            logging.info(f"Suppressed duplicate update {update.update_id}")
+            logging.debug(f"Update dedup stats: {update_dedup.stats()}")
+            return jsonify({"status": "OK"}), 200
+        if claim != CLAIMED:
+            logging.info(f"Update {update.update_id} is already being processed")
+            return jsonify({"error": "Update is being processed"}), 503
+
+        if WEBHOOK_MODE == "async":
+            return submit_update(update)
+
+        try:
+            # Telegram sends the method in the response body, saving a round trip
+            reply = process_update(update, webhook_reply=True)
+        except Exception:
+            # Let Telegram's redelivery of a failed update through
+            update_dedup.release(update.update_id)
+            raise
+        update_dedup.complete(update.update_id)
+        return jsonify(reply or {"status": "OK"}), 200
     return jsonify({"error": "Method not allowed"}), 405
 
 
+def handle_polled_update(data: Dict[str, Any]) -> None:
+    """Handles an update received by long polling."""
+    update = telebot.types.Update.de_json(data)
+    if update is None or update.message is None:
+        return
+    process_update(update)
+
+
+# Set to "polling" to run on a single VM, consuming getUpdates instead of serving
+# the webhook
+UPDATE_SOURCE = os.environ.get("UPDATE_SOURCE", "webhook")
+
+polling_runner = PollingRunner(
+    BOT_TOKEN,
+    handle_polled_update,
+    # Telebot's API URL, so that a local stub serves both polls and sends
+    api_url=os.environ.get("TELEGRAM_API_URL", DEFAULT_API_URL),
+    max_concurrency=int(os.environ.get("POLLING_MAX_CONCURRENCY", 16)),
+    max_pending=int(os.environ.get("POLLING_MAX_PENDING", 1000)),
+    poll_timeout=int(os.environ.get("POLLING_TIMEOUT", 30)),
+)
+
+
 if __name__ == "__main__":
 
-    app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+    if UPDATE_SOURCE == "polling":
+        setup_cloud_logging()
+        if GEOCODING_MODE == "deferred":
+            address_resolver.start_sweeps()
+        asyncio.run(polling_runner.run())
+        address_resolver.join(timeout=60)
+        send_scheduler.join(timeout=60)
+    else:
+        app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,751 @@
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import os
+from firebase_admin import firestore
+from google.cloud.firestore_v1 import DELETE_FIELD
+from typing import (
+    Any,
+    ClassVar,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Self,
+    Tuple,
+)
+import telebot
+from pydantic import BaseModel, PrivateAttr, field_validator
+from rollups import (
+    PERIODS,
+    ROLLUP_COLLECTION_NAME,
+    period_id,
+    rollup_fields,
+    shift_amounts,
+    trip_amounts,
+)
+from schema_migrations import (
+    SCHEMA_VERSION_FIELD,
+    SHIFT_SCHEMA_VERSION,
+    SHIFT_UPGRADES,
+    TRIP_SCHEMA_VERSION,
+    TRIP_UPGRADES,
+    USER_SCHEMA_VERSION,
+    USER_UPGRADES,
+    Upgrade,
+    upgrade_document,
+)
+from session_cache import SessionCache, StaleSessionError
+from storage import ConflictError, Document, FirestoreRepository, Repository
+from tracing import Tracer
+from write_stats import WriteStats
+
+# Firestore is connected on first use rather than at import, to keep cold starts
+# free of credential lookups
+DB_NAME = f"taxi-{os.environ.get('ENV', 'dev')}"
+
+
+@lru_cache(maxsize=None)
+def get_db() -> firestore.Client:
+    """Gets the Firestore client, creating it on first use."""
+    return firestore.Client(database=DB_NAME)
+
+
+# "firestore", or "sqlite" for a single-box deployment keeping the documents in
+# an embedded database at SQLITE_PATH
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "taxi.db")
+
+
+@lru_cache(maxsize=None)
+def get_repository() -> Repository:
+    """Gets the storage of the model documents, selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        # pylint: disable=import-outside-toplevel
+        from sqlite_storage import SQLiteRepository
+
+        return SQLiteRepository(SQLITE_PATH)
+    return FirestoreRepository(get_db)
+
+
+USER_COLLECTION_NAME = "users"
+TRIP_COLLECTION_NAME = "trips"
+SHIFT_COLLECTION_NAME = "shifts"
+EXPORT_COLLECTION_NAME = "exports"
+
+# Writes of an export record conflicting with a handler are retried this often
+RECORD_EXPORT_ATTEMPTS = 3
+
+# Write-through cache of the documents touched while serving updates. In strict
+# mode every update is conditional on the cached update time, so that a document
+# modified by another instance is detected and refreshed instead of overwritten.
+session_cache = SessionCache(
+    mode=os.environ.get("SESSION_CACHE_MODE", "strict"),
+    max_size=int(os.environ.get("SESSION_CACHE_MAX_SIZE", 1024)),
+    ttl=float(os.environ.get("SESSION_CACHE_TTL", 300)),
+)
+
+# Fields and bytes written per handler, see FirestoreModel.update_cached
+write_stats = WriteStats()
+
+# Latency of each update and of the Firestore, geocoding and Telegram calls in it
+tracer = Tracer(slow_threshold=float(os.environ.get("TRACE_SLOW_THRESHOLD", 1)))
+
+# In trusted mode, documents at the current schema version are loaded without
+# validation, as only the bot writes them and it does so through these models.
+# Older documents are always upgraded and validated. Set to "validate" to
+# validate every document.
+DESERIALIZATION_MODE = os.environ.get("DESERIALIZATION_MODE", "trusted")
+
+
+@lru_cache(maxsize=None)
+def _construct_template(model: type) -> Tuple[frozenset, Dict[str, Any], list]:
+    fields = frozenset(model.model_fields)
+    defaults = {
+        name: field.get_default(call_default_factory=True)
+        for name, field in model.model_fields.items()
+        if not field.is_required()
+    }
+    private = [
+        (name, attr.default_factory, attr.default)
+        for name, attr in model.__private_attributes__.items()
+    ]
+    return fields, defaults, private
+
+
+class FirestoreModel(BaseModel):
+    # Upgrades of older documents on read, see schema_migrations
+    schema_upgrades: ClassVar[List[Upgrade]] = []
+    schema_version: int = 0
+
+    _update_time: Optional[datetime] = PrivateAttr(default=None)
+    _increments: Dict[str, float] = PrivateAttr(default_factory=dict)
+    # Field values as last read from or written to Firestore
+    _snapshot: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    # Schema upgrade changes not written back yet
+    _upgrade_changes: Dict[str, Any] = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def is_trusted(cls, data: Dict[str, Any]) -> bool:
+        """Checks if document data can be loaded without validation."""
+        return DESERIALIZATION_MODE == "trusted" and data.get(
+            SCHEMA_VERSION_FIELD, 0
+        ) == len(cls.schema_upgrades)
+
+    @classmethod
+    def construct_trusted(cls, data: Dict[str, Any]) -> Self:
+        """Creates a model from trusted document data without validation.
+
+        Sets the same instance state as model_construct, which is slower than
+        validating as it resolves the fields of the model on every call.
+        """
+        fields, defaults, private = _construct_template(cls)
+        if not data.keys() <= fields:
+            data = {field: value for field, value in data.items() if field in fields}
+        values = defaults.copy()
+        values.update(data)
+        model = cls.__new__(cls)
+        object.__setattr__(model, "__dict__", values)
+        object.__setattr__(model, "__pydantic_fields_set__", set(data))
+        object.__setattr__(model, "__pydantic_extra__", None)
+        object.__setattr__(
+            model,
+            "__pydantic_private__",
+            {
+                name: factory() if factory is not None else default
+                for name, factory, default in private
+            },
+        )
+        return model
+
+    @classmethod
+    def from_firestore_data(cls, data: Dict[str, Any]) -> Self:
+        """Creates a model from document data, upgrading and validating older documents.
+
+        The upgrade is only written back with the next update of the document.
+        """
+        if cls.is_trusted(data):
+            return cls.construct_trusted(data)
+        data, changes = upgrade_document(cls.schema_upgrades, data)
+        model = cls.model_validate(data)
+        model._upgrade_changes = changes  # pylint: disable=protected-access
+        return model
+
+    @classmethod
+    def from_firestore_doc(cls, doc: Document) -> Optional[Self]:
+        """Creates a model from a stored document."""
+        if doc.exists:
+            return cls.from_firestore_data(doc.to_dict())
+        return None
+
+    @classmethod
+    def from_firestore_docs(cls, docs: Iterable[Document]) -> List[Self]:
+        """Creates models from the documents of a query, which all exist."""
+        return [cls.from_firestore_data(doc.to_dict()) for doc in docs]
+
+    @classmethod
+    def get_cached(cls, collection_name: str, doc_id: str) -> Optional[Self]:
+        """Gets a model from the session cache, reading Firestore on a miss."""
+        cached = session_cache.get(collection_name, doc_id)
+        if cached is not None:
+            model, update_time = cached
+            model._update_time = update_time  # pylint: disable=protected-access
+            return model
+
+        with tracer.span(f"firestore.get.{collection_name}"):
+            doc = get_repository().get(collection_name, doc_id)
+        model = cls.from_firestore_doc(doc)
+        if model is not None:
+            # pylint: disable=protected-access
+            model._update_time = doc.update_time
+            model._snapshot = model.model_dump()
+            session_cache.put(collection_name, doc_id, model, doc.update_time)
+        return model
+
+    def dirty_fields(self) -> Dict[str, Any]:
+        """Gets the fields changed since the model was last read or written."""
+        data = self.model_dump()
+        if not self._snapshot:
+            return data
+        return {
+            field: value
+            for field, value in data.items()
+            if field not in self._snapshot or self._snapshot[field] != value
+        }
+
+    def increment(self, **amounts: float) -> None:
+        """Increments counter fields, written as Firestore increments on the next update."""
+        for field, amount in amounts.items():
+            setattr(self, field, getattr(self, field) + amount)
+            self._increments[field] = self._increments.get(field, 0) + amount
+
+    def set_cached(
+        self,
+        collection_name: str,
+        doc_id: str,
+        data: Dict[str, Any],
+        uow: Optional["UnitOfWork"] = None,
+    ) -> None:
+        """Creates the Firestore document and caches the model."""
+        if uow is None:
+            with UnitOfWork() as own_uow:
+                self.set_cached(collection_name, doc_id, data, uow=own_uow)
+            return
+        uow.set(self, collection_name, doc_id, data)
+
+    def update_cached(
+        self,
+        collection_name: str,
+        doc_id: str,
+        uow: Optional["UnitOfWork"] = None,
+    ) -> None:
+        """Updates the changed fields of the Firestore document and the cached model.
+
+        No write is made if no field changed.
+        """
+        data = {
+            **self.dirty_fields(),
+            **{
+                field: firestore.Increment(amount)
+                for field, amount in self._increments.items()
+            },
+        }
+        if not data:
+            write_stats.record_skipped()
+            return
+        data = {**self._upgrade_changes, **data}
+        if uow is None:
+            with UnitOfWork() as own_uow:
+                own_uow.update(self, collection_name, doc_id, data)
+            return
+        uow.update(self, collection_name, doc_id, data)
+
+
+class UnitOfWork:
+    """Collects the writes of a handler and commits them in a single batch.
+
+    In strict session cache mode updates only apply if the documents have not
+    been modified since they were read, otherwise the whole batch is rejected and
+    StaleSessionError is raised.
+    """
+
+    def __init__(self) -> None:
+        self.batch = get_repository().batch()
+        self._writes: List[Tuple[Optional[FirestoreModel], str, str]] = []
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.commit()
+
+    def set(
+        self,
+        model: Optional[FirestoreModel],
+        collection_name: str,
+        doc_id: str,
+        data: Dict[str, Any],
+    ) -> None:
+        """Adds the creation of a document to the batch, caching the model if set."""
+        self.batch.set(collection_name, doc_id, data)
+        self._writes.append((model, collection_name, doc_id))
+        write_stats.record(data)
+
+    def update(
+        self,
+        model: FirestoreModel,
+        collection_name: str,
+        doc_id: str,
+        data: Dict[str, Any],
+    ) -> None:
+        """Adds the update of a document to the batch."""
+        last_update_time = None
+        # pylint: disable=protected-access
+        if (
+            session_cache.strict
+            and model._update_time is not None
+            and (collection_name, doc_id) not in self._doc_keys()
+        ):
+            last_update_time = model._update_time
+        self.batch.update(
+            collection_name, doc_id, data, last_update_time=last_update_time
+        )
+        self._writes.append((model, collection_name, doc_id))
+        write_stats.record(data)
+
+    def increment(
+        self,
+        collection_name: str,
+        doc_id: str,
+        amounts: Dict[str, Any],
+        data: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Adds increments to a document to the batch, creating it if missing.
+
+        Amounts may be nested in dicts to increment fields of a map.
+        """
+        fields = {**(data or {}), **_to_increments(amounts)}
+        self.batch.merge(collection_name, doc_id, fields)
+        self._writes.append((None, collection_name, doc_id))
+        write_stats.record(fields)
+
+    def commit(self) -> None:
+        """Commits the batch in one round trip and updates the session cache."""
+        if not self._writes:
+            return
+        try:
+            with tracer.span("firestore.commit"):
+                update_times = self.batch.commit()
+        except ConflictError as err:
+            for collection_name, doc_id in self._doc_keys():
+                session_cache.invalidate(collection_name, doc_id, stale=True)
+            raise StaleSessionError(
+                f"Documents {self._doc_keys()} were modified elsewhere."
+            ) from err
+
+        # pylint: disable=protected-access
+        for (model, collection_name, doc_id), update_time in zip(
+            self._writes, update_times
+        ):
+            if model is None:
+                continue
+            model._update_time = update_time
+            model._increments.clear()
+            model._upgrade_changes = {}
+            model._snapshot = model.model_dump()
+            session_cache.put(collection_name, doc_id, model, update_time)
+        self._writes = []
+
+    def _doc_keys(self) -> List[Tuple[str, str]]:
+        return list(
+            dict.fromkeys(
+                (collection, doc_id) for _, collection, doc_id in self._writes
+            )
+        )
+
+
+def _to_increments(amounts: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        field: (
+            _to_increments(amount)
+            if isinstance(amount, dict)
+            else firestore.Increment(amount)
+        )
+        for field, amount in amounts.items()
+    }
+
+
+class Trip(FirestoreModel):
+    model_config = {"arbitrary_types_allowed": True}
+    schema_upgrades: ClassVar[List[Upgrade]] = TRIP_UPGRADES
+    schema_version: int = TRIP_SCHEMA_VERSION
+    trip_id: Optional[str] = None
+    shift_id: Optional[str] = None
+    user_id: str
+    start_latitude: Optional[float] = None
+    start_longitude: Optional[float] = None
+    # Unset until resolved when the address is geocoded in the background
+    start_address: Optional[str] = None
+    start_time: datetime
+    end_latitude: Optional[float] = None
+    end_longitude: Optional[float] = None
+    end_address: Optional[str] = None
+    end_time: Optional[datetime] = None
+    fare: Optional[float] = None
+
+    @field_validator("fare")
+    def validate_fare(cls, value: float):
+        """Validates that the fare is a positive number."""
+        if value is not None and value <= 0:
+            raise ValueError("Fare must be a positive number.")
+        return value
+
+    def to_firestore_dict(self):
+        """Converts the Trip object to a dictionary suitable for Firestore.
+
+        The addresses are always written, as explicit nulls until resolved, for
+        the sweep of find_unresolved_addresses to match.
+        """
+        data = self.model_dump(exclude_unset=True)
+        data["schema_version"] = self.schema_version
+        data.setdefault("start_address", self.start_address)
+        data.setdefault("end_address", self.end_address)
+        return data
+
+    def save_to_firestore(self, uow: Optional[UnitOfWork] = None):
+        """Saves or updates the Trip object in Firestore."""
+        self.trip_id = get_repository().new_id(TRIP_COLLECTION_NAME)
+        self.set_cached(
+            TRIP_COLLECTION_NAME, self.trip_id, self.to_firestore_dict(), uow=uow
+        )
+
+    @classmethod
+    def get_trip_by_id(cls, trip_id: str) -> Optional[Self]:
+        """Gets a Trip object from Firestore by its ID."""
+        return cls.get_cached(TRIP_COLLECTION_NAME, trip_id)
+
+    def update_in_firestore(self, uow: Optional[UnitOfWork] = None):
+        """Updates the corresponding Firestore document with the current User data."""
+        self.update_cached(TRIP_COLLECTION_NAME, str(self.trip_id), uow=uow)
+
+    @staticmethod
+    def fill_addresses(addresses: Dict[str, Dict[str, str]]) -> None:
+        """Writes addresses resolved in the background to their trips in one batch.
+
+        The cached trips are dropped rather than patched, as a handler may be
+        changing them, and are read again when next used.
+        """
+        batch = get_repository().batch()
+        for trip_id, fields in addresses.items():
+            batch.update(TRIP_COLLECTION_NAME, trip_id, fields)
+            write_stats.record(fields)
+        with tracer.span("firestore.commit"):
+            batch.commit()
+        for trip_id in addresses:
+            session_cache.invalidate(TRIP_COLLECTION_NAME, trip_id)
+
+    @staticmethod
+    def mark_unresolvable(fields: Dict[str, List[str]]) -> None:
+        """Records the addresses given up on, as {trip_id: [field]}, in one batch.
+
+        The null address is removed, so that sweeps no longer match it, and
+        {field}_unresolvable is set.
+        """
+        batch = get_repository().batch()
+        for trip_id, trip_fields in fields.items():
+            data = {}
+            for field in trip_fields:
+                data[field] = DELETE_FIELD
+                data[f"{field}_unresolvable"] = True
+            batch.update(TRIP_COLLECTION_NAME, trip_id, data)
+            write_stats.record(data)
+        with tracer.span("firestore.commit"):
+            batch.commit()
+        for trip_id in fields:
+            session_cache.invalidate(TRIP_COLLECTION_NAME, trip_id)
+
+    @staticmethod
+    def find_unresolved_addresses(
+        max_age: timedelta, limit: int
+    ) -> List[Tuple[str, str, float, float]]:
+        """Gets the null addresses of trips within max_age that have coordinates.
+
+        Addresses given up on by mark_unresolvable are not null any more. Returns
+        up to limit of each of start_address and end_address, as (trip_id, field,
+        latitude, longitude).
+        """
+        since = datetime.now(timezone.utc) - max_age
+        unresolved = []
+        for field, prefix in (("start_address", "start"), ("end_address", "end")):
+            docs = get_repository().query(
+                TRIP_COLLECTION_NAME,
+                [(field, "==", None), (f"{prefix}_time", ">=", since)],
+                fields=[f"{prefix}_latitude", f"{prefix}_longitude"],
+                limit=limit,
+            )
+            for doc in docs:
+                data = doc.to_dict()
+                latitude = data.get(f"{prefix}_latitude")
+                longitude = data.get(f"{prefix}_longitude")
+                if latitude is not None and longitude is not None:
+                    unresolved.append((doc.id, field, latitude, longitude))
+        return unresolved
+
+
+class Shift(FirestoreModel):
+    schema_upgrades: ClassVar[List[Upgrade]] = SHIFT_UPGRADES
+    schema_version: int = SHIFT_SCHEMA_VERSION
+    shift_id: Optional[str] = None
+    user_id: str
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    total_trips: int = 0
+    total_fare: float = 0.0
+
+    def to_firestore_dict(self):
+        """Converts the Shift object to a dictionary suitable for Firestore."""
+        data = self.model_dump(exclude_unset=True)
+        data["schema_version"] = self.schema_version
+        if data.get("start_time"):
+            data["start_time"] = firestore.SERVER_TIMESTAMP
+        if data.get("end_time"):
+            data["end_time"] = firestore.SERVER_TIMESTAMP
+        return data
+
+    @classmethod
+    def get_shift_by_id(cls, shift_id: str) -> Optional[Self]:
+        """Gets a Shift object from Firestore by its ID."""
+        return cls.get_cached(SHIFT_COLLECTION_NAME, shift_id)
+
+    def save_to_firestore(self, uow: Optional[UnitOfWork] = None):
+        """Saves or updates the Shift object in Firestore."""
+        self.shift_id = get_repository().new_id(SHIFT_COLLECTION_NAME)
+        self.set_cached(
+            SHIFT_COLLECTION_NAME, self.shift_id, self.to_firestore_dict(), uow=uow
+        )
+
+    def update_in_firestore(self, uow: Optional[UnitOfWork] = None):
+        """Updates the corresponding Firestore document with the current Shift data."""
+        self.update_cached(SHIFT_COLLECTION_NAME, str(self.shift_id), uow=uow)
+
+    def get_all_trips(self) -> List[Trip]:
+        """Retrieves all trips associated with this user from Firestore."""
+        docs = get_repository().query(
+            TRIP_COLLECTION_NAME, [("shift_id", "==", str(self.shift_id))]
+        )
+        return Trip.from_firestore_docs(docs)
+
+    def reconcile_totals(self) -> None:
+        """Recomputes total_trips and total_fare with a server-side aggregation query."""
+        with tracer.span("firestore.aggregate"):
+            self.total_trips, self.total_fare = get_repository().count_and_sum(
+                TRIP_COLLECTION_NAME,
+                [("shift_id", "==", str(self.shift_id)), ("fare", ">", 0)],
+                "fare",
+            )
+
+
+class User(FirestoreModel):
+    schema_upgrades: ClassVar[List[Upgrade]] = USER_UPGRADES
+    schema_version: int = USER_SCHEMA_VERSION
+    user_id: int
+    first_name: str
+    last_name: Optional[str]
+    username: Optional[str]
+    active_trip: Optional[str] = None
+    active_shift: Optional[str] = None
+    total_trips: int = 0
+    total_fare: float = 0.0
+    await_location_input: bool = False
+    await_fare_input: bool = False
+    # Export cursor, the full export history lives in the exports subcollection
+    last_export_time: Optional[datetime] = None
+    last_exported_end_time: Optional[datetime] = None
+
+    @classmethod
+    def get_or_create_from_message_user(cls, from_user: telebot.types.User) -> Self:
+        """Gets or creates a User object from a Telegram message user."""
+        user_id_str = str(from_user.id)
+        user = cls.get_cached(USER_COLLECTION_NAME, user_id_str)
+        if user:
+            return user
+
+        new_user_data = {
+            "user_id": from_user.id,
+            "first_name": from_user.first_name,
+            "last_name": from_user.last_name,
+            "username": from_user.username,
+            "schema_version": USER_SCHEMA_VERSION,
+        }
+        user = cls.model_validate(new_user_data)
+        user.set_cached(USER_COLLECTION_NAME, user_id_str, new_user_data)
+        return user
+
+    def update_in_firestore(self, uow: Optional[UnitOfWork] = None):
+        """Updates the corresponding Firestore document with the current User data."""
+        self.update_cached(USER_COLLECTION_NAME, str(self.user_id), uow=uow)
+
+    def get_all_shifts(self) -> List[Shift]:
+        """Retrieves all shifts associated with this user from Firestore."""
+        docs = get_repository().query(
+            SHIFT_COLLECTION_NAME, [("user_id", "==", str(self.user_id))]
+        )
+        return Shift.from_firestore_docs(docs)
+
+    def rollup_collection_name(self) -> str:
+        """Gets the path of the earnings rollups subcollection of this user."""
+        return f"{USER_COLLECTION_NAME}/{self.user_id}/{ROLLUP_COLLECTION_NAME}"
+
+    def add_trip_to_rollups(self, trip: Trip, uow: UnitOfWork) -> None:
+        """Adds a paid trip to the daily and monthly earnings rollups."""
+        for period in PERIODS:
+            uow.increment(
+                self.rollup_collection_name(),
+                period_id(period, trip.start_time),
+                trip_amounts(trip.start_time, trip.fare),
+                data=rollup_fields(period, trip.start_time, str(self.user_id)),
+            )
+
+    def add_shift_to_rollups(self, shift: Shift, uow: UnitOfWork) -> None:
+        """Adds an ended shift to the daily and monthly earnings rollups."""
+        for period, when, amounts in shift_amounts(shift.start_time, shift.end_time):
+            uow.increment(
+                self.rollup_collection_name(),
+                period_id(period, when),
+                amounts,
+                data=rollup_fields(period, when, str(self.user_id)),
+            )
+
+    def get_rollups(self, when: datetime) -> Dict[str, Dict[str, Any]]:
+        """Gets the day and month rollups containing the time in one round trip."""
+        doc_ids = {period: period_id(period, when) for period in PERIODS}
+        with tracer.span("firestore.get_all.rollups"):
+            docs = get_repository().get_many(
+                self.rollup_collection_name(), list(doc_ids.values())
+            )
+        return {period: docs.get(doc_id) or {} for period, doc_id in doc_ids.items()}
+
+    def iter_trip_dicts(
+        self,
+        skip_exported: bool = False,
+        field_paths: Optional[List[str]] = None,
+        page_size: int = 500,
+        ended_after: Optional[datetime] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Streams the trips of this user newest first, one page of documents at a time.
+
+        Only trips ending after ended_after, or after the export cursor when
+        skipping exported trips, are streamed.
+        """
+        filters = [("user_id", "==", str(self.user_id))]
+        order_by = "start_time"
+
+        if skip_exported and ended_after is None:
+            ended_after = self.last_exported_end_time
+        if ended_after:
+            # A single driver's trips never overlap, so ordering by end time is
+            # the same as ordering by start time
+            filters.append(("end_time", ">", ended_after))
+            order_by = "end_time"
+
+        last_doc = None
+        while True:
+            with tracer.span("firestore.query"):
+                docs = get_repository().query(
+                    TRIP_COLLECTION_NAME,
+                    filters,
+                    order_by=order_by,
+                    descending=True,
+                    fields=field_paths,
+                    limit=page_size,
+                    start_after=last_doc,
+                )
+            for doc in docs:
+                yield doc.to_dict()
+            if len(docs) < page_size:
+                return
+            last_doc = docs[-1]
+
+    def get_all_trips(self, skip_exported: bool = False) -> List[Trip]:
+        """Retrieves all trips associated with this user from Firestore."""
+        filters = [("user_id", "==", str(self.user_id))]
+
+        if skip_exported and self.last_exported_end_time:
+            filters.append(("end_time", ">", self.last_exported_end_time))
+
+        return Trip.from_firestore_docs(
+            get_repository().query(TRIP_COLLECTION_NAME, filters)
+        )
+
+    def record_export(
+        self,
+        trip_count: int,
+        last_exported_end_time: Optional[datetime],
+        skip_exported: bool = False,
+        uow: Optional[UnitOfWork] = None,
+    ) -> None:
+        """Advances the export cursor and adds the export to the export history."""
+        export = Export(
+            user_id=str(self.user_id),
+            export_time=datetime.now(timezone.utc),
+            trip_count=trip_count,
+            skip_exported=skip_exported,
+            last_exported_end_time=last_exported_end_time,
+        )
+        self.last_export_time = export.export_time
+        if last_exported_end_time is not None and (
+            self.last_exported_end_time is None
+            or last_exported_end_time > self.last_exported_end_time
+        ):
+            self.last_exported_end_time = last_exported_end_time
+
+        with UnitOfWork() if uow is None else nullcontext(uow) as export_uow:
+            export.save_to_firestore(export_uow)
+            self.update_in_firestore(export_uow)
+
+    @classmethod
+    def record_sent_export(
+        cls,
+        user_id: str,
+        trip_count: int,
+        last_exported_end_time: Optional[datetime],
+        skip_exported: bool = False,
+    ) -> None:
+        """Records an export once its file is sent, possibly by a send worker.
+
+        The user is read again rather than taken from the session cache, as a
+        handler may be changing the cached model, and the write is retried if the
+        user is updated in the meantime.
+        """
+        for attempt in range(1, RECORD_EXPORT_ATTEMPTS + 1):
+            session_cache.invalidate(USER_COLLECTION_NAME, user_id)
+            user = cls.get_cached(USER_COLLECTION_NAME, user_id)
+            try:
+                user.record_export(trip_count, last_exported_end_time, skip_exported)
+                return
+            except StaleSessionError:
+                if attempt == RECORD_EXPORT_ATTEMPTS:
+                    raise
+
+
+class Export(FirestoreModel):
+    export_id: Optional[str] = None
+    user_id: str
+    export_time: datetime
+    trip_count: int
+    skip_exported: bool = False
+    last_exported_end_time: Optional[datetime] = None
+
+    def save_to_firestore(self, uow: Optional[UnitOfWork] = None):
+        """Saves the Export object to the exports subcollection of its user.
+
+        Exports are never read back by the bot, so they are not cached.
+        """
+        collection_name = (
+            f"{USER_COLLECTION_NAME}/{self.user_id}/{EXPORT_COLLECTION_NAME}"
+        )
+        self.export_id = get_repository().new_id(collection_name)
+        with UnitOfWork() if uow is None else nullcontext(uow) as export_uow:
+            export_uow.set(None, collection_name, self.export_id, self.model_dump())
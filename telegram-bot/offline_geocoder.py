@@ -0,0 +1,98 @@
+import csv
+import logging
+import math
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# Bucket keys pack the column and row of a grid bucket into a single integer
+BUCKET_KEY_STRIDE = 1 << 20
+
+
+class OfflineGeocoder:
+    """In-memory nearest-address index over HK1980 grid points.
+
+    Points are sorted by grid bucket and stored in flat arrays, so a query only
+    needs to scan the few buckets within the search distance.
+    """
+
+    def __init__(
+        self,
+        eastings: array,
+        northings: array,
+        addresses: List[str],
+        bucket_size: float = 100.0,
+    ) -> None:
+        self.bucket_size = bucket_size
+        keys = [self._bucket_key(e, n) for e, n in zip(eastings, northings)]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.eastings = array("d", (eastings[i] for i in order))
+        self.northings = array("d", (northings[i] for i in order))
+        self.addresses = [addresses[i] for i in order]
+
+        self.buckets: Dict[int, Tuple[int, int]] = {}
+        start = 0
+        for end in range(1, len(order) + 1):
+            if end == len(order) or keys[order[end]] != keys[order[start]]:
+                self.buckets[keys[order[start]]] = (start, end)
+                start = end
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    @classmethod
+    def from_csv(cls, path: str, bucket_size: float = 100.0) -> "OfflineGeocoder":
+        """Loads an address point file with easting, northing and address columns."""
+        eastings = array("d")
+        northings = array("d")
+        addresses: List[str] = []
+        # Share the string objects of repeated addresses, e.g. lots of one estate
+        interned: Dict[str, str] = {}
+        with open(path, newline="", encoding="utf-8") as file:
+            for row in csv.DictReader(file):
+                try:
+                    easting = float(row["easting"])
+                    northing = float(row["northing"])
+                except (KeyError, TypeError, ValueError) as err:
+                    logging.error(f"Skipping invalid address point {row}: {err}")
+                    continue
+                address = row.get("address", "").strip()
+                if not address:
+                    continue
+                eastings.append(easting)
+                northings.append(northing)
+                addresses.append(interned.setdefault(address, address))
+        return cls(eastings, northings, addresses, bucket_size=bucket_size)
+
+    def nearest(
+        self, easting: float, northing: float, max_distance: float
+    ) -> Optional[Tuple[str, float]]:
+        """Gets the nearest address and its distance within max_distance metres."""
+        column = math.floor(easting / self.bucket_size)
+        row = math.floor(northing / self.bucket_size)
+        reach = math.ceil(max_distance / self.bucket_size)
+
+        best_index = -1
+        best_distance_sq = max_distance * max_distance
+        for bucket_column in range(column - reach, column + reach + 1):
+            for bucket_row in range(row - reach, row + reach + 1):
+                bucket = self.buckets.get(
+                    bucket_column * BUCKET_KEY_STRIDE + bucket_row
+                )
+                if bucket is None:
+                    continue
+                for i in range(*bucket):
+                    d_easting = self.eastings[i] - easting
+                    d_northing = self.northings[i] - northing
+                    distance_sq = d_easting * d_easting + d_northing * d_northing
+                    if distance_sq <= best_distance_sq:
+                        best_index = i
+                        best_distance_sq = distance_sq
+
+        if best_index < 0:
+            return None
+        return self.addresses[best_index], math.sqrt(best_distance_sq)
+
+    def _bucket_key(self, easting: float, northing: float) -> int:
+        return math.floor(easting / self.bucket_size) * BUCKET_KEY_STRIDE + math.floor(
+            northing / self.bucket_size
+        )
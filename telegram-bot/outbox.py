@@ -0,0 +1,140 @@
+import json
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+
+# Telegram rejects longer messages, these are never coalesced
+MAX_MESSAGE_LENGTH = 4096
+
+
+class Outbox:
+    """Holds back the messages sent while serving an update.
+
+    Consecutive texts to the same chat are coalesced into one message when at most
+    one of them carries a reply markup. When the update is done, the messages are
+    sent in order, except that a lone message can be returned as the webhook
+    response for Telegram to send, saving a round trip.
+    """
+
+    def __init__(
+        self,
+        send: Callable[..., Any],
+        enabled: bool = True,
+        separator: str = "\n\n",
+    ) -> None:
+        self.send = send
+        self.enabled = enabled
+        self.separator = separator
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.deferred = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.replied = 0
+
+    @contextmanager
+    def collect(self) -> Iterator[None]:
+        """Holds back the messages sent in this thread until flushed.
+
+        Messages still held when the block raises are sent before re-raising.
+        """
+        if not self.enabled:
+            yield
+            return
+        self._local.pending = []
+        try:
+            yield
+        except BaseException:
+            self.flush()
+            raise
+        finally:
+            self._local.pending = None
+
+    def defer(self, chat_id: Hashable, text: str, **kwargs: Any) -> bool:
+        """Holds back a message, returns False if it should be sent now."""
+        pending: Optional[List[Dict[str, Any]]] = getattr(self._local, "pending", None)
+        if pending is None:
+            return False
+        with self._lock:
+            self.deferred += 1
+        if pending and self._can_coalesce(pending[-1], chat_id, text, kwargs):
+            last = pending[-1]
+            last["text"] = f"{last['text'].rstrip()}{self.separator}{text.lstrip()}"
+            if kwargs.get("reply_markup") is not None:
+                last["kwargs"]["reply_markup"] = kwargs["reply_markup"]
+            with self._lock:
+                self.coalesced += 1
+            return True
+        pending.append({"chat_id": chat_id, "text": text, "kwargs": dict(kwargs)})
+        return True
+
+    def discard(self) -> None:
+        """Drops the messages held back so far, e.g. before retrying an update."""
+        if getattr(self._local, "pending", None):
+            self._local.pending = []
+
+    def flush(self, reply: bool = False) -> Optional[Dict[str, Any]]:
+        """Sends the messages held back so far.
+
+        With reply, a lone message is not sent but returned as a Bot API method
+        for the webhook response. Several messages are all sent, as the sends may
+        be queued and the response would overtake them.
+        """
+        pending = getattr(self._local, "pending", None)
+        if not pending:
+            return None
+        self._local.pending = []
+        last = pending.pop() if reply and len(pending) == 1 else None
+        for message in pending:
+            self.send(message["chat_id"], message["text"], **message["kwargs"])
+        with self._lock:
+            self.sent += len(pending)
+            self.replied += last is not None
+        return self._to_method(last) if last is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the message counters."""
+        with self._lock:
+            return {
+                "deferred": self.deferred,
+                "coalesced": self.coalesced,
+                "sent": self.sent,
+                "replied": self.replied,
+            }
+
+    def _can_coalesce(
+        self, last: Dict[str, Any], chat_id: Hashable, text: str, kwargs: Dict[str, Any]
+    ) -> bool:
+        if last["chat_id"] != chat_id:
+            return False
+        if len(last["text"]) + len(self.separator) + len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        # Only one of the messages may set the keyboard, and any other options
+        # such as parse_mode must agree
+        if (
+            last["kwargs"].get("reply_markup") is not None
+            and kwargs.get("reply_markup") is not None
+        ):
+            return False
+        other_options = {
+            key: value for key, value in kwargs.items() if key != "reply_markup"
+        }
+        last_options = {
+            key: value for key, value in last["kwargs"].items() if key != "reply_markup"
+        }
+        return other_options == last_options
+
+    @staticmethod
+    def _to_method(message: Dict[str, Any]) -> Dict[str, Any]:
+        method = {
+            "method": "sendMessage",
+            "chat_id": message["chat_id"],
+            "text": message["text"],
+        }
+        for key, value in message["kwargs"].items():
+            if value is None:
+                continue
+            method[key] = (
+                json.loads(value.to_json()) if hasattr(value, "to_json") else value
+            )
+        return method
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Set
+
+import httpx
+
+DEFAULT_API_URL = "https://api.telegram.org/bot{0}/{1}"
+
+# Seconds between retries of a failed Bot API call, doubling up to the maximum
+MIN_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+
+def chat_id_of(update: Dict[str, Any]) -> Hashable:
+    """Gets the chat of an update, updates without one are serialised by update ID."""
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("chat"), dict):
+            return value["chat"]["id"]
+    return ("update", update["update_id"])
+
+
+class PollingRunner:
+    """Consumes updates with getUpdates long polling and dispatches them on asyncio.
+
+    Updates of one chat are handled one at a time in arrival order, while up to
+    max_concurrency updates of different chats are handled in parallel on a
+    thread pool, as the handlers block on Firestore and Telegram. Only updates
+    handled up to the oldest one still waiting or running are confirmed, with the
+    next getUpdates call, so that updates lost with the process are sent again.
+    As Telegram sends the unconfirmed updates first, polling pauses while
+    batch_size updates (or max_pending if lower) are unconfirmed, so that a
+    backlog stays with Telegram.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        token: str,
+        handler: Callable[[Dict[str, Any]], None],
+        *,
+        api_url: str = DEFAULT_API_URL,
+        max_concurrency: int = 16,
+        max_pending: int = 1000,
+        poll_timeout: int = 30,
+        batch_size: int = 100,
+        allowed_updates: Optional[List[str]] = None,
+    ) -> None:
+        self.token = token
+        self.handler = handler
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.poll_timeout = poll_timeout
+        self.batch_size = batch_size
+        self.allowed_updates = allowed_updates or ["message"]
+        # Everything below the offset has been handled
+        self.offset: Optional[int] = None
+        # Received update IDs not confirmed yet in order, and the handled ones among them
+        self._unconfirmed: Deque[int] = deque()
+        self._handled: Set[int] = set()
+        self._next_update_id: Optional[int] = None
+        self._chats: Dict[Hashable, Deque[Dict[str, Any]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._capacity: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.pending = 0
+        self.max_pending_seen = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.running = 0
+        self.total_processing_time = 0.0
+        self.max_processing_time = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the polling and dispatch counters."""
+        return {
+            "offset": self.offset,
+            "polls": self.polls,
+            "poll_errors": self.poll_errors,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "pending": self.pending,
+            "unconfirmed": len(self._unconfirmed),
+            "max_pending": self.max_pending_seen,
+            "running": self.running,
+            "active_chats": len(self._chats),
+            "avg_processing_time": (
+                self.total_processing_time / self.processed if self.processed else 0.0
+            ),
+            "max_processing_time": self.max_processing_time,
+        }
+
+    def stop(self) -> None:
+        """Stops polling from any thread, the updates already received are still handled."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def run(self) -> None:
+        """Polls and dispatches updates until stopped."""
+        self._stopping = asyncio.Event()
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = self._loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="update"
+        )
+        loop.set_default_executor(executor)
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, self.stop)
+        # The read timeout covers the long poll held open by Telegram
+        timeout = httpx.Timeout(10.0, read=self.poll_timeout + 10.0)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            # getUpdates is refused while a webhook is set
+            if await self._retry(
+                client, "deleteWebhook", {"drop_pending_updates": False}
+            ):
+                await self._poll(client)
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+            if self.offset is not None:
+                # Confirm the last batch, or Telegram sends it again on restart
+                try:
+                    await self._call(
+                        client,
+                        "getUpdates",
+                        {"offset": self.offset, "timeout": 0, "limit": 1},
+                    )
+                except (httpx.HTTPError, RuntimeError) as err:
+                    logging.warning(f"Could not confirm offset {self.offset}: {err}")
+        executor.shutdown(wait=True)
+        logging.info(f"Polling stopped: {self.stats()}")
+
+    async def _retry(
+        self, client: httpx.AsyncClient, method: str, params: Dict[str, Any]
+    ) -> bool:
+        # Calls a method until it succeeds, returns False if stopped before then
+        retry_delay = MIN_RETRY_DELAY
+        while not self._stopping.is_set():
+            try:
+                await self._call(client, method, params)
+                return True
+            except (httpx.HTTPError, RuntimeError) as err:
+                logging.warning(f"{method} failed, retrying in {retry_delay}s: {err}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), retry_delay)
+            except asyncio.TimeoutError:
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+        return False
+
+    async def _poll(self, client: httpx.AsyncClient) -> None:
+        retry_delay = MIN_RETRY_DELAY
+        while not self._stopping.is_set():
+            await self._capacity.wait()
+            params = {
+                "timeout": self.poll_timeout,
+                "limit": self.batch_size,
+                "allowed_updates": self.allowed_updates,
+            }
+            if self.offset is not None:
+                params["offset"] = self.offset
+            poll = asyncio.create_task(self._call(client, "getUpdates", params))
+            stopping = asyncio.create_task(self._stopping.wait())
+            await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            if not poll.done():
+                # Updates of an abandoned poll are sent again after a restart
+                poll.cancel()
+                return
+            try:
+                updates = poll.result()
+            except (httpx.HTTPError, RuntimeError) as err:
+                self.poll_errors += 1
+                logging.warning(f"getUpdates failed, retrying in {retry_delay}s: {err}")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                continue
+            retry_delay = MIN_RETRY_DELAY
+            self.polls += 1
+            for update in updates:
+                update_id = update["update_id"]
+                if (
+                    self._next_update_id is not None
+                    and update_id < self._next_update_id
+                ):
+                    # Sent again as it is still being handled
+                    continue
+                self._next_update_id = update_id + 1
+                self._submit(update)
+
+    async def _call(
+        self, client: httpx.AsyncClient, method: str, params: Dict[str, Any]
+    ) -> Any:
+        response = await client.post(
+            self.api_url.format(self.token, method), json=params
+        )
+        try:
+            body = response.json()
+        except ValueError:
+            # e.g. an HTML error page from a proxy in front of the Bot API
+            body = {}
+        if not response.is_success or not body.get("ok"):
+            retry_after = body.get("parameters", {}).get("retry_after")
+            if retry_after:
+                await asyncio.sleep(retry_after)
+            raise RuntimeError(
+                f"{method} failed with {body.get('error_code', response.status_code)}: "
+                f"{body.get('description', response.reason_phrase)}"
+            )
+        return body["result"]
+
+    def _window(self) -> int:
+        # A poll must return at least one update beyond the unconfirmed ones
+        return min(self.max_pending, self.batch_size)
+
+    def _submit(self, update: Dict[str, Any]) -> None:
+        self.received += 1
+        self.pending += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        self._unconfirmed.append(update["update_id"])
+        if len(self._unconfirmed) >= self._window():
+            self._capacity.clear()
+        chat_id = chat_id_of(update)
+        chat_updates = self._chats.get(chat_id)
+        if chat_updates is not None:
+            chat_updates.append(update)
+            return
+        # No task owns this chat yet, start one
+        self._chats[chat_id] = deque([update])
+        task = asyncio.create_task(self._drain(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, chat_id: Hashable) -> None:
+        chat_updates = self._chats[chat_id]
+        while chat_updates:
+            update = chat_updates.popleft()
+            async with self._semaphore:
+                self.running += 1
+                start = time.perf_counter()
+                try:
+                    await asyncio.to_thread(self.handler, update)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    self.failed += 1
+                    logging.exception(f"Update {update['update_id']} failed")
+                finally:
+                    elapsed = time.perf_counter() - start
+                    self.running -= 1
+                    self.processed += 1
+                    self.total_processing_time += elapsed
+                    self.max_processing_time = max(self.max_processing_time, elapsed)
+                    self.pending -= 1
+                    self._confirm(update["update_id"])
+        del self._chats[chat_id]
+
+    def _confirm(self, update_id: int) -> None:
+        # Moves the offset past the updates handled without a gap
+        self._handled.add(update_id)
+        while self._unconfirmed and self._unconfirmed[0] in self._handled:
+            oldest = self._unconfirmed.popleft()
+            self._handled.discard(oldest)
+            self.offset = oldest + 1
+        if len(self._unconfirmed) < self._window():
+            self._capacity.set()
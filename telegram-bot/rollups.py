@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Tuple
+
+from trip_export import HK_TZ
+
+ROLLUP_COLLECTION_NAME = "rollups"
+
+# Earnings are summarised per Hong Kong calendar day and month
+PERIODS = ("day", "month")
+
+
+def period_start(period: str, when: datetime) -> datetime:
+    """Gets the start of the day or month containing the time, in Hong Kong time."""
+    local = when.astimezone(HK_TZ)
+    if period == "day":
+        return local.replace(hour=0, minute=0, second=0, microsecond=0)
+    return local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def period_id(period: str, when: datetime) -> str:
+    """Gets the ID of the rollup document of the day or month containing the time."""
+    local = when.astimezone(HK_TZ)
+    if period == "day":
+        return f"day-{local:%Y-%m-%d}"
+    return f"month-{local:%Y-%m}"
+
+
+def rollup_fields(period: str, when: datetime, user_id: str) -> Dict[str, Any]:
+    """Gets the fields identifying a rollup document."""
+    return {
+        "user_id": user_id,
+        "period": period,
+        "period_start": period_start(period, when),
+    }
+
+
+def trip_amounts(start_time: datetime, fare: float) -> Dict[str, Any]:
+    """Gets what a paid trip adds to the rollups of the period it started in."""
+    return {
+        "total_trips": 1,
+        "total_fare": fare,
+        "hour_trips": {str(start_time.astimezone(HK_TZ).hour): 1},
+    }
+
+
+def split_by_day(start: datetime, end: datetime) -> Iterator[Tuple[datetime, float]]:
+    """Splits a time range at Hong Kong midnights into (day start, seconds) pairs."""
+    day = period_start("day", start)
+    while day < end:
+        next_day = period_start("day", day + timedelta(hours=25))
+        seconds = (min(end, next_day) - max(start, day)).total_seconds()
+        if seconds > 0:
+            yield day, seconds
+        day = next_day
+
+
+def shift_amounts(
+    start_time: datetime, end_time: datetime
+) -> List[Tuple[str, datetime, Dict[str, Any]]]:
+    """Gets what a shift adds to the rollups of each period it overlaps.
+
+    Returns (period, time within the period, amounts) tuples. Hours on shift are
+    split across the days and months the shift spans, the shift itself is counted
+    in the day and month it started.
+    """
+    amounts: Dict[Tuple[str, str], Tuple[str, datetime, Dict[str, Any]]] = {}
+    for period in PERIODS:
+        amounts[(period, period_id(period, start_time))] = (
+            period,
+            start_time,
+            {"total_shifts": 1, "shift_seconds": 0.0},
+        )
+    for day, seconds in split_by_day(start_time, end_time):
+        for period in PERIODS:
+            key = (period, period_id(period, day))
+            _, _, period_amounts = amounts.setdefault(
+                key, (period, day, {"shift_seconds": 0.0})
+            )
+            period_amounts["shift_seconds"] += seconds
+    return list(amounts.values())
+
+
+def summarise(data: Dict[str, Any], busiest: int = 3) -> Dict[str, Any]:
+    """Summarises a rollup document with its average fare and busiest hours."""
+    total_trips = int(data.get("total_trips", 0))
+    total_fare = float(data.get("total_fare", 0.0))
+    hour_trips = data.get("hour_trips", {})
+    return {
+        "total_trips": total_trips,
+        "total_fare": total_fare,
+        "total_shifts": int(data.get("total_shifts", 0)),
+        "shift_hours": float(data.get("shift_seconds", 0.0)) / 3600,
+        "average_fare": total_fare / total_trips if total_trips else 0.0,
+        "busiest_hours": [
+            int(hour)
+            for hour, _ in sorted(
+                hour_trips.items(), key=lambda item: (-item[1], int(item[0]))
+            )[:busiest]
+        ],
+    }
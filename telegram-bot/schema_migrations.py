@@ -0,0 +1,99 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+SCHEMA_VERSION_FIELD = "schema_version"
+
+# An upgrade takes a document at one schema version to the next, returning the
+# new document data. Documents without a schema_version are at version 0.
+Upgrade = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+def add_defaults(defaults: Dict[str, Any]) -> Upgrade:
+    """Gets an upgrade writing out default values of fields missing from a document.
+
+    Firestore queries skip documents without a filtered or ordered field, so
+    defaults the models fill in on read are stored explicitly.
+    """
+
+    def upgrade(data: Dict[str, Any]) -> Dict[str, Any]:
+        return {**defaults, **data}
+
+    return upgrade
+
+
+def export_history_to_cursor(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Derives the export cursor of a user from a legacy export_history list.
+
+    The history itself is left in place for migrations/migrate_export_cursor.py
+    to move into the exports subcollection.
+    """
+    export_history = data.get("export_history")
+    if not export_history or data.get("last_export_time"):
+        return data
+    # Previously trips ending after the last export were not exported yet
+    return {
+        **data,
+        "last_export_time": max(export_history),
+        "last_exported_end_time": max(export_history),
+    }
+
+
+USER_UPGRADES: List[Upgrade] = [
+    add_defaults(
+        {
+            "active_trip": None,
+            "active_shift": None,
+            "total_trips": 0,
+            "total_fare": 0.0,
+            "await_location_input": False,
+            "await_fare_input": False,
+        }
+    ),
+    export_history_to_cursor,
+]
+SHIFT_UPGRADES: List[Upgrade] = [
+    add_defaults({"end_time": None, "total_trips": 0, "total_fare": 0.0}),
+]
+TRIP_UPGRADES: List[Upgrade] = [
+    add_defaults(
+        {
+            "shift_id": None,
+            "end_latitude": None,
+            "end_longitude": None,
+            "end_address": None,
+            "end_time": None,
+            "fare": None,
+        }
+    ),
+]
+
+USER_SCHEMA_VERSION = len(USER_UPGRADES)
+SHIFT_SCHEMA_VERSION = len(SHIFT_UPGRADES)
+TRIP_SCHEMA_VERSION = len(TRIP_UPGRADES)
+
+
+def upgrade_document(
+    upgrades: List[Upgrade], data: Dict[str, Any]
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Upgrades document data to the latest schema version.
+
+    Returns the upgraded data and the changes to write back, with removed fields
+    set to DELETE_FIELD. No changes are returned for an up to date document.
+    """
+    version = data.get(SCHEMA_VERSION_FIELD, 0)
+    if version >= len(upgrades):
+        return data, {}
+
+    upgraded = dict(data)
+    for upgrade in upgrades[version:]:
+        upgraded = upgrade(upgraded)
+    upgraded[SCHEMA_VERSION_FIELD] = len(upgrades)
+
+    changes: Dict[str, Any] = {
+        field: value
+        for field, value in upgraded.items()
+        if field not in data or data[field] != value
+    }
+    changes.update({field: DELETE_FIELD for field in data if field not in upgraded})
+    return upgraded, changes
@@ -0,0 +1,382 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from telebot.apihelper import ApiTelegramException
+
+# Replies to the driver go ahead of bulk sends such as CSV exports
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Seconds before the first retry of a send failing with a network or server
+# error, doubling with every attempt
+RETRY_DELAY = 1.0
+
+
+class TokenBucket:
+    """Allows rate sends per second on average, in bursts of up to capacity."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def ready_at(self, now: float) -> float:
+        """Gets the time a send is allowed at."""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        if tokens >= 1:
+            return now
+        return now + (1 - tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        """Takes a token for a send, which may put the bucket in debt."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.tokens -= 1
+        self.updated = now
+
+    def is_full(self, now: float) -> bool:
+        """Checks if the bucket refilled completely."""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+def retry_after(err: Exception) -> Optional[float]:
+    """Gets the seconds to wait before retrying a send rejected with 429."""
+    if isinstance(err, ApiTelegramException) and err.error_code == 429:
+        return float(err.result_json.get("parameters", {}).get("retry_after", 1))
+    return None
+
+
+def is_permanent(err: Exception) -> bool:
+    """Checks if a send failed for good, e.g. the driver blocked the bot."""
+    return isinstance(err, ApiTelegramException) and 400 <= err.error_code < 500
+
+
+@dataclass(slots=True)
+class SendJob:
+    """A send to a chat waiting in the scheduler."""
+
+    chat_id: Hashable
+    send: Callable[[], Any]
+    priority: int
+    seq: int
+    enqueued_at: float
+    cleanup: Optional[Callable[[], None]] = None
+    on_sent: Optional[Callable[[], None]] = None
+    attempts: int = 0
+    not_before: float = 0.0
+
+
+class SendScheduler:
+    """Sends Telegram messages from worker threads within the Bot API rate limits.
+
+    Sends are queued per chat and made in order for each chat, within a global
+    token bucket and one per chat. Among the chats allowed to send, the one whose
+    next send has the highest priority and was queued first goes first. A send
+    rejected with 429 is retried after the retry_after given by Telegram, one
+    failing with a network or server error after a backoff, up to max_attempts.
+    When disabled, sends are made straight away in the calling thread.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        enabled: bool = True,
+        global_rate: float = 30.0,
+        global_burst: float = 1.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        workers: int = 4,
+        max_queued: int = 10000,
+        max_attempts: int = 5,
+    ) -> None:
+        self.enabled = enabled
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_workers = workers
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        # A bucket allows its capacity on top of its rate in any one second, so
+        # the global one is kept small to stay under Telegram's per second limit
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets: Dict[Hashable, TokenBucket] = {}
+        self._chats: Dict[Hashable, Deque[SendJob]] = {}
+        # Chats whose next send is allowed now, as (priority, seq, chat_id), and
+        # chats waiting on their bucket or a retry, as (time, priority, seq, chat_id)
+        self._ready: List[Tuple[int, int, Hashable]] = []
+        self._delayed: List[Tuple[float, int, int, Hashable]] = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        # Runs on_sent callbacks, which may block on Firestore, off the send workers
+        self._callbacks = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="send-callback"
+        )
+        self._pending_callbacks = 0
+        self.in_flight = 0
+        self.depth = 0
+        self.depth_by_priority = {priority: 0 for priority in PRIORITY_NAMES}
+        self.max_depth = 0
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rate_limited = 0
+        self.retried = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_send_time = 0.0
+
+    def enqueue(
+        self,
+        chat_id: Hashable,
+        send: Callable[[], Any],
+        priority: int = INTERACTIVE,
+        cleanup: Optional[Callable[[], None]] = None,
+        on_sent: Optional[Callable[[], None]] = None,
+    ) -> bool:
+        """Queues a send to a chat, returns False if it was dropped as the queue is full.
+
+        cleanup is called once the send is made or given up, e.g. to close a file.
+        on_sent is called once it is made, e.g. to record it, off the send path, and
+        its errors are only logged as the message is delivered already.
+        """
+        if not self.enabled:
+            try:
+                self._send_now(send)
+            finally:
+                if cleanup is not None:
+                    cleanup()
+            if on_sent is not None:
+                self._call_on_sent(chat_id, on_sent)
+            return True
+
+        now = time.monotonic()
+        with self._condition:
+            if self.depth >= self.max_queued:
+                self.dropped += 1
+                logging.warning(f"Send queue full, dropped a send to chat {chat_id}")
+                if cleanup is not None:
+                    cleanup()
+                return False
+            job = SendJob(
+                chat_id, send, priority, next(self._seq), now, cleanup, on_sent
+            )
+            self.enqueued += 1
+            self.depth += 1
+            self.depth_by_priority[priority] += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            chat_jobs = self._chats.get(chat_id)
+            if chat_jobs is not None:
+                # The chat is scheduled already, the job goes out after the others
+                chat_jobs.append(job)
+                return True
+            self._chats[chat_id] = deque([job])
+            self._schedule(chat_id, now)
+            if len(self._workers) < self.max_workers:
+                self._start_worker()
+            self._condition.notify()
+        return True
+
+    def idle(self, chat_id: Hashable) -> bool:
+        """Checks if nothing is queued or being sent to a chat."""
+        with self._condition:
+            return chat_id not in self._chats
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every queued send is made or given up and recorded.
+
+        Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._chats or self._pending_callbacks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the queue counters."""
+        with self._condition:
+            return {
+                "depth": self.depth,
+                "depth_by_priority": {
+                    name: self.depth_by_priority[priority]
+                    for priority, name in PRIORITY_NAMES.items()
+                },
+                "max_depth": self.max_depth,
+                "chats": len(self._chats),
+                "in_flight": self.in_flight,
+                "workers": len(self._workers),
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "rate_limited": self.rate_limited,
+                "retried": self.retried,
+                "avg_wait_time": self.total_wait_time / self.sent if self.sent else 0.0,
+                "max_wait_time": self.max_wait_time,
+                "avg_send_time": self.total_send_time / self.sent if self.sent else 0.0,
+            }
+
+    def _send_now(self, send: Callable[[], Any]) -> Any:
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return send()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                delay = retry_after(err)
+                if delay is None and (
+                    is_permanent(err) or attempt == self.max_attempts
+                ):
+                    raise
+                with self._condition:
+                    self.rate_limited += delay is not None
+                    self.retried += 1
+                time.sleep(
+                    delay if delay is not None else RETRY_DELAY * 2 ** (attempt - 1)
+                )
+        return None
+
+    def _start_worker(self) -> None:
+        worker = threading.Thread(
+            target=self._work,
+            name=f"send-worker-{len(self._workers)}",
+            daemon=True,
+        )
+        self._workers.append(worker)
+        worker.start()
+
+    def _schedule(self, chat_id: Hashable, now: float) -> None:
+        job = self._chats[chat_id][0]
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst
+            )
+        ready_at = max(bucket.ready_at(now), job.not_before)
+        if ready_at <= now:
+            heapq.heappush(self._ready, (job.priority, job.seq, chat_id))
+        else:
+            heapq.heappush(self._delayed, (ready_at, job.priority, job.seq, chat_id))
+
+    def _next_job(self) -> SendJob:
+        # Called with the condition held, waits for a job allowed by both buckets
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+            wake_at = self._delayed[0][0] if self._delayed else None
+            if self._ready:
+                global_ready_at = self._global_bucket.ready_at(now)
+                if global_ready_at <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    self._global_bucket.consume(now)
+                    return self._chats[chat_id][0]
+                wake_at = min(wake_at or global_ready_at, global_ready_at)
+            self._condition.wait(None if wake_at is None else wake_at - now)
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                job = self._next_job()
+                self.in_flight += 1
+            started_at = time.monotonic()
+            error: Optional[Exception] = None
+            try:
+                job.send()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                error = err
+            finished_at = time.monotonic()
+
+            with self._condition:
+                self.in_flight -= 1
+                job.attempts += 1
+                # Sends to a chat are spaced from the time Telegram got the last
+                # one, as a slow request would otherwise arrive close to the next
+                self._chat_buckets[job.chat_id].consume(finished_at)
+                if error is not None and self._retry(job, error, finished_at):
+                    self._schedule(job.chat_id, finished_at)
+                    self._condition.notify()
+                    continue
+                if error is None:
+                    self.sent += 1
+                    wait_time = started_at - job.enqueued_at
+                    self.total_wait_time += wait_time
+                    self.max_wait_time = max(self.max_wait_time, wait_time)
+                    self.total_send_time += finished_at - started_at
+                self._finish(job, finished_at)
+                if error is None and job.on_sent is not None:
+                    self._pending_callbacks += 1
+                    self._callbacks.submit(self._run_on_sent, job.chat_id, job.on_sent)
+
+    def _run_on_sent(self, chat_id: Hashable, on_sent: Callable[[], None]) -> None:
+        try:
+            self._call_on_sent(chat_id, on_sent)
+        finally:
+            with self._condition:
+                self._pending_callbacks -= 1
+                self._condition.notify_all()
+
+    @staticmethod
+    def _call_on_sent(chat_id: Hashable, on_sent: Callable[[], None]) -> None:
+        try:
+            on_sent()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception(f"Error recording a send to chat {chat_id}")
+
+    def _retry(self, job: SendJob, error: Exception, now: float) -> bool:
+        # Called with the condition held, sets when to retry the job, if at all
+        delay = retry_after(error)
+        if delay is not None:
+            self.rate_limited += 1
+        elif is_permanent(error) or job.attempts >= self.max_attempts:
+            self.failed += 1
+            logging.error(
+                f"Giving up on a send to chat {job.chat_id} after "
+                f"{job.attempts} attempts: {error}"
+            )
+            return False
+        else:
+            delay = RETRY_DELAY * 2 ** (job.attempts - 1)
+        if job.attempts >= self.max_attempts:
+            self.failed += 1
+            logging.error(f"Giving up on a rate limited send to chat {job.chat_id}")
+            return False
+        self.retried += 1
+        job.not_before = now + delay
+        logging.warning(f"Retrying a send to chat {job.chat_id} in {delay}s: {error}")
+        return True
+
+    def _finish(self, job: SendJob, now: float) -> None:
+        # Called with the condition held, moves on to the next job of the chat
+        if job.cleanup is not None:
+            try:
+                job.cleanup()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception(f"Error cleaning up a send to chat {job.chat_id}")
+        self.depth -= 1
+        self.depth_by_priority[job.priority] -= 1
+        chat_jobs = self._chats[job.chat_id]
+        chat_jobs.popleft()
+        if chat_jobs:
+            self._schedule(job.chat_id, now)
+        else:
+            del self._chats[job.chat_id]
+            self._prune_buckets(now)
+        self._condition.notify_all()
+
+    def _prune_buckets(self, now: float) -> None:
+        # Buckets of idle chats are dropped once full, as a new one is the same
+        if len(self._chat_buckets) > 2 * len(self._chats) + 1024:
+            for chat_id, bucket in list(self._chat_buckets.items()):
+                if chat_id not in self._chats and bucket.is_full(now):
+                    del self._chat_buckets[chat_id]
@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+
+class StaleSessionError(Exception):
+    """Raised when a cached document was modified by another instance."""
+
+
+class SessionCache:
+    """Instance-local write-through cache of Firestore backed models.
+
+    Entries are keyed on collection name and document ID and carry the document
+    update time they were read or written at, so that writes can be guarded with
+    a last-update-time precondition in strict mode.
+    """
+
+    MODES = ("off", "ttl", "strict")
+
+    def __init__(self, mode: str = "strict", max_size: int = 1024, ttl: float = 300):
+        if mode not in self.MODES:
+            raise ValueError(f"Session cache mode must be one of {self.MODES}.")
+        self.mode = mode
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[
+            Tuple[str, str], Tuple[BaseModel, Optional[datetime], float]
+        ] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @property
+    def strict(self) -> bool:
+        return self.mode == "strict"
+
+    def get(
+        self, collection: str, doc_id: str
+    ) -> Optional[Tuple[BaseModel, Optional[datetime]]]:
+        """Gets a copy of the cached model and its update time."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get((collection, doc_id))
+            if entry is None or entry[2] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end((collection, doc_id))
+            self.hits += 1
+            model, update_time, _ = entry
+        return model.model_copy(deep=True), update_time
+
+    def put(
+        self,
+        collection: str,
+        doc_id: str,
+        model: BaseModel,
+        update_time: Optional[datetime],
+    ) -> None:
+        """Caches a copy of the model at the given document update time."""
+        if not self.enabled:
+            return
+        with self._lock:
+            cached = self._entries.get((collection, doc_id))
+            if (
+                cached is not None
+                and update_time is not None
+                and cached[1] is not None
+                and cached[1] > update_time
+            ):
+                # Never replace a newer version of the document
+                return
+            self._entries[(collection, doc_id)] = (
+                model.model_copy(deep=True),
+                update_time,
+                time.monotonic() + self.ttl,
+            )
+            self._entries.move_to_end((collection, doc_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, collection: str, doc_id: str, stale: bool = False) -> None:
+        """Drops the cached model, e.g. after another instance modified it."""
+        with self._lock:
+            self._entries.pop((collection, doc_id), None)
+            if stale:
+                self.stale += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the cache counters."""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale": self.stale,
+        }
@@ -0,0 +1,363 @@
+import json
+import secrets
+import sqlite3
+import string
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from google.cloud.firestore_v1 import DELETE_FIELD, SERVER_TIMESTAMP, Increment
+
+from storage import ConflictError, Filter, Repository
+
+# Datetimes are stored as fixed-width UTC strings behind a prefix, so that they
+# compare and sort correctly in SQL and are told apart from other strings on read
+DATETIME_PREFIX = "\u0001dt:"
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Fields extracted into indexed columns
+INDEXED_FIELDS = ("user_id", "shift_id", "start_time")
+
+OPERATORS = {"==": "=", ">": ">", ">=": ">=", "<": "<", "<=": "<="}
+
+ID_ALPHABET = string.ascii_letters + string.digits
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    update_time INTEGER NOT NULL,
+    user_id TEXT GENERATED ALWAYS AS (json_extract(data, '$.user_id')) VIRTUAL,
+    shift_id TEXT GENERATED ALWAYS AS (json_extract(data, '$.shift_id')) VIRTUAL,
+    start_time TEXT GENERATED ALWAYS AS (json_extract(data, '$.start_time')) VIRTUAL,
+    PRIMARY KEY (collection, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS documents_user_id
+    ON documents (collection, user_id, start_time);
+CREATE INDEX IF NOT EXISTS documents_shift_id
+    ON documents (collection, shift_id);
+"""
+
+
+def encode_value(value: Any) -> Any:
+    """Converts a field value to its JSON representation."""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return DATETIME_PREFIX + value.astimezone(timezone.utc).strftime(
+            DATETIME_FORMAT
+        )
+    if isinstance(value, dict):
+        return {field: encode_value(item) for field, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    return value
+
+
+def decode_value(value: Any) -> Any:
+    """Converts a field value back from its JSON representation."""
+    if isinstance(value, str) and value.startswith(DATETIME_PREFIX):
+        return datetime.fromisoformat(value[len(DATETIME_PREFIX) :])
+    if isinstance(value, dict):
+        return {field: decode_value(item) for field, item in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+def _micros(when: datetime) -> int:
+    return int(when.timestamp() * 1_000_000)
+
+
+def _from_micros(micros: int) -> datetime:
+    return datetime.fromtimestamp(micros / 1_000_000, tz=timezone.utc)
+
+
+def apply_transforms(
+    current: Optional[Dict[str, Any]], data: Dict[str, Any], now: datetime
+) -> Dict[str, Any]:
+    """Applies fields, possibly Firestore transforms, over the current document data."""
+    result = dict(current or {})
+    for field, value in data.items():
+        if value is DELETE_FIELD:
+            result.pop(field, None)
+        elif value is SERVER_TIMESTAMP:
+            result[field] = now
+        elif isinstance(value, Increment):
+            result[field] = (result.get(field) or 0) + value.value
+        elif isinstance(value, dict) and any(
+            isinstance(item, (dict, Increment)) or item is DELETE_FIELD
+            for item in value.values()
+        ):
+            existing = result.get(field)
+            result[field] = apply_transforms(
+                existing if isinstance(existing, dict) else None, value, now
+            )
+        else:
+            result[field] = value
+    return result
+
+
+@dataclass(slots=True)
+class SQLiteDocument:
+    """A document read from SQLite, with the interface of a Firestore snapshot."""
+
+    id: str
+    data: Optional[Dict[str, Any]]
+    update_time: Optional[datetime]
+    # Value of the ordered field, to continue a query after this document
+    order_value: Any = None
+
+    @property
+    def exists(self) -> bool:
+        """Whether the document exists."""
+        return self.data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        """Returns a copy of the document data."""
+        return dict(self.data) if self.data is not None else None
+
+
+class SQLiteWriteBatch:
+    """Writes committed in a single SQLite transaction."""
+
+    def __init__(self, repository: "SQLiteRepository") -> None:
+        self.repository = repository
+        self._writes: List[Tuple[str, str, str, Dict[str, Any], Optional[datetime]]] = (
+            []
+        )
+
+    def set(self, collection: str, doc_id: str, data: Dict[str, Any]) -> None:
+        """Adds the creation or replacement of a document."""
+        self._writes.append(("set", collection, doc_id, data, None))
+
+    def update(
+        self,
+        collection: str,
+        doc_id: str,
+        data: Dict[str, Any],
+        last_update_time: Optional[datetime] = None,
+    ) -> None:
+        """Adds an update of the fields of a document, conditional if last_update_time is set."""
+        self._writes.append(("update", collection, doc_id, data, last_update_time))
+
+    def merge(self, collection: str, doc_id: str, data: Dict[str, Any]) -> None:
+        """Adds a merge of possibly nested fields into a document, creating it if missing."""
+        self._writes.append(("merge", collection, doc_id, data, None))
+
+    def commit(self) -> List[datetime]:
+        """Commits the writes, returns the update time of each."""
+        connection = self.repository.connection()
+        update_times = []
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for operation, collection, doc_id, data, last_update_time in self._writes:
+                row = connection.execute(
+                    "SELECT data, update_time FROM documents WHERE collection = ? AND id = ?",
+                    (collection, doc_id),
+                ).fetchone()
+                if operation == "update":
+                    if row is None:
+                        raise ConflictError(
+                            f"Document {collection}/{doc_id} not found."
+                        )
+                    if last_update_time is not None and row[1] != _micros(
+                        last_update_time
+                    ):
+                        raise ConflictError(
+                            f"Document {collection}/{doc_id} was modified since "
+                            f"{last_update_time}."
+                        )
+
+                update_micros = self.repository.next_update_time(row[1] if row else 0)
+                now = _from_micros(update_micros)
+                current = (
+                    None
+                    if operation == "set" or row is None
+                    else decode_value(json.loads(row[0]))
+                )
+                document = apply_transforms(current, data, now)
+                connection.execute(
+                    "INSERT OR REPLACE INTO documents (collection, id, data, update_time) "
+                    "VALUES (?, ?, ?, ?)",
+                    (
+                        collection,
+                        doc_id,
+                        json.dumps(encode_value(document), ensure_ascii=False),
+                        update_micros,
+                    ),
+                )
+                update_times.append(now)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self._writes = []
+        return update_times
+
+
+class SQLiteRepository(Repository):
+    """Documents stored as JSON in an embedded SQLite database, for a single box.
+
+    The database runs in WAL mode, so reads are not blocked by writes, with one
+    connection per thread. Trips and shifts are indexed by user, shift and start
+    time.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_update_time = 0
+        connection = self.connection()
+        connection.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        """Gets the connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            self._local.connection = connection
+        return connection
+
+    def next_update_time(self, previous: int) -> int:
+        """Gets an update time in microseconds, after any given out before."""
+        with self._lock:
+            self._last_update_time = max(
+                time.time_ns() // 1000, self._last_update_time + 1, previous + 1
+            )
+            return self._last_update_time
+
+    def get(self, collection: str, doc_id: str) -> SQLiteDocument:
+        row = (
+            self.connection()
+            .execute(
+                "SELECT data, update_time FROM documents WHERE collection = ? AND id = ?",
+                (collection, doc_id),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return SQLiteDocument(doc_id, None, None)
+        return SQLiteDocument(
+            doc_id, decode_value(json.loads(row[0])), _from_micros(row[1])
+        )
+
+    def get_many(
+        self, collection: str, doc_ids: Sequence[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        if not doc_ids:
+            return {}
+        rows = (
+            self.connection()
+            .execute(
+                "SELECT id, data FROM documents WHERE collection = ? AND id IN "
+                f"({', '.join('?' * len(doc_ids))})",
+                (collection, *doc_ids),
+            )
+            .fetchall()
+        )
+        return {doc_id: decode_value(json.loads(data)) for doc_id, data in rows}
+
+    def new_id(self, collection: str) -> str:
+        return "".join(secrets.choice(ID_ALPHABET) for _ in range(20))
+
+    def batch(self) -> SQLiteWriteBatch:
+        return SQLiteWriteBatch(self)
+
+    def query(
+        self,
+        collection: str,
+        filters: Sequence[Filter],
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        fields: Optional[List[str]] = None,
+        limit: Optional[int] = None,
+        start_after: Optional[SQLiteDocument] = None,
+    ) -> List[SQLiteDocument]:
+        where, params = self._where(collection, filters)
+        order_expression = self._expression(order_by or "__name__")
+        if start_after is not None:
+            comparison = "<" if descending else ">"
+            order_value = encode_value(start_after.order_value)
+            where += (
+                f" AND ({order_expression} {comparison} ? OR "
+                f"({order_expression} = ? AND id {comparison} ?))"
+            )
+            params += [order_value, order_value, start_after.id]
+        direction = "DESC" if descending else "ASC"
+        sql = (
+            f"SELECT id, data, update_time, {order_expression} FROM documents "
+            f"WHERE {where} ORDER BY {order_expression} {direction}, id {direction}"
+        )
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+
+        documents = []
+        for doc_id, data, update_time, order_value in self.connection().execute(
+            sql, params
+        ):
+            document = decode_value(json.loads(data))
+            if fields is not None:
+                document = {
+                    field: document[field] for field in fields if field in document
+                }
+            documents.append(
+                SQLiteDocument(
+                    doc_id,
+                    document,
+                    _from_micros(update_time),
+                    decode_value(order_value),
+                )
+            )
+        return documents
+
+    def count_and_sum(
+        self, collection: str, filters: Sequence[Filter], field: str
+    ) -> Tuple[int, float]:
+        where, params = self._where(collection, filters)
+        expression = self._expression(field)
+        count, total = (
+            self.connection()
+            .execute(
+                f"SELECT count(*), total({expression}) FROM documents WHERE {where}",
+                params,
+            )
+            .fetchone()
+        )
+        return int(count), float(total)
+
+    def _where(
+        self, collection: str, filters: Sequence[Filter]
+    ) -> Tuple[str, List[Any]]:
+        clauses = ["collection = ?"]
+        params: List[Any] = [collection]
+        for field, operator, value in filters:
+            if operator == "==" and value is None:
+                # As in Firestore, only matches fields set to null, not missing ones
+                clauses.append(f"json_type(data, '{self._path(field)}') = 'null'")
+                continue
+            expression = self._expression(field)
+            clauses.append(f"{expression} {OPERATORS[operator]} ?")
+            params.append(encode_value(value))
+        return " AND ".join(clauses), params
+
+    @classmethod
+    def _expression(cls, field: str) -> str:
+        if field == "__name__":
+            return "id"
+        if field in INDEXED_FIELDS:
+            return field
+        return f"json_extract(data, '{cls._path(field)}')"
+
+    @staticmethod
+    def _path(field: str) -> str:
+        return f'$."{field}"'.replace("'", "''")
@@ -0,0 +1,211 @@
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Protocol, Sequence, Tuple
+
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1 import Client
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+# (field, operator, value) filters, operators as in Firestore: ==, >, >=, <, <=
+Filter = Tuple[str, str, Any]
+
+
+class ConflictError(Exception):
+    """Raised when a conditional write finds the document modified since it was read."""
+
+
+class Document(Protocol):
+    """A stored document, as returned by Firestore snapshots."""
+
+    id: str
+    update_time: Optional[datetime]
+
+    @property
+    def exists(self) -> bool:
+        """Whether the document exists."""
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        """Returns the document data."""
+
+
+class WriteBatch(Protocol):
+    """Writes committed atomically in one round trip."""
+
+    def set(self, collection: str, doc_id: str, data: Dict[str, Any]) -> None:
+        """Adds the creation or replacement of a document."""
+
+    def update(
+        self,
+        collection: str,
+        doc_id: str,
+        data: Dict[str, Any],
+        last_update_time: Optional[datetime] = None,
+    ) -> None:
+        """Adds an update of the fields of a document.
+
+        With last_update_time the whole batch fails with ConflictError if the
+        document was modified since.
+        """
+
+    def merge(self, collection: str, doc_id: str, data: Dict[str, Any]) -> None:
+        """Adds a merge of possibly nested fields into a document, creating it if missing."""
+
+    def commit(self) -> List[datetime]:
+        """Commits the writes, returns the update time of each."""
+
+
+class Repository(ABC):
+    """Storage of the model documents, addressed by collection path and document ID.
+
+    Field values may be Firestore transforms: SERVER_TIMESTAMP, Increment and
+    DELETE_FIELD.
+    """
+
+    @abstractmethod
+    def get(self, collection: str, doc_id: str) -> Document:
+        """Gets a document, which may not exist."""
+
+    @abstractmethod
+    def get_many(
+        self, collection: str, doc_ids: Sequence[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        """Gets the data of the existing documents among doc_ids in one round trip."""
+
+    @abstractmethod
+    def new_id(self, collection: str) -> str:
+        """Generates an ID for a new document."""
+
+    @abstractmethod
+    def batch(self) -> WriteBatch:
+        """Starts a batch of writes."""
+
+    @abstractmethod
+    def query(
+        self,
+        collection: str,
+        filters: Sequence[Filter],
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        fields: Optional[List[str]] = None,
+        limit: Optional[int] = None,
+        start_after: Optional[Document] = None,
+    ) -> List[Document]:
+        """Gets the documents matching all filters.
+
+        Only the given fields are returned if set. Pages continue after the last
+        document of the previous page.
+        """
+
+    @abstractmethod
+    def count_and_sum(
+        self, collection: str, filters: Sequence[Filter], field: str
+    ) -> Tuple[int, float]:
+        """Counts the documents matching all filters and sums one of their fields."""
+
+
+class FirestoreWriteBatch:
+    """A Firestore write batch."""
+
+    def __init__(self, db: Client) -> None:
+        self.db = db
+        self.batch = db.batch()
+
+    def set(self, collection: str, doc_id: str, data: Dict[str, Any]) -> None:
+        """Adds the creation or replacement of a document."""
+        self.batch.set(self.db.collection(collection).document(doc_id), data)
+
+    def update(
+        self,
+        collection: str,
+        doc_id: str,
+        data: Dict[str, Any],
+        last_update_time: Optional[datetime] = None,
+    ) -> None:
+        """Adds an update of the fields of a document, conditional if last_update_time is set."""
+        option = None
+        if last_update_time is not None:
+            option = self.db.write_option(last_update_time=last_update_time)
+        self.batch.update(
+            self.db.collection(collection).document(doc_id), data, option=option
+        )
+
+    def merge(self, collection: str, doc_id: str, data: Dict[str, Any]) -> None:
+        """Adds a merge of possibly nested fields into a document, creating it if missing."""
+        self.batch.set(
+            self.db.collection(collection).document(doc_id), data, merge=True
+        )
+
+    def commit(self) -> List[datetime]:
+        """Commits the writes, returns the update time of each."""
+        try:
+            return [result.update_time for result in self.batch.commit()]
+        except FailedPrecondition as err:
+            raise ConflictError(str(err)) from err
+
+
+class FirestoreRepository(Repository):
+    """Documents stored in Firestore."""
+
+    def __init__(self, client: Callable[[], Client]) -> None:
+        self.client = client
+
+    @property
+    def db(self) -> Client:
+        """Gets the Firestore client, creating it on first use."""
+        return self.client()
+
+    def get(self, collection: str, doc_id: str) -> Document:
+        return self.db.collection(collection).document(doc_id).get()
+
+    def get_many(
+        self, collection: str, doc_ids: Sequence[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        refs = [self.db.collection(collection).document(doc_id) for doc_id in doc_ids]
+        return {doc.id: doc.to_dict() for doc in self.db.get_all(refs) if doc.exists}
+
+    def new_id(self, collection: str) -> str:
+        return self.db.collection(collection).document().id
+
+    def batch(self) -> FirestoreWriteBatch:
+        return FirestoreWriteBatch(self.db)
+
+    def query(
+        self,
+        collection: str,
+        filters: Sequence[Filter],
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        fields: Optional[List[str]] = None,
+        limit: Optional[int] = None,
+        start_after: Optional[Document] = None,
+    ) -> List[Document]:
+        query = self._filtered(collection, filters)
+        if order_by is not None:
+            query = query.order_by(
+                order_by,
+                direction="DESCENDING" if descending else "ASCENDING",
+            )
+        if fields is not None:
+            query = query.select(fields)
+        if limit is not None:
+            query = query.limit(limit)
+        if start_after is not None:
+            query = query.start_after(start_after)
+        return list(query.stream())
+
+    def count_and_sum(
+        self, collection: str, filters: Sequence[Filter], field: str
+    ) -> Tuple[int, float]:
+        aggregation = (
+            self._filtered(collection, filters)
+            .count(alias="count")
+            .sum(field, alias="sum")
+        )
+        results = {result.alias: result.value for result in aggregation.get()[0]}
+        return int(results["count"]), float(results["sum"])
+
+    def _filtered(self, collection: str, filters: Sequence[Filter]):
+        query = self.db.collection(collection)
+        for field, operator, value in filters:
+            query = query.where(filter=FieldFilter(field, operator, value))
+        return query
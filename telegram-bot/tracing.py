@@ -0,0 +1,194 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.2,
+    0.3,
+    0.5,
+    0.75,
+    1,
+    1.5,
+    2,
+    3,
+    5,
+    10,
+)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram with approximate quantiles."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Records a latency."""
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def quantile(self, fraction: float) -> Optional[float]:
+        """Gets the upper bound of the bucket containing the given quantile."""
+        with self._lock:
+            if not self.count:
+                return None
+            rank = fraction * self.count
+            seen = 0
+            for i, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """Returns the count, mean, max and p50/p90/p95/p99 latencies."""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Tracer:
+    """Times each update and the Firestore, geocoding and Telegram calls within it.
+
+    Spans are aggregated into latency histograms per command, and the timeline of
+    every update is logged as a structured record.
+    """
+
+    def __init__(self, slow_threshold: float = 1.0) -> None:
+        self.slow_threshold = slow_threshold
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.commands: Dict[str, LatencyHistogram] = {}
+        self.spans: Dict[str, Dict[str, LatencyHistogram]] = {}
+
+    @contextmanager
+    def trace(self, command: str, update_id: Optional[int] = None) -> Iterator[None]:
+        """Times an update as a root span, aggregated under the command."""
+        spans: List[Dict[str, Any]] = []
+        start = time.perf_counter()
+        self._local.spans = spans
+        self._local.start = start
+        self._local.command = command
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self._local.spans = None
+            self._local.command = None
+            self._record(command, duration, spans)
+            record = {
+                "command": command,
+                "update_id": update_id,
+                "duration": round(duration, 4),
+                "spans": spans,
+            }
+            if duration >= self.slow_threshold:
+                logging.warning(
+                    f"Slow update {update_id} ({command}) took {duration:.3f}s",
+                    extra={"json_fields": record},
+                )
+            else:
+                logging.debug(
+                    f"Update {update_id} ({command}) took {duration:.3f}s",
+                    extra={"json_fields": record},
+                )
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Times a call within the current update, if any."""
+        spans = getattr(self._local, "spans", None)
+        if spans is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            spans.append(
+                {
+                    "name": name,
+                    "offset": round(start - self._local.start, 4),
+                    "duration": round(time.perf_counter() - start, 4),
+                }
+            )
+
+    def bind(self, name: str, call: Callable[[], Any]) -> Callable[[], Any]:
+        """Wraps a call to be made later as a span of the current update, if any.
+
+        A call made outside the update, e.g. by a send worker once the update is
+        done, is not in its timeline but is still aggregated under its command.
+        """
+        spans = getattr(self._local, "spans", None)
+        if spans is None:
+            return call
+        command = self._local.command
+
+        def traced() -> Any:
+            if getattr(self._local, "spans", None) is spans:
+                with self.span(name):
+                    return call()
+            start = time.perf_counter()
+            try:
+                return call()
+            finally:
+                duration = time.perf_counter() - start
+                with self._lock:
+                    histogram = self.spans.setdefault(command, {}).setdefault(
+                        name, LatencyHistogram()
+                    )
+                histogram.observe(duration)
+
+        return traced
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the latency stats per command and of the spans within it."""
+        with self._lock:
+            commands = dict(self.commands)
+            spans = {command: dict(named) for command, named in self.spans.items()}
+        return {
+            command: {
+                "latency": histogram.stats(),
+                "spans": {
+                    name: span_histogram.stats()
+                    for name, span_histogram in spans.get(command, {}).items()
+                },
+            }
+            for command, histogram in commands.items()
+        }
+
+    def _record(
+        self, command: str, duration: float, spans: List[Dict[str, Any]]
+    ) -> None:
+        with self._lock:
+            histogram = self.commands.setdefault(command, LatencyHistogram())
+            named = self.spans.setdefault(command, {})
+            span_histograms = [
+                (named.setdefault(span["name"], LatencyHistogram()), span["duration"])
+                for span in spans
+            ]
+        histogram.observe(duration)
+        for span_histogram, span_duration in span_histograms:
+            span_histogram.observe(span_duration)
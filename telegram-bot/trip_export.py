@@ -0,0 +1,128 @@
+import csv
+import io
+import tempfile
+import zipfile
+from datetime import datetime, timedelta, timezone
+from typing import IO, Any, Dict, Iterable, List, Optional, Tuple
+
+# Hong Kong has not observed daylight saving time since 1979, so a fixed offset
+# avoids a pytz lookup per row
+HK_TZ = timezone(timedelta(hours=8), "HKT")
+
+# Only these trip fields are downloaded for an export
+EXPORT_FIELDS = [
+    "shift_id",
+    "trip_id",
+    "start_time",
+    "start_address",
+    "start_latitude",
+    "start_longitude",
+    "end_time",
+    "end_address",
+    "end_latitude",
+    "end_longitude",
+    "fare",
+]
+
+CSV_HEADER = [
+    "Shift ID",
+    "Trip ID",
+    "Start Time",
+    "Start Address",
+    "End Time",
+    "End Address",
+    "Fare",
+]
+
+# Exports are kept in memory up to this size before spilling to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def format_time(value: Optional[datetime]) -> str:
+    """Formats a UTC timestamp in Hong Kong time."""
+    if not value:
+        return "N/A"
+    return value.astimezone(HK_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def format_location(
+    address: Optional[str], latitude: Optional[float], longitude: Optional[float]
+) -> Optional[str]:
+    """Formats an address, or its coordinates while it is not resolved yet."""
+    if address or latitude is None or longitude is None:
+        return address
+    return f"{latitude:.5f}, {longitude:.5f}"
+
+
+def format_trip_row(trip: Dict[str, Any]) -> List[Any]:
+    """Formats the fields of a trip document as a csv row."""
+    fare = trip.get("fare")
+    return [
+        trip.get("shift_id"),
+        trip.get("trip_id"),
+        format_time(trip.get("start_time")),
+        format_location(
+            trip.get("start_address"),
+            trip.get("start_latitude"),
+            trip.get("start_longitude"),
+        ),
+        format_time(trip.get("end_time")),
+        format_location(
+            trip.get("end_address"), trip.get("end_latitude"), trip.get("end_longitude")
+        ),
+        f"${fare:.2f}" if fare else "N/A",
+    ]
+
+
+def write_trips_csv(
+    trips: Iterable[Dict[str, Any]], file: IO[str]
+) -> Tuple[int, Optional[datetime]]:
+    """Writes the trips to a csv file.
+
+    Returns the number of trips written and the latest end time among them.
+    """
+    writer = csv.writer(file)
+    writer.writerow(CSV_HEADER)
+    count = 0
+    last_end_time = None
+    for trip in trips:
+        writer.writerow(format_trip_row(trip))
+        count += 1
+        end_time = trip.get("end_time")
+        if end_time is not None and (last_end_time is None or end_time > last_end_time):
+            last_end_time = end_time
+    return count, last_end_time
+
+
+def export_trips_csv(
+    trips: Iterable[Dict[str, Any]], compress: bool = False
+) -> Tuple[IO[bytes], str, int, Optional[datetime]]:
+    """Streams the trips into a spooled csv (or zipped csv) file.
+
+    Returns the file positioned at the start, its file name, the number of trips
+    written and the latest end time among them.
+    """
+    # pylint: disable=consider-using-with
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if compress:
+        with zipfile.ZipFile(spooled_file, "w", zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("trips.csv", "w") as binary_file:
+                count, last_end_time = _write_text(trips, binary_file)
+        file_name = "trips.zip"
+    else:
+        count, last_end_time = _write_text(trips, spooled_file)
+        file_name = "trips.csv"
+    spooled_file.seek(0)
+    return spooled_file, file_name, count, last_end_time
+
+
+def _write_text(
+    trips: Iterable[Dict[str, Any]], binary_file: IO[bytes]
+) -> Tuple[int, Optional[datetime]]:
+    text_file = io.TextIOWrapper(binary_file, encoding="utf-8", newline="")
+    try:
+        return write_trips_csv(trips, text_file)
+    finally:
+        text_file.flush()
+        # Leave the underlying file open for sending
+        text_file.detach()
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1 import CollectionReference
+
+PROCESSED_UPDATES_COLLECTION_NAME = "processed_updates"
+
+# Outcomes of a claim
+CLAIMED = "claimed"
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+class UpdateDeduplicator:
+    """Suppresses Telegram webhook redeliveries of an update.
+
+    An update is claimed before it is dispatched, first in a bounded in-process
+    set and then, in shared mode, with a single Firestore marker created only if
+    absent. In process a claim is a lease of lease seconds: a redelivery while it
+    runs is reported IN_PROGRESS, and once the update is marked completed it is
+    suppressed for ttl seconds. Completing is not written to Firestore, so a
+    marker left by any instance suppresses redeliveries as COMPLETED until it is
+    released after a failure or removed by a TTL policy on its expires_at field.
+    """
+
+    MODES = ("off", "local", "shared")
+
+    def __init__(
+        self,
+        mode: str = "shared",
+        collection: Optional[Callable[[], CollectionReference]] = None,
+        max_size: int = 10000,
+        ttl: float = 24 * 60 * 60,
+        lease: float = 60.0,
+    ) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"Update deduplication mode must be one of {self.MODES}.")
+        self.mode = mode
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lease = lease
+        # update_id -> (expiry as time.monotonic(), completed)
+        self._claimed: OrderedDict[int, Tuple[float, bool]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.claims = 0
+        self.suppressed = 0
+        self.shared_suppressed = 0
+        self.in_progress = 0
+        self.completed = 0
+        self.released = 0
+
+    def claim(self, update_id: int, chat_id: Optional[int] = None) -> str:
+        """Claims an update for processing.
+
+        Returns CLAIMED if the update should be handled, COMPLETED if it already
+        was and IN_PROGRESS if another claim on it is still held.
+        """
+        if self.mode == "off":
+            return CLAIMED
+        outcome = self._claim_local(update_id)
+        if outcome == CLAIMED and self.mode == "shared":
+            outcome = self._claim_shared(update_id, chat_id)
+            if outcome != CLAIMED:
+                # Let the local claim go, the shared marker decides next time
+                with self._lock:
+                    self._claimed.pop(update_id, None)
+                    self.shared_suppressed += 1
+        with self._lock:
+            if outcome == CLAIMED:
+                self.claims += 1
+            elif outcome == COMPLETED:
+                self.suppressed += 1
+            else:
+                self.in_progress += 1
+        return outcome
+
+    def complete(self, update_id: int) -> None:
+        """Marks a claimed update as handled in process, suppressing its redeliveries.
+
+        The shared marker already suppresses them, so nothing is written.
+        """
+        if self.mode == "off":
+            return
+        with self._lock:
+            self._claimed[update_id] = (time.monotonic() + self.ttl, True)
+            self._claimed.move_to_end(update_id)
+            self._evict()
+            self.completed += 1
+
+    def release(self, update_id: int) -> None:
+        """Releases the claim on an update that failed, so a redelivery is processed."""
+        if self.mode == "off":
+            return
+        with self._lock:
+            self._claimed.pop(update_id, None)
+            self.released += 1
+        if self.mode == "shared" and self.collection is not None:
+            try:
+                self.collection().document(str(update_id)).delete()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logging.error(f"Error releasing update {update_id}: {err}")
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the deduplication counters."""
+        with self._lock:
+            return {
+                "size": len(self._claimed),
+                "claims": self.claims,
+                "suppressed": self.suppressed,
+                "shared_suppressed": self.shared_suppressed,
+                "in_progress": self.in_progress,
+                "completed": self.completed,
+                "released": self.released,
+            }
+
+    def _claim_local(self, update_id: int) -> str:
+        now = time.monotonic()
+        with self._lock:
+            expires_at, completed = self._claimed.get(update_id, (0.0, False))
+            if expires_at > now:
+                return COMPLETED if completed else IN_PROGRESS
+            self._claimed[update_id] = (now + self.lease, False)
+            self._claimed.move_to_end(update_id)
+            self._evict()
+        return CLAIMED
+
+    def _evict(self) -> None:
+        # Called with the lock held
+        while len(self._claimed) > self.max_size:
+            self._claimed.popitem(last=False)
+
+    def _claim_shared(self, update_id: int, chat_id: Optional[int]) -> str:
+        if self.collection is None:
+            return CLAIMED
+        now = datetime.now(timezone.utc)
+        try:
+            self.collection().document(str(update_id)).create(
+                {
+                    "update_id": update_id,
+                    "chat_id": chat_id,
+                    "claimed_at": now,
+                    "expires_at": now + timedelta(seconds=self.ttl),
+                }
+            )
+        except AlreadyExists:
+            # Claimed by another instance, which handles it or released it on failure
+            return COMPLETED
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            # Processing a rare duplicate beats dropping updates while Firestore
+            # is unavailable
+            logging.error(f"Error claiming update {update_id}: {err}")
+        return CLAIMED
@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Tuple
+
+
+class ChatOrderedQueue:
+    """Bounded worker pool that processes items in order per chat.
+
+    Items of one chat are processed one at a time in arrival order, while items
+    of different chats are processed in parallel by up to max_workers threads.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[Any], None],
+        max_workers: int = 8,
+        max_pending: int = 1000,
+    ) -> None:
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pending: Dict[Hashable, Deque[Tuple[float, Any]]] = {}
+        self._ready: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+        self.depth = 0
+        self.max_depth = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_processing_time = 0.0
+        self.max_processing_time = 0.0
+
+    def submit(self, chat_id: Hashable, item: Any) -> bool:
+        """Enqueues an item for the chat, returns False if the queue is full."""
+        with self._lock:
+            if self.depth >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            chat_items = self._pending.get(chat_id)
+            if chat_items is None:
+                # No worker owns this chat yet, schedule it
+                self._pending[chat_id] = deque([(time.monotonic(), item)])
+                self._ready.put(chat_id)
+            else:
+                chat_items.append((time.monotonic(), item))
+            if len(self._workers) < self.max_workers:
+                self._start_worker()
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the queue counters."""
+        with self._lock:
+            return {
+                "depth": self.depth,
+                "max_depth": self.max_depth,
+                "active_chats": len(self._pending),
+                "workers": len(self._workers),
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+                "avg_wait_time": (
+                    self.total_wait_time / self.processed if self.processed else 0.0
+                ),
+                "max_wait_time": self.max_wait_time,
+                "avg_processing_time": (
+                    self.total_processing_time / self.processed
+                    if self.processed
+                    else 0.0
+                ),
+                "max_processing_time": self.max_processing_time,
+            }
+
+    def _start_worker(self) -> None:
+        worker = threading.Thread(
+            target=self._work,
+            name=f"update-worker-{len(self._workers)}",
+            daemon=True,
+        )
+        self._workers.append(worker)
+        worker.start()
+
+    def _work(self) -> None:
+        while True:
+            chat_id = self._ready.get()
+            with self._lock:
+                enqueued_at, item = self._pending[chat_id].popleft()
+            started_at = time.monotonic()
+            try:
+                self.handler(item)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception(f"Error processing update for chat {chat_id}")
+                with self._lock:
+                    self.failed += 1
+            finished_at = time.monotonic()
+
+            with self._lock:
+                self.depth -= 1
+                self.processed += 1
+                wait_time = started_at - enqueued_at
+                processing_time = finished_at - started_at
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+                self.total_processing_time += processing_time
+                self.max_processing_time = max(
+                    self.max_processing_time, processing_time
+                )
+                if self._pending[chat_id]:
+                    # Reschedule behind other chats so one busy chat cannot hog a worker
+                    self._ready.put(chat_id)
+                else:
+                    del self._pending[chat_id]
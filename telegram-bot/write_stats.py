@@ -0,0 +1,69 @@
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator
+
+
+def estimate_size(value: Any) -> int:
+    """Estimates the Firestore storage size of a value in bytes."""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, datetime)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, dict):
+        return sum(
+            estimate_size(field) + estimate_size(item) for field, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(item) for item in value)
+    # Sentinels and transforms such as SERVER_TIMESTAMP or Increment
+    return 8
+
+
+class WriteStats:
+    """Counts the Firestore writes, fields and bytes sent per handler."""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.handlers: Dict[str, Dict[str, int]] = {}
+
+    @contextmanager
+    def track(self, handler: str) -> Iterator[None]:
+        """Attributes the writes made in this thread to the given handler."""
+        previous = getattr(self._local, "handler", None)
+        self._local.handler = handler
+        try:
+            yield
+        finally:
+            self._local.handler = previous
+
+    def record(self, data: Dict[str, Any]) -> None:
+        """Records a document write with the given fields."""
+        counters = self._counters()
+        with self._lock:
+            counters["writes"] += 1
+            counters["fields"] += len(data)
+            counters["bytes"] += estimate_size(data)
+
+    def record_skipped(self) -> None:
+        """Records an update that was skipped because nothing changed."""
+        counters = self._counters()
+        with self._lock:
+            counters["skipped"] += 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns a copy of the counters per handler."""
+        with self._lock:
+            return {
+                handler: dict(counters) for handler, counters in self.handlers.items()
+            }
+
+    def _counters(self) -> Dict[str, int]:
+        handler = getattr(self._local, "handler", None) or "other"
+        with self._lock:
+            return self.handlers.setdefault(
+                handler, {"writes": 0, "fields": 0, "bytes": 0, "skipped": 0}
+            )
@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "telegram-bot"), os.path.join(ROOT, "benchmarks")]
+
+# pylint: disable=wrong-import-position
+from benchmark_webhook import Session  # noqa: E402
+from stub_servers import BotAPIStub, GeocoderStub, server_url, start_stub  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def telegram_stub():
+    """A fake Bot API shared by the handler tests, recording what the bot sends."""
+    server, stub = start_stub(BotAPIStub, (0.0, 0.0))
+    stub.url = server_url(server)
+    yield stub
+    server.shutdown()
+
+
+@pytest.fixture(scope="session")
+def bot_main(telegram_stub):
+    """Imports main against the fake Bot API and geocoders.
+
+    The bot reads its settings at import, so this happens once per session.
+    """
+    geocoder, _ = start_stub(GeocoderStub, (0.0, 0.0))
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-ar-baak")
+    os.environ.update(
+        {
+            "BOT_TOKEN": "0:test",
+            "CLOUD_LOGGING": "0",
+            # Keeps the geocode cache and update markers in process, the
+            # repository fixture then picks the backend of each test
+            "STORAGE_BACKEND": "sqlite",
+            # Every reply is sent to the fake Bot API as it is made
+            "TELEGRAM_REPLY_MODE": "direct",
+            "SEND_MODE": "direct",
+            "TELEGRAM_API_URL": f"{telegram_stub.url}/bot{{0}}/{{1}}",
+            "OSM_URL": f"{server_url(geocoder)}/reverse",
+            "HK_GEODATA_URL": f"{server_url(geocoder)}/gs/api/v1.0.0/identify",
+            "HK_ADDRESS_POINTS_PATH": "",
+        }
+    )
+    import main  # pylint: disable=import-outside-toplevel
+
+    yield main
+    geocoder.shutdown()
+
+
+@pytest.fixture(params=["sqlite", "firestore"])
+def repository(request, bot_main, tmp_path, monkeypatch):
+    """Stores the documents in each backend in turn.
+
+    Firestore runs against the emulator and is skipped unless
+    FIRESTORE_EMULATOR_HOST is set.
+    """
+    if request.param == "firestore" and not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        pytest.skip("FIRESTORE_EMULATOR_HOST is not set, start the emulator first")
+    models = sys.modules["models"]
+    monkeypatch.setattr(models, "STORAGE_BACKEND", request.param)
+    monkeypatch.setattr(models, "SQLITE_PATH", str(tmp_path / "taxi.db"))
+    models.get_repository.cache_clear()
+    yield bot_main.get_repository()
+    models.get_repository.cache_clear()
+
+
+@pytest.fixture
+def driver():
+    """Builds the updates of a driver with an ID of their own.
+
+    The ID is random so that runs against the same emulator do not mix.
+    """
+    return Session(uuid.uuid4().int % 10**9, random.Random(0))
@@ -0,0 +1,131 @@
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+from address_resolver import AddressResolver
+from test_handlers import run_trip, start_shift
+
+
+def resolver(resolve, written: Dict[str, Dict[str, str]], **kwargs) -> AddressResolver:
+    return AddressResolver(
+        resolve=resolve,
+        cell_key=lambda lat, lon: f"{lat:.3f},{lon:.3f}",
+        write=written.update,
+        batch_delay=0.01,
+        **kwargs,
+    )
+
+
+def test_failed_lookups_are_retried():
+    calls: List[float] = []
+
+    def resolve(lat: float, lon: float) -> Optional[str]:
+        calls.append(lat)
+        if len(calls) == 1:
+            raise RuntimeError("geocoder down")
+        return f"{lat}, {lon}"
+
+    written: Dict[str, Dict[str, str]] = {}
+    address_resolver = resolver(resolve, written)
+    address_resolver.submit("trip", "start_address", 22.3, 114.17)
+    assert address_resolver.join(timeout=5)
+
+    assert written == {"trip": {"start_address": "22.3, 114.17"}}
+    assert address_resolver.stats()["retried"] == 1
+
+
+def test_lookups_are_given_up_after_max_attempts():
+    written: Dict[str, Dict[str, str]] = {}
+    unresolvable: Dict[str, List[str]] = {}
+    address_resolver = resolver(
+        lambda lat, lon: None,
+        written,
+        max_attempts=3,
+        mark_unresolvable=unresolvable.update,
+    )
+    address_resolver.submit("trip", "end_address", 35.68, 139.76)
+    assert address_resolver.join(timeout=5)
+
+    stats = address_resolver.stats()
+    assert not written
+    assert unresolvable == {"trip": ["end_address"]}
+    assert (stats["lookups"], stats["unresolved"]) == (3, 1)
+
+
+def test_sweep_submits_unresolved_addresses_not_queued():
+    unresolved = [
+        ("trip", "start_address", 22.3, 114.17),
+        ("trip", "end_address", 22.28, 114.17),
+    ]
+    written: Dict[str, Dict[str, str]] = {}
+    address_resolver = resolver(
+        lambda lat, lon: f"{lat}, {lon}",
+        written,
+        find_unresolved=lambda: unresolved,
+    )
+    address_resolver.batch_delay = 60
+    address_resolver.submit("trip", "start_address", 22.3, 114.17)
+
+    assert address_resolver.sweep() == 1
+    assert address_resolver.join(timeout=5)
+    assert written == {
+        "trip": {"start_address": "22.3, 114.17", "end_address": "22.28, 114.17"}
+    }
+
+
+@pytest.fixture
+def lost_trip(bot_main, repository, driver, monkeypatch) -> str:
+    """Records a trip in deferred mode on an instance that stops before resolving it."""
+    monkeypatch.setattr(bot_main, "GEOCODING_MODE", "deferred")
+    monkeypatch.setattr(bot_main, "resolve_now", lambda lat, lon: None)
+    monkeypatch.setattr(bot_main.address_resolver, "submit", lambda *args: True)
+    start_shift(bot_main, driver)
+    run_trip(bot_main, driver, "66")
+    trips = repository.query("trips", [("user_id", "==", str(driver.user_id))])
+    assert len(trips) == 1
+    return trips[0].id
+
+
+def sweeping_resolver(bot_main, trip_id: str, resolve) -> AddressResolver:
+    def find_unresolved() -> List[Tuple[str, str, float, float]]:
+        # Other tests may leave unresolved trips in the emulator
+        return [
+            address
+            for address in bot_main.Trip.find_unresolved_addresses(
+                timedelta(hours=1), 500
+            )
+            if address[0] == trip_id
+        ]
+
+    return AddressResolver(
+        resolve=resolve,
+        cell_key=bot_main.geocode_cache.cell_key,
+        write=bot_main.Trip.fill_addresses,
+        find_unresolved=find_unresolved,
+        mark_unresolvable=bot_main.Trip.mark_unresolvable,
+        batch_delay=0.01,
+    )
+
+
+def test_sweep_resolves_addresses_lost_with_the_queue(bot_main, repository, lost_trip):
+    trip = repository.get("trips", lost_trip).to_dict()
+    assert trip["start_address"] is None and trip["end_address"] is None
+
+    address_resolver = sweeping_resolver(bot_main, lost_trip, bot_main.reverse_geocode)
+    assert address_resolver.sweep() == 2
+    assert address_resolver.join(timeout=10)
+
+    trip = repository.get("trips", lost_trip).to_dict()
+    assert trip["start_address"] and trip["end_address"]
+    assert address_resolver.sweep() == 0
+
+
+def test_sweep_skips_addresses_given_up(bot_main, repository, lost_trip):
+    address_resolver = sweeping_resolver(bot_main, lost_trip, lambda lat, lon: None)
+    assert address_resolver.sweep() == 2
+    assert address_resolver.join(timeout=10)
+
+    trip = repository.get("trips", lost_trip).to_dict()
+    assert "start_address" not in trip and "end_address" not in trip
+    assert trip["start_address_unresolvable"] and trip["end_address_unresolvable"]
+    assert address_resolver.sweep() == 0
@@ -0,0 +1,105 @@
+from typing import List
+
+import telebot
+
+PICKUP = {"latitude": 22.2988, "longitude": 114.1722}
+DROP_OFF = {"latitude": 22.2783, "longitude": 114.1747}
+
+
+def send(bot_main, update) -> None:
+    """Handles an update as the webhook would."""
+    _, data = update
+    bot_main.process_update(telebot.types.Update.de_json(data))
+
+
+def replies(telegram_stub, driver) -> List[str]:
+    """Gets the texts sent to the driver so far."""
+    return [
+        params["text"]
+        for params, _ in telegram_stub.calls_to("sendMessage")
+        if params["chat_id"] == str(driver.user_id)
+    ]
+
+
+def start_shift(bot_main, driver) -> None:
+    send(bot_main, driver.message(text="/start"))
+    send(bot_main, driver.message(text="/start_shift"))
+
+
+def run_trip(bot_main, driver, fare: str) -> None:
+    send(bot_main, driver.message(location=PICKUP))
+    send(bot_main, driver.message(location=DROP_OFF))
+    send(bot_main, driver.message(text=fare))
+
+
+def test_trip_is_recorded(bot_main, repository, telegram_stub, driver):
+    start_shift(bot_main, driver)
+    user_id = str(driver.user_id)
+    user = repository.get("users", user_id).to_dict()
+    assert user["active_shift"] is not None
+
+    send(bot_main, driver.message(location=PICKUP))
+    user = repository.get("users", user_id).to_dict()
+    trip = repository.get("trips", user["active_trip"]).to_dict()
+    assert trip["start_address"]
+    assert trip["start_address"] in replies(telegram_stub, driver)[-1]
+
+    send(bot_main, driver.message(location=DROP_OFF))
+    send(bot_main, driver.message(text="88.5"))
+    trip = repository.get("trips", trip["trip_id"]).to_dict()
+    assert trip["end_address"]
+    assert trip["fare"] == 88.5
+
+    user = repository.get("users", user_id).to_dict()
+    assert user["active_trip"] is None
+    assert (user["total_trips"], user["total_fare"]) == (1, 88.5)
+    shift = repository.get("shifts", user["active_shift"]).to_dict()
+    assert (shift["total_trips"], shift["total_fare"]) == (1, 88.5)
+
+
+def test_get_trips_exports_each_trip_once(bot_main, repository, telegram_stub, driver):
+    start_shift(bot_main, driver)
+    run_trip(bot_main, driver, "120")
+    trips = repository.query("trips", [("user_id", "==", str(driver.user_id))])
+    assert len(trips) == 1
+
+    documents = len(telegram_stub.calls_to("sendDocument"))
+    send(bot_main, driver.message(text="/get_trips"))
+    exports = telegram_stub.calls_to("sendDocument")[documents:]
+    assert len(exports) == 1
+    _, body = exports[0]
+    assert trips[0].id.encode() in body
+    assert b"$120.00" in body
+    assert replies(telegram_stub, driver)[-1] == "記錄已成功匯出。"
+
+    send(bot_main, driver.message(text="/get_trips"))
+    assert len(telegram_stub.calls_to("sendDocument")) == documents + 1
+    assert replies(telegram_stub, driver)[-1] == "你未有最近嘅記錄。"
+
+
+def test_stale_session_is_retried(bot_main, repository, driver):
+    start_shift(bot_main, driver)
+    user_id = str(driver.user_id)
+
+    # Another instance updates the user cached by this one
+    batch = repository.batch()
+    batch.update("users", user_id, {"total_fare": 12.5})
+    batch.commit()
+
+    stale = bot_main.session_cache.stale
+    send(bot_main, driver.message(location=PICKUP))
+    assert bot_main.session_cache.stale > stale
+
+    trips = repository.query("trips", [("user_id", "==", user_id)])
+    assert len(trips) == 1
+    user = repository.get("users", user_id).to_dict()
+    assert user["active_trip"] == trips[0].id
+    assert user["total_fare"] == 12.5
+
+
+def test_unknown_commands_share_one_stats_entry(bot_main, repository, driver):
+    start_shift(bot_main, driver)
+    send(bot_main, driver.message(text=f"/made_up_{driver.user_id}"))
+    commands = bot_main.tracer.stats()
+    assert f"/made_up_{driver.user_id}" not in commands
+    assert "/start_shift" in commands and "text" in commands
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import numpy as np
+from hotspots import HotspotIndex
+
+PICKUP_TIME = datetime(2024, 6, 3, 9, tzinfo=timezone.utc)
+
+
+def trip(minutes: int, fare: Optional[float]) -> Dict[str, Any]:
+    start_time = PICKUP_TIME + timedelta(minutes=minutes)
+    return {
+        "start_latitude": 22.2988,
+        "start_longitude": 114.1722,
+        "start_time": start_time,
+        "end_time": start_time + timedelta(minutes=15),
+        "fare": fare,
+    }
+
+
+def test_trip_awaiting_its_fare_is_binned_on_refresh():
+    index = HotspotIndex(project=lambda lat, lon: (np.asarray(lat), np.asarray(lon)))
+    assert index.add_trips([trip(0, 80.0), trip(30, None)]) == 1
+    paid_end_time = trip(0, 80.0)["end_time"]
+    assert index.watermark == paid_end_time
+
+    # The refresh fetches the trips ended after the watermark, now with its fare
+    assert index.add_trips([trip(30, 120.0)]) == 1
+    assert len(index) == 2
+    assert index.watermark == trip(30, 120.0)["end_time"]
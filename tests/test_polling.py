@@ -0,0 +1,192 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List
+
+import polling
+import pytest
+from polling import PollingRunner
+from stub_servers import BotAPIStub, server_url, start_stub
+
+
+def update(update_id: int, chat_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": "hi"},
+    }
+
+
+def interleaved(chats: int, per_chat: int) -> List[Dict[str, Any]]:
+    """Builds updates of several chats interleaved as Telegram sends them."""
+    return [
+        update(i * chats + chat + 1, chat)
+        for i in range(per_chat)
+        for chat in range(chats)
+    ]
+
+
+def run_until_handled(runner: PollingRunner, count: int) -> None:
+    """Runs the runner until count updates are handled, then stops it."""
+
+    def stop_when_done() -> None:
+        deadline = time.monotonic() + 10
+        while runner.processed < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        runner.stop()
+
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    asyncio.run(runner.run())
+
+
+@pytest.fixture
+def bot_api():
+    """A fake Bot API of its own for each test."""
+    server, stub = start_stub(BotAPIStub, (0.0, 0.0))
+    stub.url = f"{server_url(server)}/bot{{0}}/{{1}}"
+    yield stub
+    server.shutdown()
+
+
+def test_updates_of_a_chat_are_handled_in_order(bot_api):
+    updates = interleaved(chats=5, per_chat=20)
+    bot_api.add_updates(updates)
+    handled: Dict[int, List[int]] = {}
+    lock = threading.Lock()
+
+    def handler(data: Dict[str, Any]) -> None:
+        # Later updates of a chat finish first unless they wait for the earlier
+        time.sleep(0.002 * (data["update_id"] % 3))
+        with lock:
+            handled.setdefault(data["message"]["chat"]["id"], []).append(
+                data["update_id"]
+            )
+
+    runner = PollingRunner("0:test", handler, api_url=bot_api.url, poll_timeout=1)
+    run_until_handled(runner, len(updates))
+
+    assert runner.processed == len(updates)
+    for chat_id, update_ids in handled.items():
+        assert update_ids == sorted(update_ids), chat_id
+        assert len(update_ids) == 20
+
+
+def test_concurrency_is_capped(bot_api):
+    updates = interleaved(chats=10, per_chat=2)
+    bot_api.add_updates(updates)
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def handler(_: Dict[str, Any]) -> None:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+
+    runner = PollingRunner(
+        "0:test", handler, api_url=bot_api.url, poll_timeout=1, max_concurrency=3
+    )
+    run_until_handled(runner, len(updates))
+
+    assert runner.processed == len(updates)
+    assert peak == 3
+
+
+def test_offset_of_handled_updates_is_confirmed(bot_api):
+    updates = interleaved(chats=3, per_chat=5)
+    bot_api.add_updates(updates)
+    runner = PollingRunner(
+        "0:test", lambda _: None, api_url=bot_api.url, poll_timeout=1
+    )
+    run_until_handled(runner, len(updates))
+
+    assert runner.offset == updates[-1]["update_id"] + 1
+    assert bot_api.unconfirmed() == 0
+
+
+def test_updates_after_one_still_running_are_not_confirmed(bot_api):
+    updates = interleaved(chats=3, per_chat=4)
+    bot_api.add_updates(updates)
+    release = threading.Event()
+    handled: List[int] = []
+
+    def handler(data: Dict[str, Any]) -> None:
+        if data["update_id"] == 1:
+            release.wait(10)
+        handled.append(data["update_id"])
+
+    runner = PollingRunner(
+        "0:test", handler, api_url=bot_api.url, poll_timeout=1, batch_size=8
+    )
+    seen: List[Any] = []
+
+    def release_when_blocked() -> None:
+        deadline = time.monotonic() + 10
+        while len(handled) < 5 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        # The first chat waits on update 1, the window of 8 is full
+        seen.extend([sorted(handled), runner.offset, bot_api.unconfirmed()])
+        release.set()
+
+    threading.Thread(target=release_when_blocked, daemon=True).start()
+    run_until_handled(runner, len(updates))
+
+    # Killed then, Telegram would send every update again from the first
+    assert seen == [[2, 3, 5, 6, 8], None, len(updates)]
+    assert sorted(handled) == [u["update_id"] for u in updates]
+    assert runner.offset == updates[-1]["update_id"] + 1
+    assert bot_api.unconfirmed() == 0
+
+
+class FlakyBotAPIStub(BotAPIStub):
+    """Answers the first calls of each method in failures with an HTML error page.
+
+    As a proxy in front of the Bot API may.
+    """
+
+    failures: Dict[str, int] = {}
+
+    def handle_request(self) -> None:
+        stub = type(self)
+        method = self.path.rsplit("/", 1)[-1]
+        with stub.condition:
+            fail = stub.failures.get(method, 0) > 0
+            if fail:
+                stub.failures[method] -= 1
+        if not fail:
+            super().handle_request()
+            return
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b"<html><body>502 Bad Gateway</body></html>"
+        self.send_response(502)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_error_pages_are_retried(monkeypatch):
+    monkeypatch.setattr(polling, "MIN_RETRY_DELAY", 0.01)
+    server, stub = start_stub(FlakyBotAPIStub, (0.0, 0.0))
+    stub.failures = {"deleteWebhook": 2, "getUpdates": 1}
+    updates = interleaved(chats=2, per_chat=2)
+    stub.add_updates(updates)
+    try:
+        runner = PollingRunner(
+            "0:test",
+            lambda _: None,
+            api_url=f"{server_url(server)}/bot{{0}}/{{1}}",
+            poll_timeout=1,
+        )
+        run_until_handled(runner, len(updates))
+    finally:
+        server.shutdown()
+
+    assert runner.processed == len(updates)
+    assert runner.poll_errors == 1
+    assert stub.failures == {"deleteWebhook": 0, "getUpdates": 0}
+    assert stub.unconfirmed() == 0
@@ -0,0 +1,48 @@
+import threading
+from typing import List
+
+from send_scheduler import SendScheduler
+
+
+def scheduler() -> SendScheduler:
+    return SendScheduler(global_rate=1000, global_burst=10, chat_rate=1000)
+
+
+def test_recording_a_send_does_not_hold_up_the_chat():
+    send_scheduler = scheduler()
+    recorded = threading.Event()
+    sent: List[str] = []
+
+    send_scheduler.enqueue(
+        1, lambda: sent.append("export"), on_sent=lambda: recorded.wait(5)
+    )
+    send_scheduler.enqueue(1, lambda: sent.append("reply"))
+    assert not send_scheduler.join(timeout=0.5)
+    assert sent == ["export", "reply"]
+
+    recorded.set()
+    assert send_scheduler.join(timeout=5)
+
+
+def test_failing_to_record_a_send_is_not_a_failed_send():
+    send_scheduler = scheduler()
+
+    def record() -> None:
+        raise RuntimeError("stale session")
+
+    send_scheduler.enqueue(1, lambda: None, on_sent=record)
+    assert send_scheduler.join(timeout=5)
+    stats = send_scheduler.stats()
+    assert (stats["sent"], stats["failed"]) == (1, 0)
+
+
+def test_recording_a_direct_send_failing_is_logged(caplog):
+    send_scheduler = SendScheduler(enabled=False)
+    closed = threading.Event()
+
+    def record() -> None:
+        raise RuntimeError("stale session")
+
+    assert send_scheduler.enqueue(1, lambda: None, cleanup=closed.set, on_sent=record)
+    assert closed.is_set()
+    assert "Error recording a send to chat 1" in caplog.text
@@ -0,0 +1,86 @@
+import os
+import time
+import uuid
+
+import pytest
+from update_dedup import (
+    CLAIMED,
+    COMPLETED,
+    IN_PROGRESS,
+    PROCESSED_UPDATES_COLLECTION_NAME,
+    UpdateDeduplicator,
+)
+
+
+@pytest.fixture(params=["local", "shared"])
+def mode(request):
+    """Deduplicates in process, then with markers in the Firestore emulator."""
+    if request.param == "shared" and not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        pytest.skip("FIRESTORE_EMULATOR_HOST is not set, start the emulator first")
+    return request.param
+
+
+def deduplicator(bot_main, mode: str, lease: float = 60.0) -> UpdateDeduplicator:
+    return UpdateDeduplicator(
+        mode=mode,
+        collection=(
+            (lambda: bot_main.get_db().collection(PROCESSED_UPDATES_COLLECTION_NAME))
+            if mode == "shared"
+            else None
+        ),
+        lease=lease,
+    )
+
+
+def new_update_id() -> int:
+    # Random so that runs against the same emulator do not mix
+    return uuid.uuid4().int % 10**12
+
+
+def test_redeliveries_are_suppressed(bot_main, mode):
+    update_id = new_update_id()
+    first, second = deduplicator(bot_main, mode), deduplicator(bot_main, mode)
+    assert first.claim(update_id) == CLAIMED
+    assert first.claim(update_id) == IN_PROGRESS
+
+    first.complete(update_id)
+    assert first.claim(update_id) == COMPLETED
+    if mode == "shared":
+        # The redelivery reaches another instance
+        assert second.claim(update_id) == COMPLETED
+
+
+def test_claim_is_taken_over_once_its_lease_runs_out(bot_main):
+    update_id = new_update_id()
+    dedup = deduplicator(bot_main, "local", lease=0.2)
+    assert dedup.claim(update_id) == CLAIMED
+    assert dedup.claim(update_id) == IN_PROGRESS
+
+    time.sleep(0.3)
+    assert dedup.claim(update_id) == CLAIMED
+    dedup.complete(update_id)
+    assert dedup.claim(update_id) == COMPLETED
+
+
+def test_released_updates_are_claimed_again(bot_main, mode):
+    update_id = new_update_id()
+    dedup = deduplicator(bot_main, mode)
+    assert dedup.claim(update_id) == CLAIMED
+    dedup.release(update_id)
+    assert dedup.claim(update_id) == CLAIMED
+
+
+def test_shared_claim_is_a_single_write(bot_main, mode):
+    if mode != "shared":
+        pytest.skip("Only shared mode writes markers")
+    update_id = new_update_id()
+    dedup = deduplicator(bot_main, mode)
+    marker = bot_main.get_db().collection(PROCESSED_UPDATES_COLLECTION_NAME)
+    marker = marker.document(str(update_id))
+    assert dedup.claim(update_id) == CLAIMED
+    claimed = marker.get()
+
+    dedup.complete(update_id)
+    completed = marker.get()
+    assert completed.update_time == claimed.update_time
+    assert completed.get("expires_at") > completed.get("claimed_at")